@@ -0,0 +1,64 @@
+"""Parse throughput benchmark
+
+Measures how many Market By Price messages per second `flatten_market_by_price` turns into
+DataFrames. Run it on two builds (for example before and after a parser change, with
+`just develop-release` in between) to compare them:
+
+```
+python benches/parse_throughput.py --messages 20000 --map-entries 20
+```
+"""
+
+from argparse import ArgumentParser
+from time import perf_counter
+
+from lobmp import flatten_market_by_price
+from lobmp.definitions.fids import fid_types
+
+
+def generate_message(message_number: int, num_map_entries: int) -> str:
+    message = (
+        f"TESTTICKER.MC,Market By Price,2020-01-11T00:00:00.000000000Z,+0,Raw,"
+        f"UPDATE,UNSPECIFIED,,,,3240,,{message_number},0\n"
+        ",,,,Summary,,,,,,,,,1\n"
+        ",,,,FID,1,,PROD_PERM,3240,\n"
+    )
+    for index in range(num_map_entries):
+        message += (
+            f",,,,MapEntry,,UPDATE,,,,,,{index}.000000_B,6\n"
+            ",,,,FID,266,,BID_TIME,06:31:00.000000000,\n"
+            f",,,,FID,3427,,ORDER_PRC,{100 + index}.0,\n"
+            ",,,,FID,3428,,ORDER_SIDE,1,BID\n"
+            ",,,,FID,3430,,NO_ORD,9,\n"
+            ",,,,FID,4356,,ACC_SIZE,203,\n"
+            ",,,,FID,14268,,LV_TIM_NS,06:31:00.020570000,\n"
+        )
+    return message
+
+
+def main() -> None:
+    parser = ArgumentParser(description="Benchmark flatten_market_by_price throughput")
+    parser.add_argument("--messages", default=20000, type=int)
+    parser.add_argument("--map-entries", default=20, type=int)
+    parser.add_argument("--typed", action="store_true")
+    args = parser.parse_args()
+
+    messages = [generate_message(i, args.map_entries) for i in range(args.messages)]
+    start = perf_counter()
+    if args.typed:
+        for message in messages:
+            flatten_market_by_price(message, fid_types)
+    else:
+        # Untyped calls also work on builds that predate the FID type registry
+        for message in messages:
+            flatten_market_by_price(message)
+    elapsed = perf_counter() - start
+
+    print(  # noqa: T201
+        f"{args.messages} messages with {args.map_entries} map entries in {elapsed:.2f}s: "
+        f"{args.messages / elapsed:,.0f} messages/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
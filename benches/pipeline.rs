@@ -0,0 +1,155 @@
+//! Benchmarks of every stage of the pipeline on synthetic messages.
+//!
+//! ```sh
+//! cargo bench --bench pipeline
+//! ```
+//!
+//! Every group reports the throughput in input bytes, so the stages can be
+//! compared with each other and with the end-to-end benchmark.
+
+use _lobmp::fid_types::FidTypes;
+use _lobmp::parser::Parser;
+use _lobmp::synthetic::{Generator, SyntheticOptions};
+use _lobmp::tokenizer::{Record, RecordKind};
+use _lobmp::writer::{concat_aligned, initial_columns, parse_compression, WriterOptions};
+use criterion::{black_box, criterion_group, criterion_main, BatchSize, Criterion, Throughput};
+use polars::prelude::*;
+use std::collections::{BTreeMap, HashMap};
+use std::sync::Arc;
+
+const MESSAGES: usize = 2_000;
+
+fn messages() -> Vec<String> {
+    Generator::new(SyntheticOptions::default())
+        .take(MESSAGES)
+        .collect()
+}
+
+fn bytes(messages: &[String]) -> u64 {
+    messages.iter().map(|message| message.len() as u64).sum()
+}
+
+fn typed_fid_types() -> FidTypes {
+    let names = [
+        ("ORDER_PRC", "Float64"),
+        ("NO_ORD", "Int64"),
+        ("ACC_SIZE", "Int64"),
+        ("TIMACT_MS", "Int64"),
+        ("BID_TIME", "Time"),
+        ("ASK_TIME", "Time"),
+        ("LV_TIM_NS", "Time"),
+        ("ACTIV_DATE", "Date"),
+    ];
+    FidTypes::from_names(
+        names
+            .iter()
+            .map(|(name, dtype)| (name.to_string(), dtype.to_string()))
+            .collect::<HashMap<_, _>>(),
+    )
+    .unwrap()
+}
+
+fn parse(messages: &[String], fid_types: FidTypes) -> Vec<DataFrame> {
+    let mut parser = Parser::new(Arc::new(fid_types));
+    messages
+        .iter()
+        .map(|message| parser.market_by_price(message).unwrap())
+        .collect()
+}
+
+/// Every column of `dfs`, after the columns every output starts with.
+fn columns(dfs: &[DataFrame]) -> BTreeMap<String, DataType> {
+    let mut columns = initial_columns(&FidTypes::default());
+    for df in dfs {
+        for column in df.get_columns() {
+            columns.insert(column.name().to_string(), column.dtype().clone());
+        }
+    }
+    columns
+}
+
+fn bench_tokenize(c: &mut Criterion) {
+    let messages = messages();
+    let mut group = c.benchmark_group("tokenize");
+    group.throughput(Throughput::Bytes(bytes(&messages)));
+    group.bench_function("records", |b| {
+        b.iter(|| {
+            let mut fids = 0;
+            for message in &messages {
+                for line in message.as_bytes().split(|&byte| byte == b'\n') {
+                    let record = Record::new(line);
+                    if record.kind() == RecordKind::Fid {
+                        fids += record.fid().is_some() as usize;
+                    }
+                }
+            }
+            black_box(fids)
+        })
+    });
+    group.finish();
+}
+
+fn bench_flat_market_by_price(c: &mut Criterion) {
+    let messages = messages();
+    let mut group = c.benchmark_group("flat_market_by_price");
+    group.throughput(Throughput::Bytes(bytes(&messages)));
+    group.bench_function("untyped", |b| {
+        b.iter(|| black_box(parse(&messages, FidTypes::default())))
+    });
+    group.bench_function("typed", |b| {
+        b.iter(|| black_box(parse(&messages, typed_fid_types())))
+    });
+    group.finish();
+}
+
+fn bench_align(c: &mut Criterion) {
+    let messages = messages();
+    let dfs = parse(&messages, FidTypes::default());
+    let columns = columns(&dfs);
+    let mut group = c.benchmark_group("align");
+    group.throughput(Throughput::Bytes(bytes(&messages)));
+    group.bench_function("concat_aligned", |b| {
+        b.iter_batched(
+            || dfs.clone(),
+            |dfs| black_box(concat_aligned(dfs, &columns).unwrap()),
+            BatchSize::LargeInput,
+        )
+    });
+    group.finish();
+}
+
+fn bench_write_parquet(c: &mut Criterion) {
+    let messages = messages();
+    let dfs = parse(&messages, FidTypes::default());
+    let columns = columns(&dfs);
+    let df = concat_aligned(dfs, &columns).unwrap();
+    let mut group = c.benchmark_group("write_parquet");
+    group.throughput(Throughput::Bytes(bytes(&messages)));
+    for codec in ["uncompressed", "snappy", "zstd"] {
+        let options = WriterOptions {
+            compression: parse_compression(codec, None).unwrap(),
+            ..WriterOptions::default()
+        };
+        group.bench_function(codec, |b| {
+            b.iter_batched(
+                || df.clone(),
+                |mut df| {
+                    let mut buffer = Vec::new();
+                    options.parquet_writer(&mut buffer).finish(&mut df).unwrap();
+                    black_box(buffer)
+                },
+                BatchSize::LargeInput,
+            )
+        });
+    }
+    group.finish();
+}
+
+criterion_group!(
+    benches,
+    bench_tokenize,
+    bench_flat_market_by_price,
+    bench_align,
+    bench_write_parquet
+);
+criterion_main!(benches);
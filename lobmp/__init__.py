@@ -1,6 +1,42 @@
-from lobmp._lobmp import find_market_by_price_lines, flatten_map_entry, flatten_market_by_price, run
+from lobmp._lobmp import (
+    Stats,
+    build_index,
+    compact,
+    extract_messages,
+    find_market_by_price_lines,
+    flatten_map_entry,
+    flatten_market_by_price,
+    flatten_market_by_price_many,
+    flatten_messages,
+    generate_messages,
+    iter_batches,
+    read_index,
+    read_ipc_index,
+    reconstruct_book,
+    run,
+    run_many,
+)
 from lobmp._version import VERSION
+from lobmp.aio import run_async
 
 __version__ = VERSION
 
-__all__ = ["find_market_by_price_lines", "flatten_map_entry", "flatten_market_by_price", "run"]
+__all__ = [
+    "Stats",
+    "build_index",
+    "compact",
+    "extract_messages",
+    "find_market_by_price_lines",
+    "flatten_map_entry",
+    "flatten_market_by_price",
+    "flatten_market_by_price_many",
+    "flatten_messages",
+    "generate_messages",
+    "iter_batches",
+    "read_index",
+    "read_ipc_index",
+    "reconstruct_book",
+    "run",
+    "run_async",
+    "run_many",
+]
@@ -1,8 +1,154 @@
+from collections.abc import Callable, Iterator
 from pathlib import Path
+from typing import Any, Literal, overload
 
 from polars import DataFrame
 
 def find_market_by_price_lines(path: Path) -> list: ...
-def flatten_map_entry(map_entry: str) -> list[list]: ...
-def flatten_market_by_price(market_by_price: str) -> DataFrame: ...
-def run(input_file: Path, output_directory: Path) -> bool: ...
+@overload
+def flatten_map_entry(
+    map_entry: str, fid_types: dict[str, str] | None = None, as_lists: Literal[False] = False
+) -> DataFrame: ...
+@overload
+def flatten_map_entry(
+    map_entry: str, fid_types: dict[str, str] | None = None, *, as_lists: Literal[True]
+) -> list[list]: ...
+def reconstruct_book(
+    messages: list[str], depth: int = 10, interval: str | None = None
+) -> DataFrame: ...
+def flatten_market_by_price(
+    market_by_price: str, fid_types: dict[str, str] | None = None
+) -> DataFrame: ...
+def flatten_market_by_price_many(
+    messages: list[str] | bytes, fid_types: dict[str, str] | None = None
+) -> DataFrame: ...
+
+class Stats:
+    @property
+    def elapsed(self) -> float: ...
+    @property
+    def bytes_read(self) -> int: ...
+    @property
+    def messages_read(self) -> int: ...
+    @property
+    def messages_parsed(self) -> int: ...
+    @property
+    def rows_written(self) -> int: ...
+    @property
+    def bytes_written(self) -> int: ...
+    @property
+    def stages(self) -> dict[str, dict[str, float]]: ...
+    @property
+    def parsing_queue_peak(self) -> int: ...
+    @property
+    def dataframes_queue_peak(self) -> int: ...
+    @property
+    def reorder_buffer_peak(self) -> int: ...
+    @property
+    def parts(self) -> list[dict[str, Any]]: ...
+    @property
+    def peak_rss(self) -> int | None: ...
+    def to_dict(self) -> dict[str, Any]: ...
+
+class BatchIterator(Iterator[DataFrame]):
+    def __iter__(self) -> BatchIterator: ...
+    def __next__(self) -> DataFrame: ...
+
+def iter_batches(
+    path: Path,
+    batch_rows: int = 65536,
+    memory_map: bool = False,
+    fid_types: dict[str, str] | None = None,
+    tickers: list[str] | None = None,
+    fids: list[str] | None = None,
+    start: str | None = None,
+    end: str | None = None,
+) -> BatchIterator: ...
+def generate_messages(
+    path: Path,
+    size: int,
+    tickers: int = 50,
+    refresh_ratio: float = 0.001,
+    map_entries: int = 4,
+    book_depth: int = 20,
+    seed: int = 0,
+) -> int: ...
+def run(
+    input_file: Path,
+    output_directory: Path,
+    memory_map: bool = False,
+    fid_types: dict[str, str] | None = None,
+    book_depth: int | None = None,
+    book_interval: str | None = None,
+    hive_partitioning: bool = False,
+    compression: str = "zstd",
+    compression_level: int | None = None,
+    row_group_size: int | None = None,
+    part_size: int | None = None,
+    statistics: bool = True,
+    resume: bool = False,
+    tickers: list[str] | None = None,
+    fids: list[str] | None = None,
+    start: str | None = None,
+    end: str | None = None,
+    write_stats: bool = False,
+    progress: Callable[[int, int], object] | None = None,
+    writers: int | None = None,
+    ordered: bool = True,
+    memory_limit: int | None = None,
+    write_index: bool = False,
+    schema: list[str] | None = None,
+    cache_schema: bool = False,
+    output_format: str = "parquet",
+    ipc_compression: str = "uncompressed",
+) -> Stats: ...
+def run_many(
+    input_files: list[Path],
+    output_directories: list[Path],
+    memory_map: bool = False,
+    fid_types: dict[str, str] | None = None,
+    hive_partitioning: bool = False,
+    compression: str = "zstd",
+    compression_level: int | None = None,
+    row_group_size: int | None = None,
+    part_size: int | None = None,
+    statistics: bool = True,
+    resume: bool = False,
+    tickers: list[str] | None = None,
+    fids: list[str] | None = None,
+    start: str | None = None,
+    end: str | None = None,
+    write_stats: bool = False,
+    writers: int | None = None,
+    ordered: bool = True,
+    memory_limit: int | None = None,
+    schema: list[str] | None = None,
+    cache_schema: bool = False,
+    output_format: str = "parquet",
+    ipc_compression: str = "uncompressed",
+) -> list[Stats]: ...
+def build_index(input_file: Path) -> int: ...
+def read_index(input_file: Path) -> DataFrame: ...
+def read_ipc_index(part_file: Path) -> DataFrame: ...
+def compact(
+    output_directory: Path | str,
+    part_size: int | None = None,
+    row_group_size: int | None = None,
+    compression: str = "zstd",
+    compression_level: int | None = None,
+    statistics: bool = True,
+    memory_limit: int | None = None,
+) -> int: ...
+def extract_messages(
+    input_file: Path,
+    tickers: list[str] | None = None,
+    start: str | None = None,
+    end: str | None = None,
+) -> list[str]: ...
+def flatten_messages(
+    input_file: Path,
+    tickers: list[str] | None = None,
+    start: str | None = None,
+    end: str | None = None,
+    fid_types: dict[str, str] | None = None,
+) -> DataFrame: ...
@@ -0,0 +1,52 @@
+from asyncio import CancelledError, get_running_loop, shield
+from collections.abc import Callable
+from contextlib import suppress
+from functools import partial
+from pathlib import Path
+from threading import Event
+from typing import Any
+
+from lobmp._lobmp import Stats, run
+
+__author__ = "davidricodias"
+__copyright__ = "davidricodias"
+__license__ = "MIT"
+
+
+class _Cancelled(Exception):
+    """Raised from the progress callback to stop a run whose task was cancelled"""
+
+
+async def run_async(
+    input_file: Path,
+    output_directory: Path,
+    progress: Callable[[int, int], object] | None = None,
+    **kwargs: Any,
+) -> Stats:
+    """Runs `run` on a thread of the default executor, without blocking the event loop
+
+    Takes the same arguments as `run`. `progress` is called on the event loop with the bytes of the
+    input read so far and its size, about once a second. Cancelling the task stops the run within a
+    second or so: the messages already read are written and the output is left incomplete, so it
+    can be resumed with `resume=True`. The task only ends once the run has stopped.
+    """
+    loop = get_running_loop()
+    cancelled = Event()
+
+    def report(bytes_done: int, bytes_total: int) -> None:
+        if cancelled.is_set():
+            raise _Cancelled
+        if progress is not None:
+            loop.call_soon_threadsafe(progress, bytes_done, bytes_total)
+
+    future = loop.run_in_executor(
+        None, partial(run, input_file, output_directory, progress=report, **kwargs)
+    )
+    try:
+        # Shielded, so cancelling the task does not abandon the run while it is still writing
+        return await shield(future)
+    except CancelledError:
+        cancelled.set()
+        with suppress(_Cancelled):
+            await future
+        raise
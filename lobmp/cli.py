@@ -6,30 +6,137 @@ This module provides functionality to let users call the message processor using
 line interface.
 
 The `cli` module implements an `argparse` with the follwing flags:
-- `--filepath <path>`: path of the file to be processed.
+- `--filepath <path>`: path of the file to be processed. Several paths, directories and glob
+  patterns are accepted, and all the files share one pool of workers.
 - `--provider <str>`: provider of the data to be processed. Currently *only supports lseg*.
+- `--memory-map`: memory-map the input and split it across all the parsing workers.
+- `--typed`: write typed columns following `lobmp.definitions.fids.fid_types`.
+- `--hive-partitioning`: write the output partitioned as `TICKER=<ticker>/date=<YYYY-MM-DD>`.
+- `--book-depth <int>`: reconstruct the order books and write top-N snapshots instead of messages.
+- `--book-interval <str>`: resample the book snapshots at a fixed interval such as `1s`.
+- `--compression <str>` and `--compression-level <int>`: Parquet codec of the output, `zstd` by
+  default.
+- `--row-group-size <int>`: rows of every Parquet row group, or IPC record batch.
+- `--format <str>`: write `parquet` parts, Arrow `ipc` parts (`part-*.arrow`) or `both`.
+- `--ipc-compression <str>`: codec of the IPC parts, `uncompressed` by default so they can be
+  memory-mapped.
+- `--part-size <int>`: estimated in-memory bytes of the messages written to every part file.
+- `--no-statistics`: do not write column statistics.
+- `--writers <int>`: threads that align and encode the part files of every output at once.
+- `--unordered`: write the messages as they are parsed, with a `MESSAGE_INDEX` column.
+- `--memory-limit <int>`: estimated bytes the messages being processed may hold at once.
+- `--pinned-schema [<path>]`: write exactly the columns of `lobmp.definitions.fids.columns_order`,
+  or of a JSON list of names, in that order, without discovering them.
+- `--cache-schema`: start from the schema cached by an earlier run of the same input, and cache
+  the one discovered next to the input.
+- `--resume`: continue an interrupted run from its `_manifest.json` checkpoint.
+- `--tickers <str> ...` and `--fids <str> ...`: keep only these tickers and FID columns.
+- `--start <timestamp>` and `--end <timestamp>`: keep only the messages in the UTC window
+  `[start, end)`, given in ISO 8601.
+- `--stats`: write the metrics of every run to `_stats.json` in its output directory.
 
 Example:
 ```
 lobmp --filepath download_1.csv
 ```
 
+The `compact` subcommand merges the part files of finished outputs into parts sorted by `TICKER`
+and `TIMESTAMP`, with row groups sized for pruning, and replaces the originals:
+```
+lobmp compact output/download_1.parquet --part-size 268435456
+```
+
 Author: davidricodias
 """
 
 from argparse import ArgumentParser
 from sys import argv, exit, stderr
 
-from lobmp.main import main
+from lobmp.main import compact_main, main, pinned_schema
 
 __author__ = "davidricodias"
 __copyright__ = "davidricodias"
 __license__ = "MIT"
 
 
+def compact_cli(args: list[str]) -> int:
+    parser = ArgumentParser(
+        prog="lobmp compact",
+        description="Merge the part files of finished outputs into parts sorted by TICKER and "
+        "TIMESTAMP, replacing the originals.",
+    )
+    parser.add_argument(
+        "targetdir", nargs="+", help="Output directories of finished runs.", type=str
+    )
+    parser.add_argument(
+        "--verbose",
+        default="NOTSET",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL", "NOTSET"],
+        help="Level of logging desired. Default is NOTSET, which is no logging.",
+        type=str,
+    )
+    parser.add_argument(
+        "--part-size",
+        default=None,
+        help="Estimated in-memory bytes of the rows of every compacted part. Default is 128 MiB.",
+        type=int,
+    )
+    parser.add_argument(
+        "--row-group-size",
+        default=None,
+        help="Rows of every row group of the compacted parts. Default is 65536.",
+        type=int,
+    )
+    parser.add_argument(
+        "--compression",
+        default="zstd",
+        choices=["uncompressed", "snappy", "gzip", "lz4", "zstd", "brotli"],
+        help="Parquet compression codec. Default is zstd.",
+        type=str,
+    )
+    parser.add_argument(
+        "--compression-level",
+        default=None,
+        help="Level of the gzip, zstd or brotli codec. Default is the codec default.",
+        type=int,
+    )
+    parser.add_argument(
+        "--no-statistics",
+        action="store_false",
+        dest="statistics",
+        help="Do not write the min, max and null count statistics of every column.",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        default=None,
+        help="Estimated bytes of rows the sort holds at once, spilling sorted runs to disk "
+        "beyond it. Default is 1 GiB.",
+        type=int,
+    )
+    parsed = parser.parse_args(args)
+    return compact_main(
+        parsed.targetdir,
+        parsed.verbose,
+        parsed.part_size,
+        parsed.row_group_size,
+        parsed.compression,
+        parsed.compression_level,
+        parsed.statistics,
+        parsed.memory_limit,
+    )
+
+
 def cli() -> int:
+    if len(argv) > 1 and argv[1] == "compact":
+        return compact_cli(argv[2:])
+
     parser = ArgumentParser(description="Limit Order Book Messages Processor")
-    parser.add_argument("filepath", help="Path to the input file.", type=str)
+    parser.add_argument(
+        "filepath",
+        nargs="+",
+        help="Paths to the input files, directories of CSV files or glob patterns.",
+        type=str,
+    )
     parser.add_argument("targetdir", help="Directory for the processed data.", type=str)
     parser.add_argument(
         "--verbose",
@@ -38,6 +145,162 @@ def cli() -> int:
         help="Level of logging desired. Default is NOTSET, which is no logging.",
         type=str,
     )
+    parser.add_argument(
+        "--memory-map",
+        action="store_true",
+        help="Memory-map the input and let every worker split and parse its own byte range.",
+    )
+    parser.add_argument(
+        "--typed",
+        action="store_true",
+        help="Write typed columns using the FID type registry instead of strings.",
+    )
+
+    parser.add_argument(
+        "--hive-partitioning",
+        action="store_true",
+        help="Partition the output by ticker and trading date, as TICKER=<ticker>/date=<date>.",
+    )
+    parser.add_argument(
+        "--book-depth",
+        default=None,
+        help="Reconstruct the order book of every ticker and write snapshots of this many levels.",
+        type=int,
+    )
+    parser.add_argument(
+        "--book-interval",
+        default=None,
+        help="Take book snapshots at the end of every interval (e.g. 500ms, 1s, 5m) instead of "
+        "after every message.",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--compression",
+        default="zstd",
+        choices=["uncompressed", "snappy", "gzip", "lz4", "zstd", "brotli"],
+        help="Parquet compression codec. Default is zstd.",
+        type=str,
+    )
+    parser.add_argument(
+        "--compression-level",
+        default=None,
+        help="Level of the gzip, zstd or brotli codec. Default is the codec default.",
+        type=int,
+    )
+    parser.add_argument(
+        "--row-group-size",
+        default=None,
+        help="Rows of every Parquet row group, or IPC record batch. Default is the Polars default "
+        "for Parquet and 65536 for IPC.",
+        type=int,
+    )
+    parser.add_argument(
+        "--format",
+        default="parquet",
+        choices=["parquet", "ipc", "both"],
+        help="Write the parts as Parquet, as Arrow IPC files (part-*.arrow) that can be "
+        "memory-mapped, or both. Default is parquet.",
+        type=str,
+    )
+    parser.add_argument(
+        "--ipc-compression",
+        default="uncompressed",
+        choices=["uncompressed", "lz4", "zstd"],
+        help="Codec of the IPC parts. Default is uncompressed, which is read without copies.",
+        type=str,
+    )
+    parser.add_argument(
+        "--part-size",
+        default=None,
+        help="Estimated in-memory bytes of the messages written to every part file. "
+        "Default is 128 MiB.",
+        type=int,
+    )
+    parser.add_argument(
+        "--no-statistics",
+        action="store_false",
+        dest="statistics",
+        help="Do not write the min, max and null count statistics of every column.",
+    )
+    parser.add_argument(
+        "--writers",
+        default=None,
+        help="Threads that align and encode the part files of every output at the same time. "
+        "Default is 4.",
+        type=int,
+    )
+    parser.add_argument(
+        "--unordered",
+        action="store_false",
+        dest="ordered",
+        help="Write the messages as they are parsed instead of in input order. Every row has a "
+        "MESSAGE_INDEX column that sorts them back in input order. Can not be resumed.",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        default=None,
+        help="Estimated bytes the messages being read, parsed, reordered and batched may hold at "
+        "once. Readers wait and batches are written early to stay under it. Default is no limit.",
+        type=int,
+    )
+    parser.add_argument(
+        "--pinned-schema",
+        nargs="?",
+        const="",
+        default=None,
+        help="Write exactly these columns, in this order, without discovering them: the names "
+        "of lobmp.definitions.fids.columns_order, or of a JSON list in the given file.",
+        type=str,
+    )
+    parser.add_argument(
+        "--cache-schema",
+        action="store_true",
+        help="Start from the schema cached by an earlier run of the same input, so no part is "
+        "rewritten, and cache the schema discovered in <input>.lobmpschema.json.",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run from the manifest in the output directory, skipping "
+        "the files that are complete.",
+    )
+
+    parser.add_argument(
+        "--tickers",
+        nargs="+",
+        default=None,
+        help="Keep only the messages of these tickers.",
+        type=str,
+    )
+    parser.add_argument(
+        "--fids",
+        nargs="+",
+        default=None,
+        help="Keep only these FID columns. The header columns are always kept.",
+        type=str,
+    )
+    parser.add_argument(
+        "--start",
+        default=None,
+        help="Keep only the messages from this ISO 8601 timestamp on, in UTC.",
+        type=str,
+    )
+    parser.add_argument(
+        "--end",
+        default=None,
+        help="Keep only the messages before this ISO 8601 timestamp, in UTC.",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Write the metrics of the run (messages and bytes read, busy and idle time of every "
+        "stage, queue peaks, parts written and peak memory) to _stats.json in the output "
+        "directory.",
+    )
 
     # Show help if no arguments are provided
     if len(argv) == 1:
@@ -45,7 +308,48 @@ def cli() -> int:
         exit(1)
 
     args = parser.parse_args()
-    return main(args.filepath, args.targetdir, args.verbose)
+    if args.book_interval is not None and args.book_depth is None:
+        parser.error("--book-interval requires --book-depth")
+    if not args.ordered and (args.book_depth is not None or args.resume):
+        parser.error("--unordered can not be used with --book-depth or --resume")
+    if args.pinned_schema is not None and args.cache_schema:
+        parser.error("--pinned-schema can not be used with --cache-schema")
+    if args.book_depth is not None and (args.pinned_schema is not None or args.cache_schema):
+        parser.error("--pinned-schema and --cache-schema can not be used with --book-depth")
+    if args.book_depth is not None and args.format != "parquet":
+        parser.error("--book-depth only writes Parquet")
+    if args.book_depth is not None and (args.memory_map or args.typed or args.hive_partitioning):
+        parser.error(
+            "--memory-map, --typed and --hive-partitioning can not be used with --book-depth"
+        )
+    return main(
+        args.filepath,
+        args.targetdir,
+        args.verbose,
+        args.memory_map,
+        args.typed,
+        args.book_depth,
+        args.book_interval,
+        args.hive_partitioning,
+        args.compression,
+        args.compression_level,
+        args.row_group_size,
+        args.part_size,
+        args.statistics,
+        args.resume,
+        args.tickers,
+        args.fids,
+        args.start,
+        args.end,
+        args.stats,
+        args.writers,
+        args.ordered,
+        args.memory_limit,
+        pinned_schema(args.pinned_schema) if args.pinned_schema is not None else None,
+        args.cache_schema,
+        args.format,
+        args.ipc_compression,
+    )
 
 
 if __name__ == "__main__":
@@ -1,38 +1,40 @@
+# Every known FID maps to its code, whether its value is in the second value column, and the
+# type of its output column
 known_fids = {
-    "PROD_PERM": ["1", False],
-    "DSPLY_NAME": ["3", False],
-    "CURRENCY": ["15", True],
-    "ACTIV_DATE": ["17", False],
-    "RECORDTYPE": ["259", False],
-    "RDN_EXCHD2": ["1709", True],
-    "QUOTE_DATE": ["3386", False],
-    "PROV_SYMB": ["3422", False],
-    "PR_RNK_RUL": ["3423", True],
-    "OR_RNK_RUL": ["3425", True],
-    "MNEMONIC": ["3694", False],
-    "QUOTIM_MS": ["3855", False],
-    "MKT_STATUS": ["3915", False],
-    "TIMACT_MS": ["4148", False],
-    "CONTEXT_ID": ["5357", False],
-    "DDS_DSO_ID": ["6401", False],
-    "SPS_SP_RIC": ["6480", False],
-    "BOOK_STATE": ["6516", True],
-    "HALT_REASN": ["6517", False],
-    "MKT_OR_RUL": ["6519", True],
-    "TRD_STATUS": ["6614", True],
-    "HALT_RSN": ["6615", True],
-    "INST_PHASE": ["8927", True],
-    "TIMACT_NS": ["14269", False],
-    "BID_TIME": ["266", False],
-    "ORDER_PRC": ["3427", False],
-    "ORDER_SIDE": ["3428", True],
-    "NO_ORD": ["3430", False],
-    "ACC_SIZE": ["4356", False],
-    "LV_TIM_MS": ["6527", False],
-    "LV_DATE": ["6529", False],
-    "LV_TIM_NS": ["14268", False],
-    "ASK_TIME": ["267", False],
-    "ORDBK_VOL": ["3875", False],
+    "PROD_PERM": ["1", False, "Int64"],
+    "DSPLY_NAME": ["3", False, "String"],
+    "CURRENCY": ["15", True, "Categorical"],
+    "ACTIV_DATE": ["17", False, "Date"],
+    "RECORDTYPE": ["259", False, "Int64"],
+    "RDN_EXCHD2": ["1709", True, "Categorical"],
+    "QUOTE_DATE": ["3386", False, "Date"],
+    "PROV_SYMB": ["3422", False, "String"],
+    "PR_RNK_RUL": ["3423", True, "Categorical"],
+    "OR_RNK_RUL": ["3425", True, "Categorical"],
+    "MNEMONIC": ["3694", False, "String"],
+    "QUOTIM_MS": ["3855", False, "Int64"],
+    "MKT_STATUS": ["3915", False, "String"],
+    "TIMACT_MS": ["4148", False, "Int64"],
+    "CONTEXT_ID": ["5357", False, "Int64"],
+    "DDS_DSO_ID": ["6401", False, "Int64"],
+    "SPS_SP_RIC": ["6480", False, "String"],
+    "BOOK_STATE": ["6516", True, "Categorical"],
+    "HALT_REASN": ["6517", False, "String"],
+    "MKT_OR_RUL": ["6519", True, "Categorical"],
+    "TRD_STATUS": ["6614", True, "Categorical"],
+    "HALT_RSN": ["6615", True, "Categorical"],
+    "INST_PHASE": ["8927", True, "Categorical"],
+    "TIMACT_NS": ["14269", False, "Time"],
+    "BID_TIME": ["266", False, "Time"],
+    "ORDER_PRC": ["3427", False, "Float64"],
+    "ORDER_SIDE": ["3428", True, "Categorical"],
+    "NO_ORD": ["3430", False, "Int64"],
+    "ACC_SIZE": ["4356", False, "Int64"],
+    "LV_TIM_MS": ["6527", False, "Int64"],
+    "LV_DATE": ["6529", False, "Date"],
+    "LV_TIM_NS": ["14268", False, "Time"],
+    "ASK_TIME": ["267", False, "Time"],
+    "ORDBK_VOL": ["3875", False, "Int64"],
 }
 
 columns_order = [
@@ -86,3 +88,17 @@ supplement = [
     "MAP_ENTRY_TYPE",
     "MAP_ENTRY_KEY",
 ]
+
+supplement_types = {
+    "TICKER": "String",
+    "TIMESTAMP": "Datetime",  # Exchange local time, GMT_OFFSET is applied
+    "GMT_OFFSET": "String",
+    "MARKET_MESSAGE_TYPE": "Categorical",
+    "MAP_ENTRY_TYPE": "Categorical",
+    "MAP_ENTRY_KEY": "String",
+}
+
+# Type registry used for typed output columns, unknown FIDs stay as strings
+fid_types: dict[str, str] = {
+    name: str(fid[2]) for name, fid in known_fids.items()
+} | supplement_types
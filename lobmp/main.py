@@ -1,23 +1,221 @@
+from collections.abc import Sequence
+from glob import glob, has_magic
+from json import loads
 from logging import NOTSET, _levelToName
 from pathlib import Path
+from typing import TypedDict
 
-from lobmp import run
+from lobmp import compact, run, run_many
+from lobmp.definitions.fids import columns_order, fid_types
 from lobmp.logger import activate_logger, log, set_logger_level
 
 __author__ = "davidricodias"
 __copyright__ = "davidricodias"
 __license__ = "MIT"
 
+INPUT_SUFFIXES = (".csv", ".csv.gz", ".csv.zst")
 
-def main(filepath: str, targetdir: str, verbose: int | str = "NOTSET") -> int:
-    status: int = 0
+
+class ParquetOptions(TypedDict):
+    compression: str
+    compression_level: int | None
+    row_group_size: int | None
+    part_size: int | None
+    statistics: bool
+    writers: int | None
+
+
+class FilterOptions(TypedDict):
+    tickers: list[str] | None
+    fids: list[str] | None
+    start: str | None
+    end: str | None
+
+
+def input_files(filepaths: str | Sequence[str]) -> list[Path]:
+    """Expands files, directories and glob patterns into the list of files to process"""
+    if isinstance(filepaths, str):
+        filepaths = [filepaths]
+    files: list[Path] = []
+    for filepath in filepaths:
+        path = Path(filepath)
+        if path.is_dir():
+            files += sorted(
+                p for p in path.iterdir() if p.name.endswith(INPUT_SUFFIXES) and p.is_file()
+            )
+        elif not path.exists() and has_magic(filepath):
+            files += [Path(p) for p in sorted(glob(filepath, recursive=True)) if Path(p).is_file()]
+        else:
+            files.append(path)
+    return files
+
+
+def pinned_schema(schema_file: str | None = None) -> list[str]:
+    """Columns of a pinned schema, a JSON list of names in `schema_file` or `columns_order`"""
+    if not schema_file:
+        return list(columns_order)
+    schema = loads(Path(schema_file).read_text())
+    if not isinstance(schema, list) or not all(isinstance(name, str) for name in schema):
+        raise ValueError(f"The schema file {schema_file} is not a JSON list of column names")
+    return schema
+
+
+def output_directory(targetdir: str, input_file_path: Path, output_format: str = "parquet") -> Path:
+    suffix = ".arrow" if output_format == "ipc" else ".parquet"
+    return (Path(targetdir) / input_file_path.stem).with_suffix(suffix)
+
+
+def main(
+    filepath: str | Sequence[str],
+    targetdir: str,
+    verbose: int | str = "NOTSET",
+    memory_map: bool = False,
+    typed: bool = False,
+    book_depth: int | None = None,
+    book_interval: str | None = None,
+    hive_partitioning: bool = False,
+    compression: str = "zstd",
+    compression_level: int | None = None,
+    row_group_size: int | None = None,
+    part_size: int | None = None,
+    statistics: bool = True,
+    resume: bool = False,
+    tickers: list[str] | None = None,
+    fids: list[str] | None = None,
+    start: str | None = None,
+    end: str | None = None,
+    write_stats: bool = False,
+    writers: int | None = None,
+    ordered: bool = True,
+    memory_limit: int | None = None,
+    schema: list[str] | None = None,
+    cache_schema: bool = False,
+    output_format: str = "parquet",
+    ipc_compression: str = "uncompressed",
+) -> int:
     if verbose != _levelToName[NOTSET]:
         activate_logger()
         set_logger_level(verbose)
 
-    input_file_path = Path(filepath)
-    output_directory_path = (Path(targetdir) / input_file_path.stem).with_suffix(".parquet")
+    input_file_paths = input_files(filepath)
+    if not input_file_paths:
+        raise FileNotFoundError(f"No input files found in {filepath}")
+    output_directory_paths = [
+        output_directory(targetdir, path, output_format) for path in input_file_paths
+    ]
+    if len(set(output_directory_paths)) < len(output_directory_paths):
+        raise ValueError("Several input files would be written to the same output directory")
+
+    parquet_options: ParquetOptions = {
+        "compression": compression,
+        "compression_level": compression_level,
+        "row_group_size": row_group_size,
+        "part_size": part_size,
+        "statistics": statistics,
+        "writers": writers,
+    }
+    filter_options: FilterOptions = {"tickers": tickers, "fids": fids, "start": start, "end": end}
+
+    if book_depth is not None:
+        # Books are replayed in message order, one file at a time
+        for input_file_path, output_directory_path in zip(
+            input_file_paths, output_directory_paths, strict=True
+        ):
+            with log.timeit(f"Execute book reconstruction of {input_file_path}"):
+                # The options books do not support are passed on, so run rejects them
+                stats = run(
+                    input_file_path,
+                    output_directory_path,
+                    memory_map=memory_map,
+                    fid_types=fid_types if typed else None,
+                    book_depth=book_depth,
+                    book_interval=book_interval,
+                    hive_partitioning=hive_partitioning,
+                    resume=resume,
+                    write_stats=write_stats,
+                    ordered=ordered,
+                    memory_limit=memory_limit,
+                    schema=schema,
+                    cache_schema=cache_schema,
+                    output_format=output_format,
+                    **parquet_options,
+                    **filter_options,
+                )
+                log.info(f"{input_file_path}: {stats}")
+        return 0
+
+    if len(input_file_paths) == 1:
+        with log.timeit("Execute run"):
+            stats = run(
+                input_file_paths[0],
+                output_directory_paths[0],
+                memory_map=memory_map,
+                fid_types=fid_types if typed else None,
+                hive_partitioning=hive_partitioning,
+                resume=resume,
+                write_stats=write_stats,
+                ordered=ordered,
+                memory_limit=memory_limit,
+                schema=schema,
+                cache_schema=cache_schema,
+                output_format=output_format,
+                ipc_compression=ipc_compression,
+                **parquet_options,
+                **filter_options,
+            )
+        log.info(f"{input_file_paths[0]}: {stats}")
+        return 0
+
+    with log.timeit(f"Execute run of {len(input_file_paths)} files"):
+        all_stats = run_many(
+            input_file_paths,
+            output_directory_paths,
+            memory_map=memory_map,
+            fid_types=fid_types if typed else None,
+            hive_partitioning=hive_partitioning,
+            resume=resume,
+            write_stats=write_stats,
+            ordered=ordered,
+            memory_limit=memory_limit,
+            schema=schema,
+            cache_schema=cache_schema,
+            output_format=output_format,
+            ipc_compression=ipc_compression,
+            **parquet_options,
+            **filter_options,
+        )
+    for input_file_path, stats in zip(input_file_paths, all_stats, strict=True):
+        log.info(f"{input_file_path}: {stats}")
+    return 0
+
+
+def compact_main(
+    targetdir: str | Sequence[str],
+    verbose: int | str = "NOTSET",
+    part_size: int | None = None,
+    row_group_size: int | None = None,
+    compression: str = "zstd",
+    compression_level: int | None = None,
+    statistics: bool = True,
+    memory_limit: int | None = None,
+) -> int:
+    """Compacts the parts of every output directory in `targetdir`"""
+    if verbose != _levelToName[NOTSET]:
+        activate_logger()
+        set_logger_level(verbose)
 
-    with log.timeit("Execute run"):
-        status = run(input_file_path, output_directory_path)
-    return status
+    if isinstance(targetdir, str):
+        targetdir = [targetdir]
+    for output_directory_path in targetdir:
+        with log.timeit(f"Compact {output_directory_path}"):
+            parts = compact(
+                output_directory_path,
+                part_size=part_size,
+                row_group_size=row_group_size,
+                compression=compression,
+                compression_level=compression_level,
+                statistics=statistics,
+                memory_limit=memory_limit,
+            )
+        log.info(f"{output_directory_path}: {parts} parts")
+    return 0
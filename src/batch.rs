@@ -0,0 +1,575 @@
+//! Processing of input files on one shared pool of threads.
+//!
+//! Every conversion to parts goes through this pool, a single file for `run`
+//! as well as a batch for `run_many`. A bounded number of files are open at a
+//! time. Each open file has a reader, which streams its messages (or,
+//! memory-mapped, its byte ranges) into a parsing queue shared by every file,
+//! and a writer of its own. The parsing workers are shared by all the files,
+//! so the cores stay busy while a file is starting or its writer is doing the
+//! final flush.
+//!
+//! Every file has a checkpoint manifest of its own, so a resumed batch skips
+//! the files that are complete and resumes the others where they stopped.
+//!
+//! The memory limit is shared by the whole batch: the readers of every file
+//! wait for the same `Budget` before sending their messages or ranges.
+//!
+//! Every file also has metrics and a progress of its own. As the parsing
+//! workers are shared, only their busy time is split between the files.
+//!
+//! A message that can not be parsed fails its file only: the rest of that file
+//! is dropped and its job returns the error, while the other files go on.
+
+use crate::budget::Budget;
+use crate::fid_types::FidTypes;
+use crate::filter::Filter;
+use crate::input::{self, Compression, Input};
+use crate::manifest::Manifest;
+use crate::parser::Parser;
+use crate::progress::Progress;
+use crate::reader::{for_each_message, IndexedMessage};
+use crate::schema::{OutputSchema, SchemaCache};
+use crate::splitter;
+use crate::stats::{Metrics, Timer};
+use crate::writer::{fail_writer, spawn_writer, IndexedDataFrame, InputEnd, WriterOptions};
+use crossbeam::channel::{bounded, unbounded, Sender};
+use memmap2::Mmap;
+use std::fmt;
+use std::fs::{self, File};
+use std::ops::Range;
+use std::path::{Path, PathBuf};
+use std::sync::atomic::{AtomicUsize, Ordering};
+use std::sync::Arc;
+use std::thread::{self, available_parallelism};
+use std::time::{Duration, Instant};
+
+/// Parsing workers for every file that is open at the same time.
+const CPUS_PER_OPEN_FILE: usize = 4;
+/// Error of a task whose writer is gone.
+const WRITER_STOPPED: &str = "The writer stopped before every message was written";
+
+/// An input file, the directory its parts are written to, and the metrics and
+/// the progress of its conversion. Cancelling the progress stops the reader of
+/// the file, and the parts of the messages read so far are still written.
+pub struct BatchJob {
+    pub input: PathBuf,
+    pub output: PathBuf,
+    pub metrics: Arc<Metrics>,
+    pub progress: Arc<Progress>,
+}
+
+/// Why a job failed.
+pub enum JobError {
+    /// The output can not be resumed with the options of the run
+    Invalid(String),
+    /// Reading, parsing or writing the file failed
+    Failed(String),
+}
+
+impl From<String> for JobError {
+    fn from(e: String) -> JobError {
+        JobError::Failed(e)
+    }
+}
+
+impl fmt::Display for JobError {
+    fn fmt(&self, f: &mut fmt::Formatter) -> fmt::Result {
+        match self {
+            JobError::Invalid(e) | JobError::Failed(e) => f.write_str(e),
+        }
+    }
+}
+
+/// Logs a message at a level, such as `info`, from any thread.
+pub type Log<'a> = &'a (dyn Fn(&str, String) + Sync);
+
+/// Work for the parsing pool: a whole message, or a byte range of a mapped file.
+enum Work {
+    Message(IndexedMessage),
+    Range {
+        range: usize,
+        data: Arc<Mmap>,
+        bounds: Range<usize>,
+    },
+}
+
+/// Work of one file, the queue of the writer of that file, its metrics, the
+/// budget its messages are charged to and its progress, which holds its error.
+struct Task {
+    work: Work,
+    tx_dataframes: Sender<IndexedDataFrame>,
+    metrics: Arc<Metrics>,
+    budget: Arc<Budget>,
+    progress: Arc<Progress>,
+}
+
+/// Processes every job and calls `on_done` with the index and the result of
+/// each job, on the calling thread, as soon as its output is written. With
+/// `write_stats`, the metrics of every job are saved in its output directory,
+/// and with `cache_schema` every job caches the schema of its input.
+/// The messages of every job are charged to `budget`, and `log` reports the
+/// outputs that are skipped or resumed.
+#[allow(clippy::too_many_arguments)]
+pub fn run_batch<F>(
+    jobs: &[BatchJob],
+    memory_map: bool,
+    resume: bool,
+    write_stats: bool,
+    cache_schema: bool,
+    fid_types: Arc<FidTypes>,
+    filter: Arc<Filter>,
+    options: WriterOptions,
+    budget: Arc<Budget>,
+    log: Log,
+    mut on_done: F,
+) where
+    F: FnMut(usize, Result<(), JobError>),
+{
+    let num_cpus: usize = available_parallelism().map(|n| n.get()).unwrap_or(1);
+    let num_readers = jobs.len().min(num_cpus.div_ceil(CPUS_PER_OPEN_FILE));
+    log("debug", format!("Using {} CPUs", num_cpus));
+
+    let (tx_tasks, rx_tasks) = bounded::<Task>(2 * num_cpus);
+    let (tx_done, rx_done) = unbounded::<(usize, Result<(), JobError>)>();
+    let next_job = AtomicUsize::new(0);
+
+    thread::scope(|s| {
+        for _ in 0..num_cpus {
+            let rx_tasks = rx_tasks.clone();
+            let mut parser = Parser::with_filter(fid_types.clone(), filter.clone());
+            s.spawn(move || {
+                // Process tasks until every reader is done
+                while let Ok(task) = rx_tasks.recv() {
+                    parse_task(&mut parser, task);
+                }
+            });
+        }
+        drop(rx_tasks);
+
+        for _ in 0..num_readers {
+            let (tx_tasks, tx_done) = (tx_tasks.clone(), tx_done.clone());
+            let (next_job, fid_types, filter, options, budget) =
+                (&next_job, &fid_types, &filter, &options, &budget);
+            s.spawn(move || loop {
+                let i = next_job.fetch_add(1, Ordering::Relaxed);
+                let Some(job) = jobs.get(i) else {
+                    return;
+                };
+                let result = process_file(
+                    job,
+                    memory_map,
+                    resume,
+                    write_stats,
+                    cache_schema,
+                    fid_types,
+                    filter,
+                    options,
+                    budget,
+                    log,
+                    &tx_tasks,
+                    2 * num_cpus,
+                );
+                if tx_done.send((i, result)).is_err() {
+                    return;
+                }
+            });
+        }
+        drop(tx_tasks);
+        drop(tx_done);
+
+        for (i, result) in rx_done.iter() {
+            on_done(i, result);
+        }
+    });
+}
+
+/// Reads one file into the parsing queue and waits for its writer to finish.
+#[allow(clippy::too_many_arguments)]
+fn process_file(
+    job: &BatchJob,
+    memory_map: bool,
+    resume: bool,
+    write_stats: bool,
+    cache_schema: bool,
+    fid_types: &Arc<FidTypes>,
+    filter: &Filter,
+    options: &WriterOptions,
+    budget: &Arc<Budget>,
+    log: Log,
+    tx_tasks: &Sender<Task>,
+    queue_size: usize,
+) -> Result<(), JobError> {
+    let mut file = File::open(&job.input)
+        .map_err(|e| format!("Failed to open file {:?}: {}", job.input, e))?;
+    let compression = input::compression(&mut file)
+        .map_err(|e| format!("Failed to read file {:?}: {}", job.input, e))?;
+    let input_size = file
+        .metadata()
+        .map_err(|e| format!("Failed to read file {:?}: {}", job.input, e))?
+        .len();
+    let manifest = Manifest::open(
+        &job.output,
+        input_size,
+        options.hive_partitioning,
+        options.format,
+        resume,
+    )
+    .map_err(JobError::Invalid)?;
+    if manifest.complete {
+        log("info", format!("{:?} is already complete", job.output));
+        return Ok(());
+    }
+    if manifest.messages > 0 {
+        log(
+            "info",
+            format!(
+                "Resuming {:?} from message {} at byte {}",
+                job.output, manifest.messages, manifest.offset
+            ),
+        );
+    }
+    let start = manifest.offset;
+    let mut options = options.clone();
+    if cache_schema {
+        let cache = SchemaCache::open(&job.input, filter)
+            .map_err(|e| format!("Failed to read the schema cache of {:?}: {}", job.input, e))?;
+        options.schema = OutputSchema::Cached(Arc::new(cache));
+    }
+    fs::create_dir_all(&job.output)
+        .map_err(|e| format!("Failed to create output directory {:?}: {}", job.output, e))?;
+
+    let (metrics, progress) = (&job.metrics, &job.progress);
+    let (tx_dataframes, rx_dataframes) = bounded::<IndexedDataFrame>(queue_size);
+    let input_end = InputEnd::default();
+    let writer = spawn_writer(
+        rx_dataframes,
+        job.output.clone(),
+        fid_types.clone(),
+        options,
+        manifest,
+        metrics.clone(),
+        progress.clone(),
+        budget.clone(),
+        input_end.clone(),
+    );
+
+    // Compressed input can not be memory-mapped, it is always decoded as a stream
+    let read = if memory_map && compression == Compression::None {
+        send_ranges(
+            file,
+            start,
+            &tx_dataframes,
+            tx_tasks,
+            metrics,
+            budget,
+            progress,
+        )
+    } else {
+        send_messages(
+            file,
+            start,
+            filter,
+            &tx_dataframes,
+            tx_tasks,
+            metrics,
+            budget,
+            progress,
+        )
+    };
+
+    if let Ok(end) = &read {
+        let _ = input_end.set(*end);
+    }
+
+    // The writer finishes once the workers have dropped their copies of the queue
+    drop(tx_dataframes);
+    let written = writer
+        .join()
+        .map_err(|_| format!("Writing thread of {:?} panicked", job.input))?;
+    read.map_err(|e| format!("Failed to read file {:?}: {}", job.input, e))?;
+    written?;
+    if let Some(e) = progress.error() {
+        return Err(format!("Failed to convert file {:?}: {}", job.input, e).into());
+    }
+    if write_stats {
+        metrics
+            .stats()
+            .save(&job.output)
+            .map_err(|e| format!("Failed to save the stats of {:?}: {}", job.output, e))?;
+    }
+    Ok(())
+}
+
+/// Streams the messages of a file kept by `filter`, from the input byte offset
+/// `start` on, into the parsing queue, waiting for `budget` before each one.
+/// Stops once `progress` is cancelled. Returns the position after the last
+/// message sent.
+#[allow(clippy::too_many_arguments)]
+fn send_messages(
+    file: File,
+    start: usize,
+    filter: &Filter,
+    tx_dataframes: &Sender<IndexedDataFrame>,
+    tx_tasks: &Sender<Task>,
+    metrics: &Arc<Metrics>,
+    budget: &Arc<Budget>,
+    progress: &Arc<Progress>,
+) -> Result<(usize, usize), String> {
+    let mut input = Input::new(file).map_err(|e| e.to_string())?;
+    let sent = for_each_message(&mut input, start, filter, progress, metrics, |message| {
+        budget.acquire(message.content.len());
+        let sent = tx_tasks.send(Task {
+            work: Work::Message(message),
+            tx_dataframes: tx_dataframes.clone(),
+            metrics: metrics.clone(),
+            budget: budget.clone(),
+            progress: progress.clone(),
+        });
+        metrics.parsing_queue.record(tx_tasks.len());
+        sent.map_err(|_| "Parsing queue was closed".to_string())
+    })?;
+    Ok((0, sent))
+}
+
+/// Maps a file and sends its message ranges, from the input byte offset
+/// `start` on, into the parsing queue, waiting for `budget` before each one.
+/// Stops once `progress` is cancelled. Returns the position after the last
+/// range sent.
+fn send_ranges(
+    file: File,
+    start: usize,
+    tx_dataframes: &Sender<IndexedDataFrame>,
+    tx_tasks: &Sender<Task>,
+    metrics: &Arc<Metrics>,
+    budget: &Arc<Budget>,
+    progress: &Arc<Progress>,
+) -> Result<(usize, usize), String> {
+    if file.metadata().map_err(|e| e.to_string())?.len() == 0 {
+        return Ok((0, 0));
+    }
+    let mut timer = Timer::new();
+    // Safety: the input file is only read, and it must not be truncated while it is mapped
+    let data = Arc::new(unsafe { Mmap::map(&file) }.map_err(|e| e.to_string())?);
+
+    // Skip the messages already written by the run being resumed
+    let start = start.min(data.len());
+    progress.set(start as u64);
+    metrics
+        .bytes_read
+        .fetch_add((data.len() - start) as u64, Ordering::Relaxed);
+    let ranges = splitter::message_ranges(&data[start..], splitter::RANGE_SIZE);
+    let end = (ranges.len(), 0);
+    for (range, bounds) in ranges.into_iter().enumerate() {
+        // The ranges sent before a cancellation are still written whole
+        if progress.is_cancelled() {
+            break;
+        }
+        let task = Task {
+            work: Work::Range {
+                range,
+                data: data.clone(),
+                bounds: bounds.start + start..bounds.end + start,
+            },
+            tx_dataframes: tx_dataframes.clone(),
+            metrics: metrics.clone(),
+            budget: budget.clone(),
+            progress: progress.clone(),
+        };
+        timer.busy();
+        budget.acquire(splitter::RANGE_SIZE);
+        let sent = tx_tasks.send(task);
+        timer.idle();
+        metrics.parsing_queue.record(tx_tasks.len());
+        sent.map_err(|_| "Parsing queue was closed".to_string())?;
+    }
+    timer.busy();
+    timer.finish(&metrics.read);
+    Ok(end)
+}
+
+/// Parses one file on a pool of its own and sends its messages, in any order,
+/// to `tx_dataframes`. Stops early on a message that can not be parsed, or
+/// once the receiver of the messages is gone. Returns the position after the
+/// last message sent.
+pub fn parse_file(
+    path: &Path,
+    memory_map: bool,
+    fid_types: &Arc<FidTypes>,
+    filter: &Arc<Filter>,
+    tx_dataframes: Sender<IndexedDataFrame>,
+) -> Result<(usize, usize), String> {
+    let num_cpus: usize = available_parallelism().map(|n| n.get()).unwrap_or(1);
+    let mut file =
+        File::open(path).map_err(|e| format!("Failed to open file {:?}: {}", path, e))?;
+    let compression = input::compression(&mut file)
+        .map_err(|e| format!("Failed to read file {:?}: {}", path, e))?;
+
+    let (tx_tasks, rx_tasks) = bounded::<Task>(2 * num_cpus);
+    let progress = Arc::new(Progress::default());
+    let end = thread::scope(|s| {
+        for _ in 0..num_cpus {
+            let rx_tasks = rx_tasks.clone();
+            let mut parser = Parser::with_filter(fid_types.clone(), filter.clone());
+            s.spawn(move || {
+                // Once a task fails, the reader stops and the rest are dropped
+                while let Ok(task) = rx_tasks.recv() {
+                    parse_task(&mut parser, task);
+                }
+            });
+        }
+        drop(rx_tasks);
+
+        // The batches are not written, so the messages are never charged
+        let (metrics, budget) = (Arc::new(Metrics::default()), Arc::default());
+        let read = if memory_map && compression == Compression::None {
+            send_ranges(
+                file,
+                0,
+                &tx_dataframes,
+                &tx_tasks,
+                &metrics,
+                &budget,
+                &progress,
+            )
+        } else {
+            send_messages(
+                file,
+                0,
+                filter,
+                &tx_dataframes,
+                &tx_tasks,
+                &metrics,
+                &budget,
+                &progress,
+            )
+        };
+        drop(tx_tasks);
+        read.map_err(|e| format!("Failed to read file {:?}: {}", path, e))
+    })?;
+    match progress.error() {
+        Some(e) => Err(format!("Failed to parse file {:?}: {}", path, e)),
+        None => Ok(end),
+    }
+}
+
+/// Parses the messages of a task. On an error, fails the file of the task,
+/// whose later tasks are then dropped.
+///
+/// The raw message or range is charged to the budget until it is parsed, and
+/// its DataFrames from then on, until the writer has written them.
+fn parse_task(parser: &mut Parser, task: Task) {
+    let started = Instant::now();
+    // A mapped range counts in the progress once parsed, a message when it is read
+    let (raw_bytes, mapped_bytes) = match &task.work {
+        Work::Message(message) => (message.content.len(), 0),
+        Work::Range { bounds, .. } => (splitter::RANGE_SIZE, bounds.len()),
+    };
+    if !task.progress.has_failed() {
+        let parsed = parse_work(
+            parser,
+            task.work,
+            &task.tx_dataframes,
+            &task.metrics,
+            &task.budget,
+        );
+        if let Err(e) = parsed {
+            fail_writer(&task.progress, &task.tx_dataframes, e);
+        }
+    }
+    task.budget.release(raw_bytes);
+    task.progress.add(mapped_bytes as u64);
+    task.metrics.parse.add(started.elapsed(), Duration::ZERO);
+    task.metrics
+        .dataframes_queue
+        .record(task.tx_dataframes.len());
+}
+
+fn parse_work(
+    parser: &mut Parser,
+    work: Work,
+    tx_dataframes: &Sender<IndexedDataFrame>,
+    metrics: &Metrics,
+    budget: &Budget,
+) -> Result<(), String> {
+    match work {
+        Work::Message(message) => {
+            let span = message.offset..message.offset + message.content.len();
+            parse_message(
+                parser,
+                0,
+                message.index,
+                false,
+                span,
+                &message.content,
+                tx_dataframes,
+                budget,
+            )
+        }
+        Work::Range {
+            range,
+            data,
+            bounds,
+        } => {
+            let filter = parser.filter();
+            let (mut offset, end) = (bounds.start, bounds.end);
+            let mut messages = splitter::messages(&data[bounds])
+                .map(|message| {
+                    let span = offset..offset + message.len();
+                    offset = span.end;
+                    metrics.messages_read.fetch_add(1, Ordering::Relaxed);
+                    (span, message)
+                })
+                .filter(|(_, message)| filter.keeps_message(message))
+                .enumerate()
+                .peekable();
+            if messages.peek().is_none() {
+                return tx_dataframes
+                    .send(IndexedDataFrame::empty_range(range, end))
+                    .map_err(|_| WRITER_STOPPED.to_string());
+            }
+            while let Some((index, (span, message))) = messages.next() {
+                let last_in_range = messages.peek().is_none();
+                metrics.messages_parsed.fetch_add(1, Ordering::Relaxed);
+                parse_message(
+                    parser,
+                    range,
+                    index,
+                    last_in_range,
+                    span,
+                    message,
+                    tx_dataframes,
+                    budget,
+                )?;
+            }
+            Ok(())
+        }
+    }
+}
+
+#[allow(clippy::too_many_arguments)]
+fn parse_message(
+    parser: &mut Parser,
+    range: usize,
+    index: usize,
+    last_in_range: bool,
+    span: Range<usize>,
+    message: &[u8],
+    tx_dataframes: &Sender<IndexedDataFrame>,
+    budget: &Budget,
+) -> Result<(), String> {
+    let df = parser.market_by_price_at(message, span.start)?;
+    let bytes = df.estimated_size();
+    budget.charge(bytes);
+    let indexed_df = IndexedDataFrame {
+        range,
+        index,
+        last_in_range,
+        span,
+        data: df,
+    };
+    tx_dataframes.send(indexed_df).map_err(|_| {
+        // Nobody will write it
+        budget.release(bytes);
+        WRITER_STOPPED.to_string()
+    })
+}
@@ -0,0 +1,544 @@
+//! Limit order book reconstruction.
+//!
+//! Every message is reduced to the map entries the book needs, and the
+//! entries are replayed in order into one book per `TICKER`. A book keeps its
+//! price levels keyed by `MAP_ENTRY_KEY`, with the side and price taken from
+//! `ORDER_SIDE` and `ORDER_PRC` (or from the key itself, `<price>_<B|A>`, when
+//! an entry does not repeat them). After every message, or at the end of every
+//! interval that had messages, the top levels of the book are appended as one
+//! snapshot row: the best bid and ask prices with their `ACC_SIZE` and `NO_ORD`.
+
+use crate::fid_types::{parse_gmt_offset, parse_timestamp};
+use crate::progress::Progress;
+use crate::stats::{Metrics, Timer};
+use crate::tokenizer::{RecordKind, StrRecord};
+use crate::writer::{InputEnd, WriterOptions};
+use crossbeam::channel::Receiver;
+use polars::prelude::*;
+use std::cmp::Ordering;
+use std::collections::{BTreeSet, HashMap};
+use std::fs::{self, File};
+use std::io::{BufWriter, Write};
+use std::path::{Path, PathBuf};
+use std::sync::Arc;
+use std::thread;
+use std::time::{Duration, Instant};
+
+/// Snapshot rows written to every part file.
+const BATCH_SIZE: usize = 16384;
+
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum Side {
+    Bid,
+    Ask,
+}
+
+impl Side {
+    fn from_value(value: &str) -> Option<Side> {
+        match value.trim() {
+            "BID" | "1" => Some(Side::Bid),
+            "ASK" | "2" => Some(Side::Ask),
+            _ => None,
+        }
+    }
+
+    /// Side of a `<price>_<B|A>` map entry key.
+    fn from_key(key: &str) -> Option<Side> {
+        match key.rsplit_once('_')?.1 {
+            "B" => Some(Side::Bid),
+            "A" => Some(Side::Ask),
+            _ => None,
+        }
+    }
+}
+
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum Action {
+    Add,
+    Update,
+    Delete,
+}
+
+impl Action {
+    fn from_value(value: &str) -> Option<Action> {
+        let value = value.trim();
+        if value.eq_ignore_ascii_case("ADD") {
+            Some(Action::Add)
+        } else if value.eq_ignore_ascii_case("UPDATE") {
+            Some(Action::Update)
+        } else if value.eq_ignore_ascii_case("DELETE") {
+            Some(Action::Delete)
+        } else {
+            None
+        }
+    }
+}
+
+/// A map entry of a message, with only the FIDs the book needs.
+#[derive(Debug)]
+pub struct Entry {
+    action: Option<Action>,
+    key: String,
+    side: Option<Side>,
+    price: Option<f64>,
+    size: Option<i64>,
+    orders: Option<i64>,
+}
+
+/// A message reduced to what the book needs.
+#[derive(Debug, Default)]
+pub struct BookMessage {
+    ticker: String,
+    timestamp: Option<i64>,
+    refresh: bool,
+    /// Message sequence number of the header, shared by the parts of a refresh
+    sequence: Option<u64>,
+    entries: Vec<Entry>,
+}
+
+fn parse_number<T: std::str::FromStr>(value: &str) -> Option<T> {
+    value.trim().parse().ok()
+}
+
+/// Reduces a `Market By Price` message to its header and map entries.
+pub fn parse_message(message: &str) -> BookMessage {
+    let mut book_message = BookMessage::default();
+    let mut in_summary: bool = false;
+
+    for line in message.lines() {
+        let record = StrRecord::new(line);
+        match record.kind() {
+            RecordKind::Header => {
+                book_message.ticker = record.get(0).unwrap_or_default().to_string();
+                let gmt_offset = record.get(3).and_then(parse_gmt_offset).unwrap_or(0);
+                book_message.timestamp = record
+                    .get(2)
+                    .and_then(parse_timestamp)
+                    .map(|timestamp| timestamp + gmt_offset);
+                book_message.refresh = record.get(5) == Some("REFRESH");
+                book_message.sequence = record.get(12).and_then(parse_number);
+            }
+            RecordKind::Summary => {
+                in_summary = true;
+            }
+            RecordKind::MapEntry => {
+                in_summary = false;
+                book_message.entries.push(Entry {
+                    action: record.get(6).and_then(Action::from_value),
+                    key: record.get(12).unwrap_or_default().to_string(),
+                    side: None,
+                    price: None,
+                    size: None,
+                    orders: None,
+                });
+            }
+            RecordKind::Fid if !in_summary => {
+                let (Some(entry), Some((name, value))) =
+                    (book_message.entries.last_mut(), record.fid())
+                else {
+                    continue;
+                };
+                match name {
+                    "ORDER_PRC" => entry.price = parse_number(value),
+                    "ORDER_SIDE" => entry.side = Side::from_value(value),
+                    "ACC_SIZE" => entry.size = parse_number(value),
+                    "NO_ORD" => entry.orders = parse_number(value),
+                    _ => {}
+                }
+            }
+            _ => {}
+        }
+    }
+    book_message
+}
+
+/// Price with a total order, so it can be used as a key.
+#[derive(Clone, Copy, Debug)]
+struct Price(f64);
+
+impl PartialEq for Price {
+    fn eq(&self, other: &Price) -> bool {
+        self.cmp(other) == Ordering::Equal
+    }
+}
+
+impl Eq for Price {}
+
+impl PartialOrd for Price {
+    fn partial_cmp(&self, other: &Price) -> Option<Ordering> {
+        Some(self.cmp(other))
+    }
+}
+
+impl Ord for Price {
+    fn cmp(&self, other: &Price) -> Ordering {
+        self.0.total_cmp(&other.0)
+    }
+}
+
+#[derive(Clone, Copy, Debug)]
+struct Level {
+    side: Side,
+    price: Price,
+    size: Option<i64>,
+    orders: Option<i64>,
+}
+
+/// Price levels of one ticker.
+#[derive(Default)]
+struct Book {
+    levels: HashMap<String, Level>,
+    bids: BTreeSet<(Price, String)>,
+    asks: BTreeSet<(Price, String)>,
+    /// Sequence number of the refresh last applied, while no update followed it
+    refresh_sequence: Option<u64>,
+    /// Interval of the last message, when resampling
+    interval: Option<i64>,
+}
+
+impl Book {
+    fn side(&mut self, side: Side) -> &mut BTreeSet<(Price, String)> {
+        match side {
+            Side::Bid => &mut self.bids,
+            Side::Ask => &mut self.asks,
+        }
+    }
+
+    fn remove(&mut self, key: &str) -> Option<Level> {
+        let level = self.levels.remove(key)?;
+        self.side(level.side)
+            .remove(&(level.price, key.to_string()));
+        Some(level)
+    }
+
+    fn apply(&mut self, entry: &Entry) {
+        let previous = self.remove(&entry.key);
+        if entry.action == Some(Action::Delete) {
+            return;
+        }
+        // Entries may only carry the FIDs that changed
+        let side = entry
+            .side
+            .or(previous.map(|level| level.side))
+            .or_else(|| Side::from_key(&entry.key));
+        let price = entry
+            .price
+            .map(Price)
+            .or(previous.map(|level| level.price))
+            .or_else(|| parse_number(entry.key.rsplit_once('_')?.0).map(Price));
+        let (Some(side), Some(price)) = (side, price) else {
+            return;
+        };
+        let level = Level {
+            side,
+            price,
+            size: entry.size.or(previous.and_then(|level| level.size)),
+            orders: entry.orders.or(previous.and_then(|level| level.orders)),
+        };
+        self.side(side).insert((price, entry.key.clone()));
+        self.levels.insert(entry.key.clone(), level);
+    }
+
+    fn clear(&mut self) {
+        self.levels.clear();
+        self.bids.clear();
+        self.asks.clear();
+    }
+}
+
+/// Columns of the snapshot rows of one side, one vector per level.
+struct SideColumns {
+    prices: Vec<Vec<Option<f64>>>,
+    sizes: Vec<Vec<Option<i64>>>,
+    orders: Vec<Vec<Option<i64>>>,
+}
+
+impl SideColumns {
+    fn new(depth: usize) -> SideColumns {
+        SideColumns {
+            prices: vec![Vec::new(); depth],
+            sizes: vec![Vec::new(); depth],
+            orders: vec![Vec::new(); depth],
+        }
+    }
+
+    fn push<'a>(&mut self, levels: impl Iterator<Item = &'a Level>) {
+        let mut levels = levels.fuse();
+        for depth in 0..self.prices.len() {
+            let level = levels.next();
+            self.prices[depth].push(level.map(|level| level.price.0));
+            self.sizes[depth].push(level.and_then(|level| level.size));
+            self.orders[depth].push(level.and_then(|level| level.orders));
+        }
+    }
+
+    fn take_columns(&mut self, prefix: &str, columns: &mut Vec<Column>) {
+        for depth in 0..self.prices.len() {
+            let level = depth + 1;
+            columns.push(
+                Series::new(
+                    format!("{}_PRICE_{}", prefix, level).into(),
+                    std::mem::take(&mut self.prices[depth]),
+                )
+                .into_column(),
+            );
+            columns.push(
+                Series::new(
+                    format!("{}_SIZE_{}", prefix, level).into(),
+                    std::mem::take(&mut self.sizes[depth]),
+                )
+                .into_column(),
+            );
+            columns.push(
+                Series::new(
+                    format!("{}_ORDERS_{}", prefix, level).into(),
+                    std::mem::take(&mut self.orders[depth]),
+                )
+                .into_column(),
+            );
+        }
+    }
+}
+
+/// Books of every ticker and the snapshot rows taken from them.
+pub struct Books {
+    depth: usize,
+    interval: Option<i64>,
+    books: HashMap<String, Book>,
+    tickers: Vec<String>,
+    timestamps: Vec<Option<i64>>,
+    bids: SideColumns,
+    asks: SideColumns,
+}
+
+impl Books {
+    /// Books that take a snapshot of `depth` levels after every message, or at
+    /// the end of every `interval` nanoseconds with messages.
+    pub fn new(depth: usize, interval: Option<i64>) -> Books {
+        Books {
+            depth,
+            interval,
+            books: HashMap::new(),
+            tickers: Vec::new(),
+            timestamps: Vec::new(),
+            bids: SideColumns::new(depth),
+            asks: SideColumns::new(depth),
+        }
+    }
+
+    /// Number of snapshot rows taken and not yet collected.
+    pub fn len(&self) -> usize {
+        self.tickers.len()
+    }
+
+    pub fn is_empty(&self) -> bool {
+        self.tickers.is_empty()
+    }
+
+    fn snapshot(&mut self, ticker: &str, timestamp: Option<i64>) {
+        let book = &self.books[ticker];
+        self.tickers.push(ticker.to_string());
+        self.timestamps.push(timestamp);
+        // Best bids are the highest prices, best asks the lowest
+        self.bids
+            .push(book.bids.iter().rev().map(|(_, key)| &book.levels[key]));
+        self.asks
+            .push(book.asks.iter().map(|(_, key)| &book.levels[key]));
+    }
+
+    pub fn apply(&mut self, message: &BookMessage) {
+        let ticker = message.ticker.as_str();
+        let book = self.books.entry(ticker.to_string()).or_default();
+
+        // A resampled snapshot is taken once the interval of the book is over
+        let interval = match (self.interval, message.timestamp) {
+            (Some(interval), Some(timestamp)) => Some(timestamp.div_euclid(interval)),
+            _ => book.interval,
+        };
+        let closed = match (book.interval, interval) {
+            (Some(previous), Some(current)) if current > previous => Some(previous),
+            _ => None,
+        };
+        book.interval = interval;
+
+        if let (Some(previous), Some(interval)) = (closed, self.interval) {
+            // The book as it was at the end of its last interval
+            self.snapshot(ticker, Some((previous + 1) * interval));
+        }
+
+        let book = self.books.get_mut(ticker).unwrap();
+        // The parts of a refresh share its sequence number, the book is rebuilt from the first one
+        let continues = message.sequence.is_some() && book.refresh_sequence == message.sequence;
+        if message.refresh && !continues {
+            book.clear();
+        }
+        book.refresh_sequence = message.sequence.filter(|_| message.refresh);
+        for entry in &message.entries {
+            book.apply(entry);
+        }
+        if self.interval.is_none() {
+            self.snapshot(ticker, message.timestamp);
+        }
+    }
+
+    /// Takes the snapshots of the intervals that are still open, once every message is applied.
+    pub fn finish(&mut self) {
+        let Some(interval) = self.interval else {
+            return;
+        };
+        let mut open: Vec<(i64, String)> = self
+            .books
+            .iter_mut()
+            .filter_map(|(ticker, book)| Some((book.interval.take()?, ticker.clone())))
+            .collect();
+        open.sort();
+        for (previous, ticker) in open {
+            self.snapshot(&ticker, Some((previous + 1) * interval));
+        }
+    }
+
+    /// Collects the snapshot rows taken so far into a DataFrame.
+    pub fn take_frame(&mut self) -> PolarsResult<DataFrame> {
+        let mut columns: Vec<Column> = Vec::with_capacity(2 + 6 * self.depth);
+        columns.push(Series::new("TICKER".into(), std::mem::take(&mut self.tickers)).into_column());
+        columns.push(
+            Int64Chunked::from_iter_options(
+                "TIMESTAMP".into(),
+                std::mem::take(&mut self.timestamps).into_iter(),
+            )
+            .into_datetime(TimeUnit::Nanoseconds, None)
+            .into_column(),
+        );
+        self.bids.take_columns("BID", &mut columns);
+        self.asks.take_columns("ASK", &mut columns);
+        DataFrame::new(columns)
+    }
+}
+
+/// Parses an interval such as `500ms`, `1s`, `5m` or `1h` into nanoseconds.
+pub fn parse_interval(interval: &str) -> Result<i64, String> {
+    let interval = interval.trim();
+    let split = interval
+        .find(|c: char| !c.is_ascii_digit())
+        .unwrap_or(interval.len());
+    let (amount, unit) = interval.split_at(split);
+    let nanoseconds: i64 = match unit {
+        "ns" => 1,
+        "us" => 1_000,
+        "ms" => 1_000_000,
+        "s" => 1_000_000_000,
+        "m" => 60_000_000_000,
+        "h" => 3_600_000_000_000,
+        "d" => 86_400_000_000_000,
+        _ => {
+            return Err(format!(
+                "Unknown unit {:?} in interval {:?}",
+                unit, interval
+            ))
+        }
+    };
+    match amount.parse::<i64>() {
+        Ok(amount) if amount > 0 => amount
+            .checked_mul(nanoseconds)
+            .ok_or_else(|| format!("Interval {:?} is too large", interval)),
+        _ => Err(format!("Interval {:?} must be a positive amount", interval)),
+    }
+}
+
+/// A parsed message and its position in the input.
+pub struct IndexedBookMessage {
+    pub index: usize,
+    pub message: BookMessage,
+}
+
+fn write_snapshots(
+    output_path: &Path,
+    batch_counter: usize,
+    books: &mut Books,
+    options: &WriterOptions,
+    metrics: &Metrics,
+) {
+    let file = format!("part-{:06}.parquet", batch_counter);
+    let file_path = output_path.join(&file);
+    let mut df = books.take_frame().expect("Failed to build snapshots");
+    let started = Instant::now();
+    let mut writer = BufWriter::new(File::create(&file_path).expect("Failed to create batch file"));
+    options
+        .parquet_writer(&mut writer)
+        .finish(&mut df)
+        .expect("Failed to write batch");
+    writer.flush().expect("Failed to write batch");
+    metrics.encode.add(started.elapsed(), Duration::ZERO);
+    metrics.part(&file, &file_path, df.height());
+}
+
+/// Spawns the thread that replays the parsed messages in order and writes the snapshots.
+///
+/// The thread fails if a message before `input_end` never arrived, unless the
+/// run was cancelled or failed on its own.
+#[allow(clippy::too_many_arguments)]
+pub fn spawn_book_writer(
+    rx_messages: Receiver<IndexedBookMessage>,
+    output_path: PathBuf,
+    depth: usize,
+    interval: Option<i64>,
+    options: WriterOptions,
+    metrics: Arc<Metrics>,
+    progress: Arc<Progress>,
+    input_end: InputEnd,
+) -> thread::JoinHandle<Result<(), String>> {
+    thread::spawn(move || {
+        let mut timer = Timer::new();
+        let mut books = Books::new(depth, interval);
+        let mut next_to_apply: usize = 0;
+        let mut messages_map: HashMap<usize, BookMessage> = HashMap::new();
+        let mut batch_counter: usize = 0;
+
+        // Ensure the output directory exists
+        fs::create_dir_all(&output_path).expect("Failed to create output directory");
+
+        timer.busy();
+        while let Ok(indexed_message) = rx_messages.recv() {
+            timer.idle();
+            messages_map.insert(indexed_message.index, indexed_message.message);
+            if progress.has_failed() {
+                // The message they wait for will never arrive
+                messages_map.clear();
+            }
+            metrics.reorder_buffer.record(messages_map.len());
+            while let Some(message) = messages_map.remove(&next_to_apply) {
+                books.apply(&message);
+                next_to_apply += 1;
+            }
+            if books.len() >= BATCH_SIZE {
+                write_snapshots(&output_path, batch_counter, &mut books, &options, &metrics);
+                batch_counter += 1;
+            }
+            timer.busy();
+        }
+
+        // Final flush
+        while let Some(message) = messages_map.remove(&next_to_apply) {
+            books.apply(&message);
+            next_to_apply += 1;
+        }
+        books.finish();
+        if !books.is_empty() {
+            write_snapshots(&output_path, batch_counter, &mut books, &options, &metrics);
+        }
+        timer.busy();
+        timer.finish(&metrics.write);
+        // A message that never arrived leaves later ones waiting, or the replay short of the end
+        let missing = !messages_map.is_empty() || input_end.get() != Some(&(0, next_to_apply));
+        if missing && !progress.is_cancelled() {
+            return Err(format!(
+                "The books of {:?} are incomplete: message {} was never received, and {} later \
+                 messages were left waiting for it",
+                output_path,
+                next_to_apply,
+                messages_map.len()
+            ));
+        }
+        Ok(())
+    })
+}
@@ -0,0 +1,128 @@
+//! Memory budget of a run, in estimated bytes.
+//!
+//! The queues of the pipeline are bounded in messages, which does not bound
+//! their memory when a few messages, such as large refreshes, are huge. A
+//! `Budget` accounts the bytes held by the messages from the moment they are
+//! read until their part is encoded: the raw message while it waits to be
+//! parsed, then the estimated size of its DataFrame in the queues, the reorder
+//! buffer and the batch of its part.
+//!
+//! Only the readers wait for the budget, before they take a new message or
+//! range. Every later stage charges it without waiting, so the messages
+//! already read can always reach the writer, and the writer flushes its
+//! batches early while the budget is exhausted. The memory held stays close
+//! to the limit whatever the message mix, overshooting it by at most the
+//! messages being parsed and the parts being encoded.
+
+use std::sync::{Condvar, Mutex};
+
+/// Bytes held by the messages of a run, waited on by its readers.
+pub struct Budget {
+    limit: Option<usize>,
+    used: Mutex<usize>,
+    released: Condvar,
+}
+
+impl Budget {
+    /// A budget of `limit` bytes, or one that never waits.
+    pub fn new(limit: Option<usize>) -> Budget {
+        Budget {
+            limit,
+            used: Mutex::new(0),
+            released: Condvar::new(),
+        }
+    }
+
+    pub fn unlimited() -> Budget {
+        Budget::new(None)
+    }
+
+    pub fn limit(&self) -> Option<usize> {
+        self.limit
+    }
+
+    /// Charges `bytes`, waiting until they fit in the budget. A charge larger
+    /// than the whole budget goes through once nothing else is charged.
+    pub fn acquire(&self, bytes: usize) {
+        let Some(limit) = self.limit else {
+            return;
+        };
+        let mut used = self.used.lock().unwrap();
+        while *used > 0 && *used + bytes > limit {
+            used = self.released.wait(used).unwrap();
+        }
+        *used += bytes;
+    }
+
+    /// Charges `bytes` without waiting.
+    pub fn charge(&self, bytes: usize) {
+        if self.limit.is_some() {
+            *self.used.lock().unwrap() += bytes;
+        }
+    }
+
+    pub fn release(&self, bytes: usize) {
+        if self.limit.is_some() && bytes > 0 {
+            let mut used = self.used.lock().unwrap();
+            *used = used.saturating_sub(bytes);
+            self.released.notify_all();
+        }
+    }
+
+    /// Whether the readers have to wait for memory to be released.
+    pub fn is_exhausted(&self) -> bool {
+        self.limit
+            .is_some_and(|limit| *self.used.lock().unwrap() >= limit)
+    }
+}
+
+impl Default for Budget {
+    fn default() -> Budget {
+        Budget::unlimited()
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::sync::Arc;
+    use std::thread;
+    use std::time::Duration;
+
+    #[test]
+    fn waits_until_the_bytes_fit() {
+        let budget = Arc::new(Budget::new(Some(100)));
+        budget.acquire(80);
+        assert!(!budget.is_exhausted());
+        budget.charge(30);
+        assert!(budget.is_exhausted());
+
+        let waiting = {
+            let budget = budget.clone();
+            thread::spawn(move || budget.acquire(50))
+        };
+        thread::sleep(Duration::from_millis(50));
+        assert!(!waiting.is_finished());
+        budget.release(80);
+        waiting.join().unwrap();
+        assert_eq!(*budget.used.lock().unwrap(), 80);
+    }
+
+    #[test]
+    fn lets_a_large_charge_through_when_empty() {
+        let budget = Budget::new(Some(10));
+        budget.acquire(1000);
+        assert_eq!(*budget.used.lock().unwrap(), 1000);
+        budget.release(1000);
+        assert_eq!(*budget.used.lock().unwrap(), 0);
+    }
+
+    #[test]
+    fn unlimited_never_charges() {
+        let budget = Budget::unlimited();
+        budget.acquire(usize::MAX);
+        budget.charge(10);
+        assert_eq!(*budget.used.lock().unwrap(), 0);
+        assert!(!budget.is_exhausted());
+    }
+}
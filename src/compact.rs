@@ -0,0 +1,407 @@
+//! Compaction of the part files of a finished output.
+//!
+//! A run writes its parts in arrival order, with sizes that follow the
+//! batching of the messages, so the `TICKER` and `TIMESTAMP` statistics of
+//! their row groups rarely let a reader skip any. Compaction rewrites the parts
+//! of every partition into files of a target size, sorted by `TICKER` and then
+//! `TIMESTAMP`, with row groups small enough to be pruned.
+//!
+//! The sort is an external merge sort that holds about `memory_limit` bytes of
+//! rows at a time. The parts are read in input order into runs of half the
+//! limit, which are sorted and spilled to temporary files, and the runs are
+//! then merged by reading a chunk of each: every round takes the rows of every
+//! chunk up to the smallest of their last keys, which are the next rows of the
+//! merged order, sorts them and appends them to the output. Rows with the same
+//! key keep their input order. A partition that fits in one run is sorted in
+//! memory without spilling.
+//!
+//! The compacted output is written to a sibling directory, with its manifest
+//! and the other files of the output, and swapped with the original by two
+//! renames, so a reader sees either every original part or every compacted one.
+
+use crate::manifest::{checksum, Manifest, Part};
+use crate::writer::WriterOptions;
+use polars::prelude::*;
+use std::cmp::Ordering;
+use std::collections::BTreeMap;
+use std::fs::{self, File};
+use std::io::BufWriter;
+use std::path::{Path, PathBuf};
+
+/// Default bytes of rows held at a time.
+pub const DEFAULT_COMPACT_MEMORY: usize = 1024 * 1024 * 1024;
+/// Default rows of the row groups of the compacted parts.
+pub const DEFAULT_COMPACT_ROW_GROUP_SIZE: usize = 65536;
+/// Columns the parts are sorted by, the ones the output has.
+const SORT_COLUMNS: [&str; 2] = ["TICKER", "TIMESTAMP"];
+/// Rows of the row groups of the sorted runs, the unit they are read back in.
+const RUN_ROW_GROUP_SIZE: usize = 16384;
+
+/// Options of a compaction.
+pub struct CompactOptions {
+    /// Estimated in-memory bytes of the rows of every compacted part
+    pub part_size: usize,
+    /// Estimated bytes of rows held at a time by the sort
+    pub memory_limit: usize,
+    /// Parquet options of the compacted parts
+    pub writer: WriterOptions,
+}
+
+/// Compacts the parts listed in `manifest` of the output at `output_path`,
+/// once it is `recover`ed, and returns the number of compacted parts.
+pub fn compact(
+    output_path: &Path,
+    manifest: &Manifest,
+    options: &CompactOptions,
+) -> Result<usize, String> {
+    let tmp_path = sibling(output_path, "compact.tmp")?;
+    let old_path = sibling(output_path, "compact.old")?;
+    fs::create_dir_all(&tmp_path).map_err(|e| io_error("create", &tmp_path, e))?;
+
+    let mut partitions: BTreeMap<PathBuf, Vec<PathBuf>> = BTreeMap::new();
+    for part in &manifest.parts {
+        partitions
+            .entry(part.partition())
+            .or_default()
+            .push(output_path.join(&part.file));
+    }
+    let mut parts: Vec<Part> = Vec::new();
+    for (key, files) in &partitions {
+        let mut output = Output::new(&tmp_path, key, manifest, options)?;
+        sort_partition(files, &tmp_path.join("_runs"), &mut output, options)
+            .map_err(|e| format!("Failed to compact {:?}: {}", output_path.join(key), e))?;
+        parts.extend(output.finish()?);
+    }
+    let runs_path = tmp_path.join("_runs");
+    if runs_path.exists() {
+        fs::remove_dir_all(&runs_path).map_err(|e| io_error("remove", &runs_path, e))?;
+    }
+
+    // The other files of the output, such as its stats, are kept
+    for entry in fs::read_dir(output_path).map_err(|e| io_error("list", output_path, e))? {
+        let path = entry.map_err(|e| io_error("list", output_path, e))?.path();
+        let name = path.file_name().unwrap_or_default().to_string_lossy();
+        if path.is_file() && !name.starts_with("part-") && name != crate::manifest::MANIFEST_FILE {
+            fs::copy(&path, tmp_path.join(path.file_name().unwrap_or_default()))
+                .map_err(|e| io_error("copy", &path, e))?;
+        }
+    }
+    let count = parts.len();
+    let compacted = Manifest {
+        parts,
+        compacted: true,
+        ..manifest.clone()
+    };
+    compacted
+        .save(&tmp_path)
+        .map_err(|e| io_error("save the manifest of", &tmp_path, e))?;
+
+    fs::rename(output_path, &old_path).map_err(|e| io_error("move", output_path, e))?;
+    fs::rename(&tmp_path, output_path).map_err(|e| io_error("move", &tmp_path, e))?;
+    fs::remove_dir_all(&old_path).map_err(|e| io_error("remove", &old_path, e))?;
+    Ok(count)
+}
+
+/// Cleans up after an interrupted compaction, which may have moved the
+/// original output away before moving the compacted one in.
+pub fn recover(output_path: &Path) -> Result<(), String> {
+    let tmp_path = sibling(output_path, "compact.tmp")?;
+    let old_path = sibling(output_path, "compact.old")?;
+    if old_path.exists() && !output_path.exists() {
+        fs::rename(&old_path, output_path).map_err(|e| io_error("restore", &old_path, e))?;
+    }
+    for path in [&tmp_path, &old_path] {
+        if path.exists() {
+            fs::remove_dir_all(path).map_err(|e| io_error("remove", path, e))?;
+        }
+    }
+    Ok(())
+}
+
+fn io_error(action: &str, path: &Path, e: impl std::fmt::Display) -> String {
+    format!("Failed to {} {:?}: {}", action, path, e)
+}
+
+/// Directory next to `path`, named after it with `suffix`.
+fn sibling(path: &Path, suffix: &str) -> Result<PathBuf, String> {
+    let name = path
+        .file_name()
+        .ok_or_else(|| format!("{:?} is not an output directory", path))?;
+    Ok(path.with_file_name(format!("{}.{}", name.to_string_lossy(), suffix)))
+}
+
+/// Value of a sort column, ordered as Polars sorts it.
+#[derive(Clone, Debug, PartialEq, Eq, PartialOrd, Ord)]
+enum KeyValue {
+    Int(i64),
+    Str(String),
+}
+
+/// Sort key of a row, nulls first.
+type Key = Vec<Option<KeyValue>>;
+
+fn row_key(df: &DataFrame, keys: &[&str], row: usize) -> PolarsResult<Key> {
+    keys.iter()
+        .map(|name| {
+            Ok(match df.column(name)?.get(row)? {
+                AnyValue::Null => None,
+                AnyValue::Datetime(value, _, _) | AnyValue::Int64(value) => {
+                    Some(KeyValue::Int(value))
+                }
+                value => value
+                    .get_str()
+                    .map(|value| KeyValue::Str(value.to_string())),
+            })
+        })
+        .collect()
+}
+
+/// Rows at the start of the sorted `df` whose key is before `bound`, or equal
+/// to it if `inclusive`.
+fn rows_up_to(df: &DataFrame, keys: &[&str], bound: &Key, inclusive: bool) -> PolarsResult<usize> {
+    let (mut low, mut high) = (0, df.height());
+    while low < high {
+        let middle = low + (high - low) / 2;
+        let before = match row_key(df, keys, middle)?.cmp(bound) {
+            Ordering::Less => true,
+            Ordering::Equal => inclusive,
+            Ordering::Greater => false,
+        };
+        if before {
+            low = middle + 1;
+        } else {
+            high = middle;
+        }
+    }
+    Ok(low)
+}
+
+fn sort_rows(df: DataFrame, keys: &[&str]) -> PolarsResult<DataFrame> {
+    if keys.is_empty() {
+        return Ok(df);
+    }
+    df.sort(
+        keys.to_vec(),
+        SortMultipleOptions::default().with_maintain_order(true),
+    )
+}
+
+fn concat(dfs: Vec<DataFrame>) -> PolarsResult<DataFrame> {
+    let mut dfs = dfs.into_iter();
+    let mut concatenated = dfs.next().unwrap_or_default();
+    for df in dfs {
+        concatenated.vstack_mut(&df)?;
+    }
+    Ok(concatenated)
+}
+
+/// A sorted run spilled to disk, read back a chunk at a time.
+struct Run {
+    path: PathBuf,
+    rows: usize,
+    /// Rows of the run read so far
+    read: usize,
+    chunk: DataFrame,
+}
+
+impl Run {
+    /// Reads the next `chunk_rows` rows if the chunk is empty. Returns whether
+    /// the run has rows left.
+    fn fill(&mut self, chunk_rows: usize) -> PolarsResult<bool> {
+        if self.chunk.height() == 0 && self.read < self.rows {
+            self.chunk = LazyFrame::scan_parquet(&self.path, ScanArgsParquet::default())?
+                .slice(self.read as i64, chunk_rows as IdxSize)
+                .collect()?;
+            self.read += self.chunk.height();
+        }
+        Ok(self.chunk.height() > 0)
+    }
+}
+
+/// Sorts the rows of the part `files` of a partition into `output`, spilling
+/// the sorted runs to `runs_path` if they do not fit in memory.
+fn sort_partition(
+    files: &[PathBuf],
+    runs_path: &Path,
+    output: &mut Output,
+    options: &CompactOptions,
+) -> PolarsResult<()> {
+    // Sorting a run holds it twice
+    let run_size = (options.memory_limit / 2).max(1);
+    let mut runs: Vec<Run> = Vec::new();
+    let mut pending: Vec<DataFrame> = Vec::new();
+    let (mut pending_size, mut total_size, mut total_rows) = (0, 0, 0);
+    let mut keys: Vec<&str> = Vec::new();
+
+    for (i, file) in files.iter().enumerate() {
+        let df = ParquetReader::new(File::open(file)?).finish()?;
+        if i == 0 {
+            keys = SORT_COLUMNS
+                .into_iter()
+                .filter(|name| df.get_column_index(name).is_some())
+                .collect();
+        }
+        pending_size += df.estimated_size();
+        pending.push(df);
+        if pending_size >= run_size {
+            runs.push(spill(
+                std::mem::take(&mut pending),
+                &keys,
+                runs_path,
+                runs.len(),
+            )?);
+            total_size += std::mem::take(&mut pending_size);
+        }
+    }
+    if runs.is_empty() {
+        return output.push(sort_rows(concat(pending)?, &keys)?);
+    }
+    if !pending.is_empty() {
+        runs.push(spill(pending, &keys, runs_path, runs.len())?);
+        total_size += pending_size;
+    }
+    for run in &runs {
+        total_rows += run.rows;
+    }
+
+    // The chunks of the runs and the rows taken from them share the other half
+    let row_size = (total_size / total_rows.max(1)).max(1);
+    let chunk_rows = (run_size / (runs.len() * row_size)).max(1);
+    loop {
+        let mut open: Vec<&mut Run> = Vec::new();
+        for run in runs.iter_mut() {
+            if run.fill(chunk_rows)? {
+                open.push(run);
+            }
+        }
+        // The first run whose chunk ends with the smallest key
+        let Some((last, bound)) = open
+            .iter()
+            .map(|run| row_key(&run.chunk, &keys, run.chunk.height() - 1))
+            .collect::<PolarsResult<Vec<Key>>>()?
+            .into_iter()
+            .enumerate()
+            .min_by(|a, b| a.1.cmp(&b.1))
+        else {
+            break;
+        };
+        // Every row before the bound is before the rows left in any run. The
+        // rows equal to it are taken up to that run, as the later runs may
+        // have more of them in their next chunk.
+        let mut taken: Vec<DataFrame> = Vec::with_capacity(open.len());
+        for (i, run) in open.into_iter().enumerate() {
+            let rows = rows_up_to(&run.chunk, &keys, &bound, i <= last)?;
+            let (head, tail) = run.chunk.split_at(rows as i64);
+            taken.push(head);
+            run.chunk = tail;
+        }
+        output.push(sort_rows(concat(taken)?, &keys)?)?;
+    }
+    for run in &runs {
+        fs::remove_file(&run.path)?;
+    }
+    Ok(())
+}
+
+/// Sorts `dfs` and writes them as run number `number` in `runs_path`.
+fn spill(dfs: Vec<DataFrame>, keys: &[&str], runs_path: &Path, number: usize) -> PolarsResult<Run> {
+    fs::create_dir_all(runs_path)?;
+    let path = runs_path.join(format!("run-{:06}.parquet", number));
+    let mut sorted = sort_rows(concat(dfs)?, keys)?;
+    ParquetWriter::new(BufWriter::new(File::create(&path)?))
+        .with_compression(ParquetCompression::Lz4Raw)
+        .with_row_group_size(Some(RUN_ROW_GROUP_SIZE))
+        .finish(&mut sorted)?;
+    Ok(Run {
+        path,
+        rows: sorted.height(),
+        read: 0,
+        chunk: DataFrame::empty(),
+    })
+}
+
+/// The compacted parts of a partition, written once their rows reach the part size.
+struct Output<'a> {
+    output_path: &'a Path,
+    key: PathBuf,
+    manifest: &'a Manifest,
+    options: &'a CompactOptions,
+    pending: Vec<DataFrame>,
+    /// Estimated in-memory size of `pending`
+    bytes: usize,
+    parts: Vec<Part>,
+}
+
+impl<'a> Output<'a> {
+    fn new(
+        output_path: &'a Path,
+        key: &Path,
+        manifest: &'a Manifest,
+        options: &'a CompactOptions,
+    ) -> Result<Output<'a>, String> {
+        let path = output_path.join(key);
+        fs::create_dir_all(&path).map_err(|e| io_error("create", &path, e))?;
+        Ok(Output {
+            output_path,
+            key: key.to_path_buf(),
+            manifest,
+            options,
+            pending: Vec::new(),
+            bytes: 0,
+            parts: Vec::new(),
+        })
+    }
+
+    /// Appends sorted rows, cutting them where a part reaches its size.
+    fn push(&mut self, mut df: DataFrame) -> PolarsResult<()> {
+        // The slices share the buffers of `df`, so their size is estimated per row
+        let row_size = (df.estimated_size() / df.height().max(1)).max(1);
+        while df.height() > 0 {
+            let room = (self.options.part_size.saturating_sub(self.bytes) / row_size).max(1);
+            let (head, tail) = df.split_at(room.min(df.height()) as i64);
+            self.bytes += head.height() * row_size;
+            self.pending.push(head);
+            if self.bytes >= self.options.part_size {
+                self.flush()?;
+            }
+            df = tail;
+        }
+        Ok(())
+    }
+
+    fn flush(&mut self) -> PolarsResult<()> {
+        let mut df = concat(std::mem::take(&mut self.pending))?;
+        self.bytes = 0;
+        df.as_single_chunk_par();
+        let file = self
+            .key
+            .join(format!("part-{:06}.parquet", self.parts.len()));
+        let path = self.output_path.join(&file);
+        self.options
+            .writer
+            .parquet_writer(BufWriter::new(File::create(&path)?))
+            .finish(&mut df)?;
+        // A compacted part holds rows of the whole input
+        self.parts.push(Part {
+            file: file.to_string_lossy().into_owned(),
+            first_message: 0,
+            last_message: self.manifest.messages.saturating_sub(1),
+            start_offset: 0,
+            end_offset: self.manifest.offset,
+            rows: df.height(),
+            columns: df.width(),
+            crc32: checksum(&path)?,
+            ipc_crc32: None,
+            message_indices: None,
+        });
+        Ok(())
+    }
+
+    fn finish(mut self) -> Result<Vec<Part>, String> {
+        if !self.pending.is_empty() {
+            self.flush()
+                .map_err(|e| io_error("write", &self.output_path.join(&self.key), e))?;
+        }
+        Ok(self.parts)
+    }
+}
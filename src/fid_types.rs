@@ -0,0 +1,223 @@
+//! Typed output columns.
+//!
+//! A FID type registry maps column names to the type they are written with.
+//! It is built on the Python side from `lobmp.definitions.fids.fid_types`, and
+//! the parser uses it to build typed columns directly from the raw values.
+//! Columns that are not in the registry stay as strings.
+
+use polars::prelude::*;
+use std::collections::HashMap;
+
+/// Type of a column in the output.
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum FidType {
+    String,
+    Int64,
+    Float64,
+    Date,
+    Time,
+    Datetime,
+    Categorical,
+}
+
+impl FidType {
+    pub fn from_name(name: &str) -> Option<FidType> {
+        match name {
+            "String" => Some(FidType::String),
+            "Int64" => Some(FidType::Int64),
+            "Float64" => Some(FidType::Float64),
+            "Date" => Some(FidType::Date),
+            "Time" => Some(FidType::Time),
+            "Datetime" => Some(FidType::Datetime),
+            "Categorical" => Some(FidType::Categorical),
+            _ => None,
+        }
+    }
+
+    pub fn dtype(&self) -> DataType {
+        match self {
+            FidType::String => DataType::String,
+            FidType::Int64 => DataType::Int64,
+            FidType::Float64 => DataType::Float64,
+            FidType::Date => DataType::Date,
+            FidType::Time => DataType::Time,
+            FidType::Datetime => DataType::Datetime(TimeUnit::Nanoseconds, None),
+            FidType::Categorical => DataType::Categorical(None, CategoricalOrdering::Physical),
+        }
+    }
+}
+
+/// Registry of the column types, keyed by column name.
+#[derive(Clone, Debug, Default)]
+pub struct FidTypes {
+    types: HashMap<String, FidType>,
+}
+
+impl FidTypes {
+    /// Builds the registry from `{name: type name}` pairs, failing on the first unknown type.
+    pub fn from_names(names: HashMap<String, String>) -> Result<FidTypes, String> {
+        let mut types = HashMap::with_capacity(names.len());
+        for (column, type_name) in names {
+            let fid_type = FidType::from_name(&type_name)
+                .ok_or_else(|| format!("Unknown type {:?} for column {:?}", type_name, column))?;
+            types.insert(column, fid_type);
+        }
+        Ok(FidTypes { types })
+    }
+
+    pub fn get(&self, column: &str) -> FidType {
+        self.types.get(column).copied().unwrap_or(FidType::String)
+    }
+
+    /// Value used to fill a column when a message does not have it.
+    pub fn fill_value(dtype: &DataType) -> Expr {
+        match dtype {
+            DataType::String => lit(""),
+            dtype => lit(NULL).cast(dtype.clone()),
+        }
+    }
+}
+
+/// Days since 1970-01-01 of a proleptic Gregorian date.
+fn days_from_civil(year: i64, month: i64, day: i64) -> i64 {
+    let year = if month <= 2 { year - 1 } else { year };
+    let era = if year >= 0 { year } else { year - 399 } / 400;
+    let year_of_era = year - era * 400;
+    let month_index = (month + 9) % 12;
+    let day_of_year = (153 * month_index + 2) / 5 + day - 1;
+    let day_of_era = year_of_era * 365 + year_of_era / 4 - year_of_era / 100 + day_of_year;
+    era * 146097 + day_of_era - 719468
+}
+
+/// Formats days since 1970-01-01 as a `YYYY-MM-DD` proleptic Gregorian date.
+pub fn format_date(days: i64) -> String {
+    let days = days + 719468;
+    let era = if days >= 0 { days } else { days - 146096 } / 146097;
+    let day_of_era = days - era * 146097;
+    let year_of_era =
+        (day_of_era - day_of_era / 1460 + day_of_era / 36524 - day_of_era / 146096) / 365;
+    let day_of_year = day_of_era - (365 * year_of_era + year_of_era / 4 - year_of_era / 100);
+    let month_index = (5 * day_of_year + 2) / 153;
+    let day = day_of_year - (153 * month_index + 2) / 5 + 1;
+    let month = if month_index < 10 {
+        month_index + 3
+    } else {
+        month_index - 9
+    };
+    let year = year_of_era + era * 400 + i64::from(month <= 2);
+    format!("{:04}-{:02}-{:02}", year, month, day)
+}
+
+fn parse_digits(value: &str) -> Option<i64> {
+    if value.is_empty() || !value.bytes().all(|b| b.is_ascii_digit()) {
+        return None;
+    }
+    value.parse().ok()
+}
+
+/// Parses `YYYY-MM-DD` into days since the epoch.
+pub fn parse_date(value: &str) -> Option<i32> {
+    let mut parts = value.splitn(3, '-');
+    let year = parse_digits(parts.next()?)?;
+    let month = parse_digits(parts.next()?)?;
+    let day = parse_digits(parts.next()?)?;
+    if !(1..=12).contains(&month) || !(1..=31).contains(&day) {
+        return None;
+    }
+    i32::try_from(days_from_civil(year, month, day)).ok()
+}
+
+/// Parses `HH:MM:SS[.fffffffff]` into nanoseconds since midnight.
+pub fn parse_time(value: &str) -> Option<i64> {
+    let (clock, fraction) = match value.split_once('.') {
+        Some((clock, fraction)) => (clock, fraction),
+        None => (value, ""),
+    };
+    let mut parts = clock.splitn(3, ':');
+    let hours = parse_digits(parts.next()?)?;
+    let minutes = parse_digits(parts.next()?)?;
+    let seconds = parse_digits(parts.next()?)?;
+    if hours > 23 || minutes > 59 || seconds > 60 || fraction.len() > 9 {
+        return None;
+    }
+    let mut nanoseconds = 0;
+    if !fraction.is_empty() {
+        nanoseconds = parse_digits(fraction)? * 10_i64.pow(9 - fraction.len() as u32);
+    }
+    Some(((hours * 60 + minutes) * 60 + seconds) * 1_000_000_000 + nanoseconds)
+}
+
+/// Parses `YYYY-MM-DDTHH:MM:SS[.fffffffff]Z` into nanoseconds since the epoch.
+pub fn parse_timestamp(value: &str) -> Option<i64> {
+    let value = value.strip_suffix('Z').unwrap_or(value);
+    let (date, time) = value.split_once('T')?;
+    let days = parse_date(date)? as i64;
+    Some(days * 86_400_000_000_000 + parse_time(time)?)
+}
+
+/// Parses a GMT offset such as `+1`, `-5` or `+5:30` into nanoseconds.
+pub fn parse_gmt_offset(value: &str) -> Option<i64> {
+    let (sign, value) = match value.as_bytes().first()? {
+        b'-' => (-1, &value[1..]),
+        b'+' => (1, &value[1..]),
+        _ => (1, value),
+    };
+    let (hours, minutes) = match value.split_once(':') {
+        Some((hours, minutes)) => (parse_digits(hours)?, parse_digits(minutes)?),
+        None => (parse_digits(value)?, 0),
+    };
+    Some(sign * (hours * 60 + minutes) * 60_000_000_000)
+}
+
+/// Builds a column of type `fid_type` from raw string values. Values that do
+/// not parse, and missing values, become nulls; string columns keep the empty
+/// string for missing values. Datetimes are shifted by `gmt_offset` nanoseconds.
+pub fn typed_column(
+    name: &str,
+    fid_type: FidType,
+    values: &[Option<&str>],
+    gmt_offset: i64,
+) -> Column {
+    let name = PlSmallStr::from_str(name);
+    let values = values.iter().copied();
+    match fid_type {
+        FidType::String => {
+            let mut builder = StringChunkedBuilder::new(name, values.len());
+            for value in values {
+                builder.append_value(value.unwrap_or_default());
+            }
+            builder.finish().into_column()
+        }
+        FidType::Int64 => {
+            Int64Chunked::from_iter_options(name, values.map(|v| v?.trim().parse().ok()))
+                .into_column()
+        }
+        FidType::Float64 => {
+            Float64Chunked::from_iter_options(name, values.map(|v| v?.trim().parse().ok()))
+                .into_column()
+        }
+        FidType::Date => Int32Chunked::from_iter_options(name, values.map(|v| parse_date(v?)))
+            .into_date()
+            .into_column(),
+        FidType::Time => Int64Chunked::from_iter_options(name, values.map(|v| parse_time(v?)))
+            .into_time()
+            .into_column(),
+        FidType::Datetime => Int64Chunked::from_iter_options(
+            name,
+            values.map(|v| Some(parse_timestamp(v?)? + gmt_offset)),
+        )
+        .into_datetime(TimeUnit::Nanoseconds, None)
+        .into_column(),
+        FidType::Categorical => {
+            let mut builder =
+                CategoricalChunkedBuilder::new(name, values.len(), CategoricalOrdering::Physical);
+            for value in values {
+                match value {
+                    Some(value) if !value.is_empty() => builder.append_value(value),
+                    _ => builder.append_null(),
+                }
+            }
+            builder.finish().into_column()
+        }
+    }
+}
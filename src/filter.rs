@@ -0,0 +1,131 @@
+//! Selection of the messages and FIDs to keep.
+//!
+//! A `Filter` rejects messages from their header line alone, by ticker and by
+//! timestamp, so the readers never buffer nor parse their body. The FID
+//! projection is applied by the parser, which drops the FID lines outside of
+//! it before their values are stored. The header columns and the map entry
+//! type and key are always kept.
+
+use crate::fid_types::parse_timestamp;
+use crate::tokenizer::Record;
+use memchr::memchr;
+use std::collections::HashSet;
+
+#[derive(Clone, Debug, Default)]
+pub struct Filter {
+    /// Tickers to keep, or every ticker
+    pub tickers: Option<HashSet<String>>,
+    /// FIDs to keep, or every FID
+    pub fids: Option<HashSet<String>>,
+    /// Keep the messages from this timestamp on, in nanoseconds since the epoch (UTC)
+    pub start: Option<i64>,
+    /// Keep the messages before this timestamp, in nanoseconds since the epoch (UTC)
+    pub end: Option<i64>,
+}
+
+impl Filter {
+    /// Builds a filter, parsing the ISO 8601 bounds of the time window.
+    pub fn new(
+        tickers: Option<Vec<String>>,
+        fids: Option<Vec<String>>,
+        start: Option<&str>,
+        end: Option<&str>,
+    ) -> Result<Filter, String> {
+        let parse = |value: &str| {
+            parse_timestamp(value).ok_or_else(|| format!("Invalid timestamp {:?}", value))
+        };
+        Ok(Filter {
+            tickers: tickers.map(|tickers| tickers.into_iter().collect()),
+            fids: fids.map(|fids| fids.into_iter().collect()),
+            start: start.map(parse).transpose()?,
+            end: end.map(parse).transpose()?,
+        })
+    }
+
+    /// Whether the messages are selected by their header.
+    fn selects_messages(&self) -> bool {
+        self.tickers.is_some() || self.start.is_some() || self.end.is_some()
+    }
+
+    /// Whether the message that starts with the header line `line` is kept.
+    /// The rest of the message may follow the header line.
+    pub fn keeps_message(&self, line: &[u8]) -> bool {
+        if !self.selects_messages() {
+            return true;
+        }
+        let line = match memchr(b'\n', line) {
+            Some(end) => &line[..end],
+            None => line,
+        };
+        let record = Record::new(line);
+        if let Some(tickers) = &self.tickers {
+            let ticker = record
+                .get(0)
+                .and_then(|ticker| std::str::from_utf8(ticker).ok());
+            if !ticker.is_some_and(|ticker| tickers.contains(ticker)) {
+                return false;
+            }
+        }
+        if self.start.is_none() && self.end.is_none() {
+            return true;
+        }
+        let timestamp = record
+            .get(2)
+            .and_then(|timestamp| std::str::from_utf8(timestamp).ok())
+            .and_then(parse_timestamp);
+        match timestamp {
+            Some(timestamp) => {
+                self.start.is_none_or(|start| timestamp >= start)
+                    && self.end.is_none_or(|end| timestamp < end)
+            }
+            None => false,
+        }
+    }
+
+    /// Whether the FID `name` is kept.
+    pub fn keeps_fid(&self, name: &str) -> bool {
+        self.fids.as_ref().is_none_or(|fids| fids.contains(name))
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    const HEADER: &[u8] =
+        b"AAA.MC,Market By Price,2020-01-11T10:00:00.000000000Z,+1,Raw,UPDATE,,,,,3240,0,\n";
+
+    #[test]
+    fn keeps_everything_by_default() {
+        let filter = Filter::default();
+        assert!(filter.keeps_message(HEADER));
+        assert!(filter.keeps_fid("ORDER_PRC"));
+    }
+
+    #[test]
+    fn selects_tickers_window_and_fids() {
+        let filter = Filter::new(
+            Some(vec!["AAA.MC".to_string()]),
+            Some(vec!["ORDER_PRC".to_string()]),
+            Some("2020-01-11T10:00:00"),
+            Some("2020-01-11T11:00:00"),
+        )
+        .unwrap();
+        assert!(filter.keeps_message(HEADER));
+        assert!(filter.keeps_message(&[HEADER, b"AAA.MC,Market By Price,,"].concat()));
+        assert!(!filter.keeps_message(
+            b"BBB.MC,Market By Price,2020-01-11T10:00:00.000000000Z,+1,Raw,UPDATE,,,,,3240,0,"
+        ));
+        assert!(!filter.keeps_message(
+            b"AAA.MC,Market By Price,2020-01-11T11:00:00.000000000Z,+1,Raw,UPDATE,,,,,3240,0,"
+        ));
+        assert!(!filter.keeps_message(b"AAA.MC,Market By Price,,+1,Raw,UPDATE,,,,,3240,0,"));
+        assert!(filter.keeps_fid("ORDER_PRC"));
+        assert!(!filter.keeps_fid("ACC_SIZE"));
+    }
+
+    #[test]
+    fn rejects_invalid_bounds() {
+        assert!(Filter::new(None, None, Some("yesterday"), None).is_err());
+    }
+}
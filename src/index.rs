@@ -0,0 +1,405 @@
+//! Sidecar index of the messages of an input file.
+//!
+//! `<input>.lobmpidx` lists every `Market By Price` message of a plain CSV
+//! file with its byte offset and length, the id of its ticker, its timestamp
+//! and whether it is a refresh, so the messages of a ticker or of a time
+//! window can be read with direct seeks instead of scanning the file again.
+//! Compressed files can not be indexed, as their offsets can not be seeked.
+//!
+//! The index is built in one parallel pass over the memory-mapped file, cut
+//! into the same ranges as a memory-mapped run. It records the size and the
+//! modification time of the input, and an index that does not match its
+//! input any more is rebuilt.
+//!
+//! The format is little-endian: the magic `LOBMPIDX`, the format version, the
+//! input size and modification time, the tickers as length-prefixed UTF-8
+//! strings, and one fixed-size entry per message, in input order.
+
+use crate::fid_types::parse_timestamp;
+use crate::filter::Filter;
+use crate::splitter;
+use crate::tokenizer::Record;
+use memchr::memchr;
+use memmap2::Mmap;
+use std::collections::HashMap;
+use std::fs::{self, File};
+use std::io::{self, BufWriter, Read, Seek, SeekFrom, Write};
+use std::path::{Path, PathBuf};
+use std::sync::atomic::{AtomicUsize, Ordering};
+use std::sync::Mutex;
+use std::thread::{self, available_parallelism};
+use std::time::UNIX_EPOCH;
+
+const MAGIC: &[u8; 8] = b"LOBMPIDX";
+const VERSION: u32 = 1;
+/// Bytes of an entry: offset, length, timestamp, ticker id, flags and padding.
+const ENTRY_SIZE: usize = 32;
+/// Stored timestamp of a message without one.
+const NO_TIMESTAMP: i64 = i64::MIN;
+const REFRESH_FLAG: u8 = 1;
+
+/// Suffix added to the name of the input file.
+pub const INDEX_SUFFIX: &str = ".lobmpidx";
+
+/// A message of the input.
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub struct Entry {
+    /// Input byte offset of the header line
+    pub offset: u64,
+    /// Bytes of the message, up to the next header line
+    pub length: u64,
+    /// Position of the ticker in `Index::tickers`
+    pub ticker: u32,
+    /// Nanoseconds since the epoch (UTC)
+    pub timestamp: Option<i64>,
+    pub refresh: bool,
+}
+
+/// The messages of an input file.
+#[derive(Clone, Debug, Default, PartialEq, Eq)]
+pub struct Index {
+    pub input_size: u64,
+    /// Modification time of the input, in nanoseconds since the epoch
+    pub input_modified: u64,
+    pub tickers: Vec<String>,
+    pub entries: Vec<Entry>,
+}
+
+/// Path of the index of `input`.
+pub fn index_path(input: &Path) -> PathBuf {
+    let mut name = input.as_os_str().to_owned();
+    name.push(INDEX_SUFFIX);
+    PathBuf::from(name)
+}
+
+/// Size and modification time of a file, as the index records them.
+pub fn signature(path: &Path) -> io::Result<(u64, u64)> {
+    let metadata = fs::metadata(path)?;
+    let modified = metadata
+        .modified()?
+        .duration_since(UNIX_EPOCH)
+        .map(|elapsed| elapsed.as_nanos() as u64)
+        .unwrap_or(0);
+    Ok((metadata.len(), modified))
+}
+
+/// Messages of a range, with tickers numbered in the order the range found them.
+#[derive(Default)]
+struct RangeEntries {
+    tickers: Vec<String>,
+    entries: Vec<Entry>,
+}
+
+fn index_range(data: &[u8], range: std::ops::Range<usize>) -> RangeEntries {
+    let mut indexed = RangeEntries::default();
+    let mut ids: HashMap<&[u8], u32> = HashMap::new();
+    let mut offset = range.start;
+    for message in splitter::messages(&data[range]) {
+        let header = match memchr(b'\n', message) {
+            Some(end) => &message[..end],
+            None => message,
+        };
+        let record = Record::new(header);
+        let ticker = record.get(0).unwrap_or_default();
+        let ticker = *ids.entry(ticker).or_insert_with(|| {
+            indexed
+                .tickers
+                .push(String::from_utf8_lossy(ticker).into_owned());
+            indexed.tickers.len() as u32 - 1
+        });
+        let timestamp = record
+            .get(2)
+            .and_then(|timestamp| std::str::from_utf8(timestamp).ok())
+            .and_then(parse_timestamp);
+        indexed.entries.push(Entry {
+            offset: offset as u64,
+            length: message.len() as u64,
+            ticker,
+            timestamp,
+            refresh: record.get(5) == Some(b"REFRESH".as_slice()),
+        });
+        offset += message.len();
+    }
+    indexed
+}
+
+impl Index {
+    /// Indexes the messages of `data` on every core.
+    pub fn build(data: &[u8]) -> Index {
+        let ranges = splitter::message_ranges(data, splitter::RANGE_SIZE);
+        let num_cpus: usize = available_parallelism().map(|n| n.get()).unwrap_or(1);
+        let next_range = AtomicUsize::new(0);
+        let indexed: Mutex<Vec<(usize, RangeEntries)>> = Mutex::new(Vec::new());
+        thread::scope(|s| {
+            for _ in 0..num_cpus.min(ranges.len()) {
+                s.spawn(|| loop {
+                    let r = next_range.fetch_add(1, Ordering::Relaxed);
+                    let Some(range) = ranges.get(r) else {
+                        return;
+                    };
+                    let entries = index_range(data, range.clone());
+                    indexed.lock().unwrap().push((r, entries));
+                });
+            }
+        });
+
+        // The ranges are merged in input order, numbering the tickers as they first appear
+        let mut indexed = indexed.into_inner().unwrap();
+        indexed.sort_by_key(|(r, _)| *r);
+        let mut index = Index {
+            input_size: data.len() as u64,
+            ..Index::default()
+        };
+        let mut ids: HashMap<String, u32> = HashMap::new();
+        for (_, range) in indexed {
+            let range_ids: Vec<u32> = range
+                .tickers
+                .into_iter()
+                .map(|ticker| {
+                    *ids.entry(ticker).or_insert_with_key(|ticker| {
+                        index.tickers.push(ticker.clone());
+                        index.tickers.len() as u32 - 1
+                    })
+                })
+                .collect();
+            index
+                .entries
+                .extend(range.entries.into_iter().map(|entry| Entry {
+                    ticker: range_ids[entry.ticker as usize],
+                    ..entry
+                }));
+        }
+        index
+    }
+
+    /// Indexes a plain CSV file.
+    pub fn build_file(path: &Path) -> io::Result<Index> {
+        let file = File::open(path)?;
+        let (input_size, input_modified) = signature(path)?;
+        let mut index = if input_size == 0 {
+            Index::default()
+        } else {
+            // Safety: the input file is only read, and it must not be truncated while it is mapped
+            let data = unsafe { Mmap::map(&file) }?;
+            Index::build(&data)
+        };
+        (index.input_size, index.input_modified) = (input_size, input_modified);
+        Ok(index)
+    }
+
+    /// Reads the index of `input`, building and saving it if it is missing or
+    /// does not match the input any more.
+    pub fn open_or_build(input: &Path) -> io::Result<Index> {
+        let path = index_path(input);
+        if let Ok(bytes) = fs::read(&path) {
+            if let Ok(index) = Index::from_bytes(&bytes) {
+                if (index.input_size, index.input_modified) == signature(input)? {
+                    return Ok(index);
+                }
+            }
+        }
+        let index = Index::build_file(input)?;
+        index.save(&path)?;
+        Ok(index)
+    }
+
+    pub fn save(&self, path: &Path) -> io::Result<()> {
+        // Written aside and renamed, so a reader never finds half an index
+        let tmp_path = path.with_extension("lobmpidx.tmp");
+        let mut writer = BufWriter::new(File::create(&tmp_path)?);
+        writer.write_all(&self.to_bytes())?;
+        writer.flush()?;
+        drop(writer);
+        fs::rename(&tmp_path, path)
+    }
+
+    pub fn to_bytes(&self) -> Vec<u8> {
+        let tickers: usize = self.tickers.iter().map(|ticker| 4 + ticker.len()).sum();
+        let mut bytes = Vec::with_capacity(48 + tickers + self.entries.len() * ENTRY_SIZE);
+        bytes.extend_from_slice(MAGIC);
+        bytes.extend_from_slice(&VERSION.to_le_bytes());
+        bytes.extend_from_slice(&self.input_size.to_le_bytes());
+        bytes.extend_from_slice(&self.input_modified.to_le_bytes());
+        bytes.extend_from_slice(&(self.tickers.len() as u32).to_le_bytes());
+        for ticker in &self.tickers {
+            bytes.extend_from_slice(&(ticker.len() as u32).to_le_bytes());
+            bytes.extend_from_slice(ticker.as_bytes());
+        }
+        bytes.extend_from_slice(&(self.entries.len() as u64).to_le_bytes());
+        for entry in &self.entries {
+            bytes.extend_from_slice(&entry.offset.to_le_bytes());
+            bytes.extend_from_slice(&entry.length.to_le_bytes());
+            bytes.extend_from_slice(&entry.timestamp.unwrap_or(NO_TIMESTAMP).to_le_bytes());
+            bytes.extend_from_slice(&entry.ticker.to_le_bytes());
+            bytes.push(if entry.refresh { REFRESH_FLAG } else { 0 });
+            bytes.extend_from_slice(&[0; 3]);
+        }
+        bytes
+    }
+
+    pub fn from_bytes(bytes: &[u8]) -> Result<Index, String> {
+        let mut cursor = Cursor { bytes, position: 0 };
+        if cursor.take(MAGIC.len())? != MAGIC {
+            return Err("Not a lobmp index".to_string());
+        }
+        let version = u32::from_le_bytes(cursor.array()?);
+        if version != VERSION {
+            return Err(format!("Unsupported index version {}", version));
+        }
+        let input_size = u64::from_le_bytes(cursor.array()?);
+        let input_modified = u64::from_le_bytes(cursor.array()?);
+        let num_tickers = u32::from_le_bytes(cursor.array()?);
+        let tickers = (0..num_tickers)
+            .map(|_| {
+                let length = u32::from_le_bytes(cursor.array()?) as usize;
+                String::from_utf8(cursor.take(length)?.to_vec())
+                    .map_err(|_| "Invalid ticker in the index".to_string())
+            })
+            .collect::<Result<Vec<_>, _>>()?;
+        let num_entries = u64::from_le_bytes(cursor.array()?) as usize;
+        if bytes.len() - cursor.position != num_entries.saturating_mul(ENTRY_SIZE) {
+            return Err("Truncated index".to_string());
+        }
+        let entries = (0..num_entries)
+            .map(|_| {
+                let offset = u64::from_le_bytes(cursor.array()?);
+                let length = u64::from_le_bytes(cursor.array()?);
+                let timestamp = i64::from_le_bytes(cursor.array()?);
+                let ticker = u32::from_le_bytes(cursor.array()?);
+                let flags = cursor.take(4)?[0];
+                if ticker >= num_tickers {
+                    return Err("Invalid ticker id in the index".to_string());
+                }
+                Ok(Entry {
+                    offset,
+                    length,
+                    ticker,
+                    timestamp: (timestamp != NO_TIMESTAMP).then_some(timestamp),
+                    refresh: flags & REFRESH_FLAG != 0,
+                })
+            })
+            .collect::<Result<Vec<_>, String>>()?;
+        Ok(Index {
+            input_size,
+            input_modified,
+            tickers,
+            entries,
+        })
+    }
+
+    /// The messages kept by the tickers and the time window of `filter`.
+    pub fn select<'a>(&'a self, filter: &'a Filter) -> impl Iterator<Item = &'a Entry> + 'a {
+        let tickers: Option<Vec<bool>> = filter.tickers.as_ref().map(|tickers| {
+            self.tickers
+                .iter()
+                .map(|ticker| tickers.contains(ticker))
+                .collect()
+        });
+        let windowed = filter.start.is_some() || filter.end.is_some();
+        self.entries.iter().filter(move |entry| {
+            if let Some(tickers) = &tickers {
+                if !tickers[entry.ticker as usize] {
+                    return false;
+                }
+            }
+            if !windowed {
+                return true;
+            }
+            entry.timestamp.is_some_and(|timestamp| {
+                filter.start.is_none_or(|start| timestamp >= start)
+                    && filter.end.is_none_or(|end| timestamp < end)
+            })
+        })
+    }
+}
+
+/// Reads the messages of `entries`, in their order, seeking to each one.
+pub fn read_messages<'a>(
+    file: &mut File,
+    entries: impl IntoIterator<Item = &'a Entry>,
+) -> io::Result<Vec<Vec<u8>>> {
+    entries
+        .into_iter()
+        .map(|entry| {
+            let mut message = vec![0; entry.length as usize];
+            file.seek(SeekFrom::Start(entry.offset))?;
+            file.read_exact(&mut message)?;
+            Ok(message)
+        })
+        .collect()
+}
+
+struct Cursor<'a> {
+    bytes: &'a [u8],
+    position: usize,
+}
+
+impl<'a> Cursor<'a> {
+    fn take(&mut self, length: usize) -> Result<&'a [u8], String> {
+        let end = self.position.saturating_add(length);
+        let taken = self
+            .bytes
+            .get(self.position..end)
+            .ok_or_else(|| "Truncated index".to_string())?;
+        self.position = end;
+        Ok(taken)
+    }
+
+    fn array<const N: usize>(&mut self) -> Result<[u8; N], String> {
+        Ok(self.take(N)?.try_into().unwrap())
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    const DATA: &[u8] = b"Header\n\
+AAA.MC,Market By Price,2020-01-11T10:00:00.000000000Z,+1,Raw,REFRESH,,,,,3240,0,\n\
+,,,,Summary,,,,,,,,\n\
+BBB.MC,Market By Price,2020-01-11T10:00:01.000000000Z,+1,Raw,UPDATE,,,,,3240,0,\n\
+,,,,MapEntry,,,,,,,ADD,1\n\
+AAA.MC,Market By Price,,+1,Raw,UPDATE,,,,,3240,0,\n";
+
+    #[test]
+    fn indexes_every_message() {
+        let index = Index::build(DATA);
+        assert_eq!(index.tickers, ["AAA.MC", "BBB.MC"]);
+        assert_eq!(index.entries.len(), 3);
+        let first = index.entries[0];
+        assert_eq!(first.offset, 7);
+        assert!(DATA[first.offset as usize..].starts_with(b"AAA.MC,Market By Price"));
+        assert_eq!(first.offset + first.length, index.entries[1].offset);
+        assert!(first.refresh);
+        assert_eq!(index.entries[1].ticker, 1);
+        assert!(!index.entries[1].refresh);
+        assert_eq!(index.entries[2].ticker, 0);
+        assert_eq!(index.entries[2].timestamp, None);
+        let last = index.entries[2];
+        assert_eq!((last.offset + last.length) as usize, DATA.len());
+    }
+
+    #[test]
+    fn round_trips_and_rejects_broken_indexes() {
+        let index = Index::build(DATA);
+        let bytes = index.to_bytes();
+        assert_eq!(Index::from_bytes(&bytes).unwrap(), index);
+        assert!(Index::from_bytes(&bytes[..bytes.len() - 1]).is_err());
+        assert!(Index::from_bytes(b"NOTANIDX").is_err());
+    }
+
+    #[test]
+    fn selects_tickers_and_window() {
+        let index = Index::build(DATA);
+        let filter = Filter::new(
+            Some(vec!["AAA.MC".to_string()]),
+            None,
+            Some("2020-01-11T10:00:00"),
+            None,
+        )
+        .unwrap();
+        let selected: Vec<_> = index.select(&filter).collect();
+        assert_eq!(selected, [&index.entries[0]]);
+        assert_eq!(index.select(&Filter::default()).count(), 3);
+    }
+}
@@ -0,0 +1,354 @@
+//! Opening of the input files, plain or compressed.
+//!
+//! Gzip and zstd input is detected from its magic bytes and decoded as a
+//! stream on a thread of its own, so the readers only ever see CSV lines.
+//! When the compressed file is made of independent blocks whose sizes are
+//! known without decoding them, BGZF gzip blocks or the frames listed in the
+//! seek table of a seekable zstd file, the blocks are decoded in parallel
+//! and handed over in order. Any other gzip members or zstd frames are
+//! decoded one after another.
+
+use crossbeam::channel::{bounded, unbounded, Receiver, Sender};
+use flate2::read::{GzDecoder, MultiGzDecoder};
+use memmap2::Mmap;
+use std::collections::HashMap;
+use std::fs::File;
+use std::io::{self, BufRead, BufReader, Read};
+use std::ops::Range;
+use std::path::Path;
+use std::sync::atomic::{AtomicU64, Ordering};
+use std::sync::Arc;
+use std::thread::{self, available_parallelism};
+
+/// Bytes of decoded data handed over at a time by a streaming decoder.
+const CHUNK_SIZE: usize = 1024 * 1024;
+
+/// Decoded chunks that may be waiting for the reader.
+const DECODED_CHUNKS: usize = 8;
+
+const GZIP_MAGIC: &[u8] = &[0x1f, 0x8b];
+const ZSTD_MAGIC: &[u8] = &[0x28, 0xb5, 0x2f, 0xfd];
+const SEEKABLE_ZSTD_MAGIC: u32 = 0x8f92_eab1;
+const SKIPPABLE_FRAME_MAGIC: u32 = 0x184d_2a5e;
+
+/// Compression of an input file.
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum Compression {
+    None,
+    Gzip,
+    Zstd,
+}
+
+/// Returns true if the path is a CSV file, plain (`.csv`) or compressed (`.csv.gz`, `.csv.zst`).
+pub fn is_csv(path: &Path) -> bool {
+    match path.extension().and_then(|ext| ext.to_str()) {
+        Some("csv") => true,
+        Some("gz" | "zst") => path.file_stem().is_some_and(|stem| {
+            Path::new(stem).extension().and_then(|ext| ext.to_str()) == Some("csv")
+        }),
+        _ => false,
+    }
+}
+
+/// Detects the compression of a file from its first bytes.
+pub fn compression(file: &mut File) -> io::Result<Compression> {
+    let mut magic = [0; 4];
+    let mut read = 0;
+    while read < magic.len() {
+        match file.read(&mut magic[read..])? {
+            0 => break,
+            n => read += n,
+        }
+    }
+    io::Seek::rewind(file)?;
+    let magic = &magic[..read];
+    if magic.starts_with(GZIP_MAGIC) {
+        Ok(Compression::Gzip)
+    } else if magic.starts_with(ZSTD_MAGIC) {
+        Ok(Compression::Zstd)
+    } else {
+        Ok(Compression::None)
+    }
+}
+
+/// An opened input file, decoded if it is compressed.
+pub struct Input {
+    pub reader: Box<dyn BufRead + Send>,
+    pub compression: Compression,
+    position: Arc<AtomicU64>,
+}
+
+impl Input {
+    pub fn open(path: &Path) -> io::Result<Input> {
+        Input::new(File::open(path)?)
+    }
+
+    pub fn new(mut file: File) -> io::Result<Input> {
+        let compression = compression(&mut file)?;
+        let position = Arc::new(AtomicU64::new(0));
+        let reader: Box<dyn BufRead + Send> = match compression {
+            Compression::None => Box::new(BufReader::new(Counted {
+                inner: file,
+                position: position.clone(),
+            })),
+            compression => Box::new(BufReader::new(decode(file, compression, position.clone())?)),
+        };
+        Ok(Input {
+            reader,
+            compression,
+            position,
+        })
+    }
+
+    /// Bytes of the file, compressed or not, that have been consumed so far.
+    pub fn position(&self) -> u64 {
+        self.position.load(Ordering::Relaxed)
+    }
+}
+
+/// Reader that keeps count of the bytes read from it.
+struct Counted<R> {
+    inner: R,
+    position: Arc<AtomicU64>,
+}
+
+impl<R: Read> Read for Counted<R> {
+    fn read(&mut self, buf: &mut [u8]) -> io::Result<usize> {
+        let read = self.inner.read(buf)?;
+        self.position.fetch_add(read as u64, Ordering::Relaxed);
+        Ok(read)
+    }
+}
+
+/// Reader of the chunks sent by a decoding thread.
+struct Decoded {
+    rx_chunks: Receiver<io::Result<Vec<u8>>>,
+    chunk: Vec<u8>,
+    offset: usize,
+    decoder: Option<thread::JoinHandle<()>>,
+}
+
+impl Read for Decoded {
+    fn read(&mut self, buf: &mut [u8]) -> io::Result<usize> {
+        while self.offset == self.chunk.len() {
+            match self.rx_chunks.recv() {
+                Ok(chunk) => {
+                    self.chunk = chunk?;
+                    self.offset = 0;
+                }
+                Err(_) => {
+                    // The decoder is done, make sure it did not stop halfway
+                    if let Some(decoder) = self.decoder.take() {
+                        if decoder.join().is_err() {
+                            return Err(io::Error::other("Decompression thread panicked"));
+                        }
+                    }
+                    return Ok(0);
+                }
+            }
+        }
+        let read = buf.len().min(self.chunk.len() - self.offset);
+        buf[..read].copy_from_slice(&self.chunk[self.offset..self.offset + read]);
+        self.offset += read;
+        Ok(read)
+    }
+}
+
+/// Starts decoding `file` on its own thread.
+fn decode(file: File, compression: Compression, position: Arc<AtomicU64>) -> io::Result<Decoded> {
+    // Safety: the input file is only read, and it must not be truncated while it is mapped
+    let data = unsafe { Mmap::map(&file) }?;
+    let (tx_chunks, rx_chunks) = bounded::<io::Result<Vec<u8>>>(DECODED_CHUNKS);
+
+    let decoder = thread::spawn(move || {
+        let blocks = match compression {
+            Compression::Gzip => bgzf_blocks(&data),
+            Compression::Zstd => seekable_zstd_frames(&data),
+            Compression::None => None,
+        };
+        match (compression, blocks) {
+            (Compression::Gzip, Some(blocks)) => {
+                decode_blocks(&data, &blocks, decode_gzip_block, &position, &tx_chunks)
+            }
+            (Compression::Zstd, Some(frames)) => {
+                decode_blocks(&data, &frames, decode_zstd_frame, &position, &tx_chunks)
+            }
+            (Compression::Zstd, None) => match zstd::stream::read::Decoder::new(Counted {
+                inner: &data[..],
+                position,
+            }) {
+                Ok(decoder) => decode_stream(decoder, &tx_chunks),
+                Err(e) => {
+                    let _ = tx_chunks.send(Err(e));
+                }
+            },
+            _ => decode_stream(
+                MultiGzDecoder::new(Counted {
+                    inner: &data[..],
+                    position,
+                }),
+                &tx_chunks,
+            ),
+        }
+    });
+
+    Ok(Decoded {
+        rx_chunks,
+        chunk: Vec::new(),
+        offset: 0,
+        decoder: Some(decoder),
+    })
+}
+
+/// Decodes a stream one chunk at a time.
+fn decode_stream(mut decoder: impl Read, tx_chunks: &Sender<io::Result<Vec<u8>>>) {
+    loop {
+        let mut chunk = Vec::with_capacity(CHUNK_SIZE);
+        match decoder
+            .by_ref()
+            .take(CHUNK_SIZE as u64)
+            .read_to_end(&mut chunk)
+        {
+            Ok(0) => return,
+            Ok(_) => {
+                if tx_chunks.send(Ok(chunk)).is_err() {
+                    return;
+                }
+            }
+            Err(e) => {
+                let _ = tx_chunks.send(Err(e));
+                return;
+            }
+        }
+    }
+}
+
+/// Decodes independent blocks in parallel and sends them in order.
+fn decode_blocks(
+    data: &[u8],
+    blocks: &[Range<usize>],
+    decode_block: fn(&[u8]) -> io::Result<Vec<u8>>,
+    position: &AtomicU64,
+    tx_chunks: &Sender<io::Result<Vec<u8>>>,
+) {
+    let num_cpus: usize = available_parallelism().map(|n| n.get()).unwrap_or(1);
+    // Blocks that may be decoded but not yet sent, to bound the memory used
+    let window = 2 * num_cpus;
+
+    thread::scope(|s| {
+        let (tx_blocks, rx_blocks) = unbounded::<usize>();
+        let (tx_decoded, rx_decoded) = unbounded::<(usize, io::Result<Vec<u8>>)>();
+        for _ in 0..num_cpus {
+            let (rx_blocks, tx_decoded) = (rx_blocks.clone(), tx_decoded.clone());
+            s.spawn(move || {
+                while let Ok(i) = rx_blocks.recv() {
+                    if tx_decoded
+                        .send((i, decode_block(&data[blocks[i].clone()])))
+                        .is_err()
+                    {
+                        return;
+                    }
+                }
+            });
+        }
+        drop(tx_decoded);
+
+        let mut next_block: usize = 0;
+        let mut next_to_send: usize = 0;
+        let mut decoded: HashMap<usize, io::Result<Vec<u8>>> = HashMap::new();
+        while next_to_send < blocks.len() {
+            while next_block < blocks.len() && next_block < next_to_send + window {
+                let _ = tx_blocks.send(next_block);
+                next_block += 1;
+            }
+            let Ok((i, chunk)) = rx_decoded.recv() else {
+                return;
+            };
+            decoded.insert(i, chunk);
+            while let Some(chunk) = decoded.remove(&next_to_send) {
+                let failed = chunk.is_err();
+                position.store(blocks[next_to_send].end as u64, Ordering::Relaxed);
+                if tx_chunks.send(chunk).is_err() || failed {
+                    // Dropping the block queue stops the decoding workers
+                    return;
+                }
+                next_to_send += 1;
+            }
+        }
+    });
+}
+
+fn decode_gzip_block(block: &[u8]) -> io::Result<Vec<u8>> {
+    let mut decoded = Vec::new();
+    GzDecoder::new(block).read_to_end(&mut decoded)?;
+    Ok(decoded)
+}
+
+fn decode_zstd_frame(frame: &[u8]) -> io::Result<Vec<u8>> {
+    zstd::stream::decode_all(frame)
+}
+
+fn read_u16(data: &[u8], at: usize) -> Option<usize> {
+    Some(u16::from_le_bytes(data.get(at..at + 2)?.try_into().ok()?) as usize)
+}
+
+fn read_u32(data: &[u8], at: usize) -> Option<u32> {
+    Some(u32::from_le_bytes(data.get(at..at + 4)?.try_into().ok()?))
+}
+
+/// Blocks of a BGZF file, a gzip file whose members record their own size in
+/// a `BC` extra subfield. Returns `None` for any other gzip file.
+fn bgzf_blocks(data: &[u8]) -> Option<Vec<Range<usize>>> {
+    let mut blocks = Vec::new();
+    let mut start = 0;
+    while start < data.len() {
+        let header = data.get(start..start + 12)?;
+        // Deflate compression with the FEXTRA flag set
+        if !header.starts_with(GZIP_MAGIC) || header[2] != 8 || header[3] & 0x04 == 0 {
+            return None;
+        }
+        let extra_end = start + 12 + read_u16(data, start + 10)?;
+        let mut subfield = start + 12;
+        let mut block_size = None;
+        while subfield + 4 <= extra_end {
+            let length = read_u16(data, subfield + 2)?;
+            if &data[subfield..subfield + 2] == b"BC" && length == 2 {
+                block_size = Some(read_u16(data, subfield + 4)? + 1);
+            }
+            subfield += 4 + length;
+        }
+        let end = start + block_size?;
+        if end > data.len() {
+            return None;
+        }
+        blocks.push(start..end);
+        start = end;
+    }
+    Some(blocks)
+}
+
+/// Frames of a seekable zstd file, as listed in the seek table at its end.
+/// Returns `None` for any other zstd file.
+fn seekable_zstd_frames(data: &[u8]) -> Option<Vec<Range<usize>>> {
+    let footer = data.len().checked_sub(9)?;
+    if read_u32(data, footer + 5)? != SEEKABLE_ZSTD_MAGIC {
+        return None;
+    }
+    let num_frames = read_u32(data, footer)? as usize;
+    let entry_size = if data[footer + 4] & 0x80 != 0 { 12 } else { 8 };
+    let table_start = footer.checked_sub(num_frames.checked_mul(entry_size)?)?;
+    let frame_start = table_start.checked_sub(8)?;
+    if read_u32(data, frame_start)? != SKIPPABLE_FRAME_MAGIC {
+        return None;
+    }
+
+    let mut frames = Vec::with_capacity(num_frames);
+    let mut start = 0;
+    for entry in 0..num_frames {
+        let size = read_u32(data, table_start + entry * entry_size)? as usize;
+        frames.push(start..start + size);
+        start += size;
+    }
+    // The frames must cover everything up to the seek table
+    (start == frame_start).then_some(frames)
+}
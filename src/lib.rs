@@ -1,40 +1,88 @@
+mod batch;
+mod book;
+mod budget;
+mod compact;
+mod filter;
+mod index;
+mod input;
+mod manifest;
+mod progress;
+mod reader;
+mod schema;
+mod splitter;
+mod stats;
+mod stream;
+
+// Public for the benches
+pub mod fid_types;
+pub mod parser;
+pub mod synthetic;
+pub mod tokenizer;
+pub mod writer;
+
+use batch::{run_batch, BatchJob, JobError};
+use book::{parse_interval, parse_message, spawn_book_writer, Books, IndexedBookMessage};
+use budget::Budget;
+use compact::{CompactOptions, DEFAULT_COMPACT_MEMORY, DEFAULT_COMPACT_ROW_GROUP_SIZE};
 use crossbeam::channel::bounded;
+use fid_types::FidTypes;
+use filter::Filter;
+use index::{index_path, read_messages, Entry, Index};
+use input::{is_csv, Compression, Input};
+use manifest::Manifest;
+use parser::Parser;
 use polars::prelude::*;
+use progress::{Progress, Reporter};
 use pyo3::prelude::*;
-use pyo3::types::{PyDict, PyList};
+use pyo3::types::{PyBytes, PyDict, PyList};
 use pyo3_polars::PyDataFrame;
-use std::collections::HashMap;
-use std::collections::HashSet;
+use reader::{for_each_message, IndexedMessage};
+use schema::OutputSchema;
+use serde::Serialize;
+use stats::{Metrics, Stats, Timer};
+use std::collections::{HashMap, HashSet};
 use std::fs::{self, File};
-use std::io::{BufRead, BufReader, BufWriter, Read, Seek, SeekFrom};
-use std::path::PathBuf;
-use std::thread::{available_parallelism, sleep};
-use std::{thread, time};
+use std::io::BufRead;
+use std::path::{Path, PathBuf};
+use std::sync::Arc;
+use std::thread::{self, available_parallelism};
+use stream::{spawn_stream, Batch};
+use synthetic::{write_file, SyntheticOptions};
+use tokenizer::{is_header, Record, RecordKind};
+use writer::{
+    concat_aligned, initial_columns, parse_compression, parse_ipc_compression, InputEnd,
+    OutputFormat, WriterOptions, MESSAGE_INDEX,
+};
 
 #[pyfunction]
 fn find_market_by_price_lines(path: PathBuf, py: Python) -> PyResult<PyObject> {
-    if path.extension().and_then(|ext| ext.to_str()) != Some("csv") {
+    if !is_csv(&path) {
         return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
-            "The file {:?} is not of type CSV, Only .csv files are supported",
+            "The file {:?} is not of type CSV, Only .csv files are supported, plain or compressed as .csv.gz or .csv.zst",
             path
         )));
     }
 
-    let file = File::open(&path).map_err(|e| {
-        PyErr::new::<pyo3::exceptions::PyIOError, _>(format!(
-            "Failed to open file {:?}: {}",
-            path, e
-        ))
-    })?;
-
-    let reader = BufReader::new(file);
+    let mut reader = Input::open(&path)
+        .map_err(|e| {
+            PyErr::new::<pyo3::exceptions::PyIOError, _>(format!(
+                "Failed to open file {:?}: {}",
+                path, e
+            ))
+        })?
+        .reader;
     let mut result = Vec::new();
+    let mut line: Vec<u8> = Vec::new();
 
-    for (i, line) in reader.lines().enumerate() {
-        let line = line.map_err(|e| {
+    for i in 0_usize.. {
+        line.clear();
+        let read = reader.read_until(b'\n', &mut line).map_err(|e| {
             PyErr::new::<pyo3::exceptions::PyIOError, _>(format!("Error reading line: {}", e))
         })?;
-        if line.contains("Market By Price") {
+        if read == 0 {
+            break;
+        }
+        if is_header(&line) {
             result.push(i);
         }
     }
@@ -47,42 +95,48 @@ fn find_market_by_price_lines(path: PathBuf, py: Python) -> PyResult<PyObject> {
 
 #[pyfunction]
 fn extract_fids(path: PathBuf, py: Python) -> PyResult<PyObject> {
-    if path.extension().and_then(|ext| ext.to_str()) != Some("csv") {
+    if !is_csv(&path) {
         return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
-            "The file {:?} is not of type CSV, Only .csv files are supported",
+            "The file {:?} is not of type CSV, Only .csv files are supported, plain or compressed as .csv.gz or .csv.zst",
             path
         )));
     }
 
-    let file = File::open(&path).map_err(|e| {
-        PyErr::new::<pyo3::exceptions::PyIOError, _>(format!(
-            "Failed to open file {:?}: {}",
-            path, e
-        ))
-    })?;
-
-    let reader = BufReader::new(file);
+    let mut reader = Input::open(&path)
+        .map_err(|e| {
+            PyErr::new::<pyo3::exceptions::PyIOError, _>(format!(
+                "Failed to open file {:?}: {}",
+                path, e
+            ))
+        })?
+        .reader;
     let dict = PyDict::new(py);
+    let mut line: Vec<u8> = Vec::new();
 
-    for line in reader.lines() {
-        let line = line.map_err(|e| {
+    loop {
+        line.clear();
+        let read = reader.read_until(b'\n', &mut line).map_err(|e| {
             PyErr::new::<pyo3::exceptions::PyIOError, _>(format!("Error reading line: {}", e))
         })?;
+        if read == 0 {
+            break;
+        }
 
-        let parts: Vec<&str> = line.split(',').collect();
+        let record = Record::new(&line);
 
-        if parts[4].trim() == "FID" {
-            let fid = parts[5].trim();
-            let name = parts[7].trim();
+        if record.kind() == RecordKind::Fid {
+            let fid = record.get(5).unwrap_or_default().trim_ascii();
+            let name = record.get(7).unwrap_or_default().trim_ascii();
             let mut has_two = "false";
 
-            if !parts[9].is_empty() {
+            if record.get(9).is_some_and(|value| !value.is_empty()) {
                 has_two = "true";
             }
 
             if !fid.is_empty() && !name.is_empty() {
-                let list = PyList::new(py, [fid, has_two]).unwrap();
-                dict.set_item(name, list)?;
+                let fid = String::from_utf8_lossy(fid);
+                let list = PyList::new(py, [&*fid, has_two]).unwrap();
+                dict.set_item(String::from_utf8_lossy(name), list)?;
             }
         }
     }
@@ -91,8 +145,22 @@ fn extract_fids(path: PathBuf, py: Python) -> PyResult<PyObject> {
 }
 
 #[pyfunction]
-fn flatten_map_entry(message: &str, py: Python) -> PyResult<PyObject> {
-    let matrix = flat_map_entry(message);
+#[pyo3(signature = (message, fid_types=None, as_lists=false))]
+fn flatten_map_entry(
+    message: &str,
+    fid_types: Option<HashMap<String, String>>,
+    as_lists: bool,
+    py: Python,
+) -> PyResult<PyObject> {
+    let fid_types = Arc::new(fid_types_from_names(fid_types)?);
+    if !as_lists {
+        // The columns are built from the cells directly, with no Python object per cell
+        let df = py
+            .allow_threads(|| Parser::new(fid_types).map_entry_frame(message))
+            .map_err(|e| PyErr::new::<pyo3::exceptions::PyValueError, _>(e.to_string()))?;
+        return Ok(PyDataFrame(df).into_pyobject(py)?.into_any().unbind());
+    }
+    let matrix = Parser::new(fid_types).map_entry(message);
 
     let py_list = PyList::empty(py);
     for row_vec in matrix {
@@ -106,191 +174,454 @@ fn flatten_map_entry(message: &str, py: Python) -> PyResult<PyObject> {
     Ok(py_list.into_py(py))
 }
 
-fn flat_map_entry(message: &str) -> Vec<Vec<String>> {
-    let mut rows: Vec<HashMap<String, String>> = Vec::new();
-    let mut current_row: Option<HashMap<String, String>> = None;
-    for line in message.lines() {
-        let parts: Vec<&str> = line.split(',').collect();
+fn fid_types_from_names(fid_types: Option<HashMap<String, String>>) -> PyResult<FidTypes> {
+    match fid_types {
+        Some(names) => {
+            enable_string_cache();
+            FidTypes::from_names(names).map_err(PyErr::new::<pyo3::exceptions::PyValueError, _>)
+        }
+        None => Ok(FidTypes::default()),
+    }
+}
 
-        if parts[4] == "MapEntry" {
-            // Start a new row
-            if let Some(row) = current_row.take() {
-                rows.push(row);
-            }
+#[pyfunction]
+#[pyo3(signature = (message, fid_types=None))]
+fn flatten_market_by_price(
+    message: &str,
+    fid_types: Option<HashMap<String, String>>,
+) -> PyResult<PyDataFrame> {
+    let fid_types = fid_types_from_names(fid_types)?;
+    let df = Parser::new(Arc::new(fid_types))
+        .market_by_price(message)
+        .map_err(|e| PyErr::new::<pyo3::exceptions::PyValueError, _>(e.to_string()))?;
 
-            let mut new_row = HashMap::new();
+    // Convert Polars DataFrame to Python PyObject
+    let pydf = PyDataFrame(df);
+    Ok(pydf)
+}
 
-            if let Some(entry_type) = parts.get(6) {
-                new_row.insert("MAP_ENTRY_TYPE".to_string(), entry_type.to_string());
+/// Concatenates parsed messages, in order, aligned to every column they have.
+fn concat_discovered(dfs: Vec<DataFrame>, fid_types: &FidTypes) -> PolarsResult<DataFrame> {
+    let mut columns = initial_columns(fid_types);
+    for df in &dfs {
+        for column in df.get_columns() {
+            if !columns.contains_key(column.name().as_str()) {
+                columns.insert(column.name().to_string(), column.dtype().clone());
             }
+        }
+    }
+    concat_aligned(dfs, &columns)
+}
 
-            if let Some(entry_id) = parts.get(12) {
-                new_row.insert("MAP_ENTRY_KEY".to_string(), entry_id.to_string());
-            }
+/// Column of the position of a message in the list given to `flatten_market_by_price_many`.
+const MESSAGE_POSITION: &str = "MESSAGE_POSITION";
+
+/// Parses `messages` on every core into one DataFrame, where every row has
+/// the key paired with its message in the column `key_column`.
+fn flatten_many(
+    messages: &[(u64, &[u8])],
+    key_column: &str,
+    fid_types: Arc<FidTypes>,
+) -> PyResult<DataFrame> {
+    let num_cpus: usize = available_parallelism().map(|n| n.get()).unwrap_or(1);
+    let chunk_size = messages.len().div_ceil(num_cpus).max(1);
+    let parsed: Vec<PyResult<Vec<DataFrame>>> = thread::scope(|s| {
+        let handles: Vec<_> = messages
+            .chunks(chunk_size)
+            .enumerate()
+            .map(|(chunk_index, chunk)| {
+                let fid_types = fid_types.clone();
+                s.spawn(move || -> PyResult<Vec<DataFrame>> {
+                    let mut parser = Parser::new(fid_types);
+                    chunk
+                        .iter()
+                        .enumerate()
+                        .map(|(i, &(key, message))| {
+                            let index = chunk_index * chunk_size + i;
+                            let message = std::str::from_utf8(message).map_err(|e| {
+                                PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+                                    "Message {} is not valid UTF-8: {}",
+                                    index, e
+                                ))
+                            })?;
+                            let mut df = parser.market_by_price(message).map_err(|e| {
+                                PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+                                    "Failed to parse message {}: {}",
+                                    index, e
+                                ))
+                            })?;
+                            let key = UInt64Chunked::full(key_column.into(), key, df.height());
+                            df.with_column(key.into_series()).map_err(|e| {
+                                PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e.to_string())
+                            })?;
+                            Ok(df)
+                        })
+                        .collect()
+                })
+            })
+            .collect();
+        handles
+            .into_iter()
+            .map(|handle| handle.join().expect("Parsing thread panicked"))
+            .collect()
+    });
+
+    let mut dfs: Vec<DataFrame> = Vec::with_capacity(messages.len());
+    for chunk in parsed {
+        dfs.extend(chunk?);
+    }
+    concat_discovered(dfs, &fid_types)
+        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e.to_string()))
+}
 
-            current_row = Some(new_row);
-        }
+#[pyfunction]
+#[pyo3(signature = (messages, fid_types=None))]
+fn flatten_market_by_price_many(
+    messages: &Bound<'_, PyAny>,
+    fid_types: Option<HashMap<String, String>>,
+    py: Python,
+) -> PyResult<PyDataFrame> {
+    let fid_types = Arc::new(fid_types_from_names(fid_types)?);
+    let df = if let Ok(buffer) = messages.downcast::<PyBytes>() {
+        // The messages are read in place, the buffer is not copied
+        let data = buffer.as_bytes();
+        py.allow_threads(|| {
+            // Keyed by their byte offset in the buffer, as in an unordered output
+            let mut offset = splitter::next_header(data, 0);
+            let messages: Vec<(u64, &[u8])> = splitter::messages(&data[offset..])
+                .map(|message| {
+                    let start = offset;
+                    offset += message.len();
+                    (start as u64, message)
+                })
+                .collect();
+            flatten_many(&messages, MESSAGE_INDEX, fid_types)
+        })?
+    } else {
+        let messages: Vec<String> = messages.extract()?;
+        py.allow_threads(|| {
+            let messages: Vec<(u64, &[u8])> = messages
+                .iter()
+                .enumerate()
+                .map(|(position, message)| (position as u64, message.as_bytes()))
+                .collect();
+            flatten_many(&messages, MESSAGE_POSITION, fid_types)
+        })?
+    };
+    Ok(PyDataFrame(df))
+}
 
-        if parts[4] == "FID" {
-            let mut fid_value_index = 8;
-            if !parts[9].is_empty() {
-                fid_value_index = 9;
-            }
-            if let (Some(key), Some(value)) = (parts.get(7), parts.get(fid_value_index)) {
-                if let Some(ref mut row) = current_row {
-                    row.insert(key.to_string(), value.to_string());
-                }
-            }
-        }
+/// Validates the options of the book reconstruction mode.
+fn book_options(depth: usize, interval: Option<&str>) -> PyResult<Option<i64>> {
+    if depth == 0 {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
+            "The book depth must be at least 1",
+        ));
     }
-    if let Some(row) = current_row.take() {
-        rows.push(row);
+    interval
+        .map(parse_interval)
+        .transpose()
+        .map_err(PyErr::new::<pyo3::exceptions::PyValueError, _>)
+}
+
+#[pyfunction]
+#[pyo3(signature = (messages, depth=10, interval=None))]
+fn reconstruct_book(
+    messages: Vec<String>,
+    depth: usize,
+    interval: Option<&str>,
+) -> PyResult<PyDataFrame> {
+    let mut books = Books::new(depth, book_options(depth, interval)?);
+    for message in &messages {
+        books.apply(&parse_message(message));
     }
-    // Build headers from all unique keys
-    let mut headers: Vec<String> = rows.iter().flat_map(|r| r.keys().cloned()).collect();
-    headers.sort();
-    headers.dedup();
+    books.finish();
+    let df = books.take_frame().map_err(|e| {
+        PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!(
+            "Failed to build the book snapshots: {}",
+            e
+        ))
+    })?;
+    Ok(PyDataFrame(df))
+}
 
-    let mut matrix: Vec<Vec<String>> = Vec::new();
-    matrix.push(headers.clone());
-    for row in &rows {
-        let values = headers
-            .iter()
-            .map(|k| row.get(k).cloned().unwrap_or_default())
-            .collect::<Vec<String>>();
-        matrix.push(values);
+/// Validates the Parquet and IPC options of the output.
+#[allow(clippy::too_many_arguments)]
+fn writer_options(
+    hive_partitioning: bool,
+    compression: &str,
+    compression_level: Option<i32>,
+    row_group_size: Option<usize>,
+    part_size: Option<usize>,
+    statistics: bool,
+    writers: Option<usize>,
+    ordered: bool,
+    resume: bool,
+    output_format: &str,
+    ipc_compression: &str,
+) -> PyResult<WriterOptions> {
+    let compression = parse_compression(compression, compression_level)
+        .map_err(PyErr::new::<pyo3::exceptions::PyValueError, _>)?;
+    let format = OutputFormat::parse(output_format)
+        .map_err(PyErr::new::<pyo3::exceptions::PyValueError, _>)?;
+    let ipc_compression = parse_ipc_compression(ipc_compression)
+        .map_err(PyErr::new::<pyo3::exceptions::PyValueError, _>)?;
+    if row_group_size == Some(0) || part_size == Some(0) || writers == Some(0) {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
+            "The row group size, the part size and the number of writers must be at least 1",
+        ));
     }
-    matrix
+    if resume && !ordered {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
+            "Unordered output can not be resumed",
+        ));
+    }
+    let defaults = WriterOptions::default();
+    Ok(WriterOptions {
+        hive_partitioning,
+        compression,
+        row_group_size,
+        statistics,
+        part_size: part_size.unwrap_or(defaults.part_size),
+        writers: writers.unwrap_or(defaults.writers),
+        ordered,
+        format,
+        ipc_compression,
+        ..defaults
+    })
 }
 
-fn flat_market_by_price(message: &str) -> Result<DataFrame, PolarsError> {
-    let mut rows: Vec<HashMap<String, String>> = Vec::new();
-    let mut current_row: Option<HashMap<String, String>> = None;
-    let mut header_info: HashMap<String, String> = HashMap::new();
-    let mut in_summary: bool = false;
+/// Validates the messages and FIDs to keep.
+fn filter_options(
+    tickers: Option<Vec<String>>,
+    fids: Option<Vec<String>>,
+    start: Option<&str>,
+    end: Option<&str>,
+) -> PyResult<Arc<Filter>> {
+    Filter::new(tickers, fids, start, end)
+        .map(Arc::new)
+        .map_err(PyErr::new::<pyo3::exceptions::PyValueError, _>)
+}
 
-    for line in message.lines() {
-        let parts: Vec<&str> = line.split(',').collect();
+/// Validates the pinned schema of a run. Only a discovered schema can be cached.
+fn pinned_schema(schema: Option<Vec<String>>, cache_schema: bool) -> PyResult<OutputSchema> {
+    let Some(names) = schema else {
+        return Ok(OutputSchema::Discovered);
+    };
+    if cache_schema {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
+            "A pinned schema is not discovered, it can not be cached",
+        ));
+    }
+    if names.is_empty() {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
+            "The pinned schema must have at least one column",
+        ));
+    }
+    let mut seen = HashSet::new();
+    if let Some(name) = names.iter().find(|name| !seen.insert(name.as_str())) {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+            "Column {:?} is twice in the pinned schema",
+            name
+        )));
+    }
+    Ok(OutputSchema::Pinned(Arc::new(names)))
+}
 
-        if parts.len() > 2 && parts[1] == "Market By Price" {
-            // Extract header information
-            if let Some(ticker) = parts.first() {
-                header_info.insert("TICKER".to_string(), ticker.to_string());
-            }
-            if let Some(timestamp) = parts.get(2) {
-                header_info.insert("TIMESTAMP".to_string(), timestamp.to_string());
-            }
-            if let Some(gmt_offset) = parts.get(3) {
-                header_info.insert("GMT_OFFSET".to_string(), gmt_offset.to_string());
+/// Validates the memory limit of a run, in bytes.
+fn memory_budget(memory_limit: Option<usize>) -> PyResult<Arc<Budget>> {
+    if memory_limit == Some(0) {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
+            "The memory limit must be at least 1 byte",
+        ));
+    }
+    Ok(Arc::new(Budget::new(memory_limit)))
+}
+
+/// Logs a message of a worker, which has no way to return an error of the logger.
+fn log_from_worker(reporter: &Reporter, level: &str, message: String) {
+    let _ = reporter.log(level, message);
+}
+
+fn join_writer(
+    writing_threads: Vec<thread::JoinHandle<Result<(), String>>>,
+    reporter: &Reporter,
+) -> PyResult<()> {
+    for handle in writing_threads {
+        match handle.join() {
+            Ok(Ok(())) => {
+                reporter.log("debug", "Writing thread completed successfully")?;
             }
-            if let Some(market_message_type) = parts.get(5) {
-                header_info.insert(
-                    "MARKET_MESSAGE_TYPE".to_string(),
-                    market_message_type.to_string(),
-                );
+            Ok(Err(e)) => {
+                return Err(PyErr::new::<pyo3::exceptions::PyIOError, _>(e));
             }
-            continue;
-        } else if parts[4] == "Summary" {
-            in_summary = true;
-            continue;
-        } else if parts[4] == "MapEntry" {
-            in_summary = false;
-            // Start a new row
-            if let Some(row) = current_row.take() {
-                rows.push(row);
+            Err(_e) => {
+                reporter.log("error", "Writing thread panicked. This is very bad :(")?;
+                return Err(PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(
+                    "Writing thread panicked. This is very bad :(",
+                ));
             }
+        }
+    }
+    Ok(())
+}
 
-            let mut new_row = HashMap::new();
+/// Returns the error of the worker that failed the run, if any.
+fn check_failed(progress: &Progress) -> PyResult<()> {
+    match progress.error() {
+        Some(e) => Err(PyErr::new::<pyo3::exceptions::PyIOError, _>(e)),
+        None => Ok(()),
+    }
+}
 
-            if let Some(entry_type) = parts.get(6) {
-                new_row.insert("MAP_ENTRY_TYPE".to_string(), entry_type.to_string());
-            }
+/// Converts a value to Python through its JSON form.
+fn to_python<T: Serialize>(py: Python, value: &T) -> PyResult<PyObject> {
+    let json = serde_json::to_string(value)
+        .map_err(|e| PyErr::new::<pyo3::exceptions::PyValueError, _>(e.to_string()))?;
+    Ok(PyModule::import(py, "json")?
+        .call_method1("loads", (json,))?
+        .unbind())
+}
 
-            if let Some(entry_id) = parts.get(12) {
-                new_row.insert("MAP_ENTRY_KEY".to_string(), entry_id.to_string());
-            }
+/// Metrics of a run, returned by `run`, see `stats::Stats`.
+#[pyclass(name = "Stats", frozen)]
+struct RunStats {
+    stats: Stats,
+}
 
-            current_row = Some(new_row);
-        } else if parts[4] == "FID" {
-            let mut fid_value_index = 8;
-            if !parts[9].is_empty() {
-                fid_value_index = 9;
-            }
-            if let (Some(key), Some(value)) = (parts.get(7), parts.get(fid_value_index)) {
-                if in_summary {
-                    // Add summary info to header_info
-                    header_info.insert(key.to_string(), value.to_string());
-                } else if let Some(ref mut row) = current_row {
-                    row.insert(key.to_string(), value.to_string());
-                }
-            }
-        }
+#[pymethods]
+impl RunStats {
+    #[getter]
+    fn elapsed(&self) -> f64 {
+        self.stats.elapsed
     }
-    // Last row
-    if let Some(row) = current_row.take() {
-        rows.push(row);
+
+    #[getter]
+    fn bytes_read(&self) -> u64 {
+        self.stats.bytes_read
     }
-    // Collect all unique column names
-    let mut column_names: Vec<String> = rows.iter().flat_map(|row| row.keys().cloned()).collect();
-    column_names.sort();
-    column_names.dedup();
 
-    // Create vectors for each column
-    let mut columns: Vec<Column> = Vec::new();
+    #[getter]
+    fn messages_read(&self) -> usize {
+        self.stats.messages_read
+    }
 
-    // Build each column
-    for col_name in &column_names {
-        let values: Vec<String> = rows
-            .iter()
-            .map(|row| row.get(col_name).cloned().unwrap_or_default())
-            .collect();
+    #[getter]
+    fn messages_parsed(&self) -> usize {
+        self.stats.messages_parsed
+    }
 
-        // Create the series for this column
-        columns.push(Column::new(col_name.into(), values));
+    #[getter]
+    fn rows_written(&self) -> usize {
+        self.stats.rows_written
     }
 
-    let new_columns: Vec<Expr> = header_info
-        .iter()
-        .map(|(key, value)| lit(value.clone()).alias(key.clone()))
-        .collect();
+    #[getter]
+    fn bytes_written(&self) -> u64 {
+        self.stats.bytes_written
+    }
 
-    // Create the DataFrame
-    let df = DataFrame::new(columns)?
-        .lazy()
-        .with_columns(new_columns)
-        .collect()?;
+    #[getter]
+    fn stages(&self, py: Python) -> PyResult<PyObject> {
+        to_python(py, &self.stats.stages)
+    }
 
-    Ok(df)
-}
+    #[getter]
+    fn parsing_queue_peak(&self) -> usize {
+        self.stats.parsing_queue_peak
+    }
 
-#[pyfunction]
-fn flatten_market_by_price(message: &str) -> PyResult<PyDataFrame> {
-    let df = flat_market_by_price(message).unwrap();
+    #[getter]
+    fn dataframes_queue_peak(&self) -> usize {
+        self.stats.dataframes_queue_peak
+    }
 
-    // Convert Polars DataFrame to Python PyObject
-    let pydf = PyDataFrame(df);
-    Ok(pydf)
-}
+    #[getter]
+    fn reorder_buffer_peak(&self) -> usize {
+        self.stats.reorder_buffer_peak
+    }
+
+    #[getter]
+    fn parts(&self, py: Python) -> PyResult<PyObject> {
+        to_python(py, &self.stats.parts)
+    }
+
+    #[getter]
+    fn peak_rss(&self) -> Option<u64> {
+        self.stats.peak_rss
+    }
 
-struct IndexedMessage {
-    index: usize,
-    content: String,
+    fn to_dict(&self, py: Python) -> PyResult<PyObject> {
+        to_python(py, &self.stats)
+    }
+
+    fn __repr__(&self) -> String {
+        format!(
+            "Stats(messages_read={}, rows_written={}, bytes_written={}, elapsed={:.3})",
+            self.stats.messages_read,
+            self.stats.rows_written,
+            self.stats.bytes_written,
+            self.stats.elapsed
+        )
+    }
 }
 
-struct IndexedDataFrame {
-    index: usize,
-    data: DataFrame,
+/// Saves the stats of a run to `output_path` if asked to, and returns them to Python.
+fn finish_stats(
+    metrics: &Metrics,
+    output_path: &std::path::Path,
+    write_stats: bool,
+) -> PyResult<RunStats> {
+    let stats = metrics.stats();
+    if write_stats {
+        stats.save(output_path).map_err(|e| {
+            PyErr::new::<pyo3::exceptions::PyIOError, _>(format!(
+                "Failed to save the stats of {:?}: {}",
+                output_path, e
+            ))
+        })?;
+    }
+    Ok(RunStats { stats })
 }
 
 #[pyfunction]
-fn run(path: PathBuf, output_path: PathBuf, py: Python) -> PyResult<bool> {
-    // Get the Python logger
-    let logging = PyModule::import(py, "logging")?;
-    let logger = logging.getattr("getLogger")?.call1(("lobmp",))?;
-
-    if path.extension().and_then(|ext| ext.to_str()) != Some("csv") {
+#[pyo3(signature = (path, output_path, memory_map=false, fid_types=None, book_depth=None, book_interval=None, hive_partitioning=false, compression="zstd", compression_level=None, row_group_size=None, part_size=None, statistics=true, resume=false, tickers=None, fids=None, start=None, end=None, write_stats=false, progress=None, writers=None, ordered=true, memory_limit=None, write_index=false, schema=None, cache_schema=false, output_format="parquet", ipc_compression="uncompressed"))]
+#[allow(clippy::too_many_arguments)]
+fn run(
+    path: PathBuf,
+    output_path: PathBuf,
+    memory_map: bool,
+    fid_types: Option<HashMap<String, String>>,
+    book_depth: Option<usize>,
+    book_interval: Option<&str>,
+    hive_partitioning: bool,
+    compression: &str,
+    compression_level: Option<i32>,
+    row_group_size: Option<usize>,
+    part_size: Option<usize>,
+    statistics: bool,
+    resume: bool,
+    tickers: Option<Vec<String>>,
+    fids: Option<Vec<String>>,
+    start: Option<&str>,
+    end: Option<&str>,
+    write_stats: bool,
+    progress: Option<Py<PyAny>>,
+    writers: Option<usize>,
+    ordered: bool,
+    memory_limit: Option<usize>,
+    write_index: bool,
+    schema: Option<Vec<String>>,
+    cache_schema: bool,
+    output_format: &str,
+    ipc_compression: &str,
+    py: Python,
+) -> PyResult<RunStats> {
+    let reporter = Reporter::new(py, progress)?;
+
+    if !is_csv(&path) {
         return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
-            "The file {:?} is not of type CSV, Only .csv files are supported",
+            "The file {:?} is not of type CSV, Only .csv files are supported, plain or compressed as .csv.gz or .csv.zst",
             path
         )));
     }
@@ -301,263 +632,801 @@ fn run(path: PathBuf, output_path: PathBuf, py: Python) -> PyResult<bool> {
             path, e
         ))
     })?;
-    let mut reader: BufReader<File> = BufReader::new(file);
 
-    logger.call_method1(
-        "info",
-        ("Counting lines in file and recognising possible FIDs...",),
+    let typed = fid_types.is_some();
+    let fid_types = Arc::new(fid_types_from_names(fid_types)?);
+    let mut options = writer_options(
+        hive_partitioning,
+        compression,
+        compression_level,
+        row_group_size,
+        part_size,
+        statistics,
+        writers,
+        ordered,
+        resume,
+        output_format,
+        ipc_compression,
     )?;
-    let mut possible_fids: HashSet<String> = HashSet::new();
-    let mut line_count = 0;
-
-    for line in reader.by_ref().lines() {
-        let str_line = line.unwrap();
-        line_count += 1;
-
-        let parts: Vec<&str> = str_line.split(',').collect();
-        if let Some(s) = parts.get(4) {
-            if *s == "FID" {
-                if let Some(fid_name) = parts.get(7) {
-                    possible_fids.insert(fid_name.to_string());
-                }
+    let filter = filter_options(tickers, fids, start, end)?;
+    let budget = memory_budget(memory_limit)?;
+    let pinned = schema.is_some();
+    options.schema = pinned_schema(schema, cache_schema)?;
+    if write_index {
+        check_indexable(&path)?;
+    }
+    let book = match book_depth {
+        Some(_) if resume => {
+            return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
+                "Book reconstruction can not be resumed",
+            ));
+        }
+        Some(_) if !ordered => {
+            return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
+                "Book reconstruction needs the messages in order",
+            ));
+        }
+        Some(_) if options.format != OutputFormat::Parquet => {
+            return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
+                "Book snapshots are only written as Parquet",
+            ));
+        }
+        Some(_) if pinned || cache_schema => {
+            return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
+                "Book snapshots have a schema of their own, it can not be pinned nor cached",
+            ));
+        }
+        Some(_) if hive_partitioning || memory_map || typed => {
+            return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
+                "Book reconstruction can not be used with hive_partitioning, memory_map nor fid_types",
+            ));
+        }
+        Some(depth) => Some((depth, book_options(depth, book_interval)?)),
+        None => None,
+    };
+
+    let metrics = Arc::new(Metrics::default());
+    let progress = Arc::new(Progress::default());
+    progress.start(file.metadata()?.len());
+    // Nothing below needs the GIL, the logs and the progress reports take it when they need it
+    py.allow_threads(|| {
+        reporter.watch(&progress, || match book {
+            Some((depth, interval)) => run_book(
+                file,
+                output_path.clone(),
+                depth,
+                interval,
+                filter,
+                options,
+                &metrics,
+                &progress,
+                &budget,
+                &reporter,
+            ),
+            None => {
+                let job = BatchJob {
+                    input: path.clone(),
+                    output: output_path.clone(),
+                    metrics: metrics.clone(),
+                    progress: progress.clone(),
+                };
+                run_job(
+                    job,
+                    memory_map,
+                    resume,
+                    cache_schema,
+                    fid_types,
+                    filter,
+                    options,
+                    budget.clone(),
+                    &reporter,
+                )
             }
+        })?;
+        if write_index {
+            // A second pass, over the input the run just left in the page cache
+            reporter.log("info", format!("Indexing {:?}...", path))?;
+            let index = Index::build_file(&path)?;
+            index.save(&index_path(&path))?;
         }
-    }
-    possible_fids.extend([
-        "TICKER".to_string(),
-        "TIMESTAMP".to_string(),
-        "GMT_OFFSET".to_string(),
-        "MARKET_MESSAGE_TYPE".to_string(),
-        "MAP_ENTRY_TYPE".to_string(),
-        "MAP_ENTRY_KEY".to_string(),
-    ]);
+        Ok::<_, PyErr>(())
+    })?;
+    finish_stats(&metrics, &output_path, write_stats)
+}
 
-    reader.seek(SeekFrom::Start(0))?;
+/// Converts a file into parts on the pool of `run_batch`, resuming the output
+/// if asked to.
+#[allow(clippy::too_many_arguments)]
+fn run_job(
+    job: BatchJob,
+    memory_map: bool,
+    resume: bool,
+    cache_schema: bool,
+    fid_types: Arc<FidTypes>,
+    filter: Arc<Filter>,
+    options: WriterOptions,
+    budget: Arc<Budget>,
+    reporter: &Reporter,
+) -> PyResult<()> {
+    let mut result = Ok(());
+    run_batch(
+        std::slice::from_ref(&job),
+        memory_map,
+        resume,
+        // The stats of a run are saved by `run`, which also returns them
+        false,
+        cache_schema,
+        fid_types,
+        filter,
+        options,
+        budget,
+        &|level: &str, message: String| log_from_worker(reporter, level, message),
+        |_, job_result| result = job_result,
+    );
+    result.map_err(|e| match e {
+        JobError::Invalid(e) => PyErr::new::<pyo3::exceptions::PyValueError, _>(e),
+        JobError::Failed(e) => PyErr::new::<pyo3::exceptions::PyIOError, _>(e),
+    })
+}
 
-    logger.call_method1("info", (format!("Found {} lines in file", line_count),))?;
+/// Reconstructs the order books of a file and writes their snapshots.
+#[allow(clippy::too_many_arguments)]
+fn run_book(
+    file: File,
+    output_path: PathBuf,
+    depth: usize,
+    interval: Option<i64>,
+    filter: Arc<Filter>,
+    options: WriterOptions,
+    metrics: &Arc<Metrics>,
+    progress: &Arc<Progress>,
+    budget: &Arc<Budget>,
+    reporter: &Reporter,
+) -> PyResult<()> {
+    let mut input = Input::new(file)?;
 
     let num_cpus: usize = available_parallelism().unwrap().get();
-    logger.call_method1("debug", (format!("Using {} CPUs", num_cpus),))?;
+    reporter.log("debug", format!("Using {} CPUs", num_cpus))?;
 
     let (tx_parsing, rx_parsing) = bounded::<IndexedMessage>(2 * num_cpus);
-    let (tx_dataframes, rx_dataframes) = bounded::<IndexedDataFrame>(2 * num_cpus);
+    let (tx_messages, rx_messages) = bounded::<IndexedBookMessage>(2 * num_cpus);
 
-    let rx_parsing_run = rx_parsing.clone();
-    let (tx_dataframes_run, rx_dataframes_run) = (tx_dataframes.clone(), rx_dataframes.clone());
-
-    let mut parsing_threads = Vec::new();
-    {
-        for _i in 0..num_cpus {
+    // Messages only need their map entries, so parsing them is cheap and the
+    // books are replayed in order on the writing thread. Only the raw messages
+    // are charged to the budget, the parsed ones are much smaller
+    let parsing_threads: Vec<_> = (0..num_cpus)
+        .map(|_| {
             let rx_parsing = rx_parsing.clone();
-            let tx_dataframes = tx_dataframes.clone();
-            let parsing_handle = thread::spawn(move || {
-                // Process messages until the channel is closed
+            let tx_messages = tx_messages.clone();
+            let (metrics, progress, budget) = (metrics.clone(), progress.clone(), budget.clone());
+            thread::spawn(move || {
+                let mut timer = Timer::new();
                 while let Ok(indexed_message) = rx_parsing.recv() {
-                    let index = indexed_message.index;
-                    let message = indexed_message.content;
-                    match flat_market_by_price(message.as_str()) {
-                        Ok(df) => {
-                            // Send the DataFrame to the output channel
-                            let indexed_df = IndexedDataFrame { index, data: df };
-                            if tx_dataframes.send(indexed_df).is_err() {
-                                println!("Dataframes queue was closed before the parsing queue was finished...");
-                                return;
-                            }
-                        }
+                    timer.idle();
+                    let raw_bytes = indexed_message.content.len();
+                    if progress.has_failed() {
+                        // The reader stops soon, the messages it already sent are dropped
+                        budget.release(raw_bytes);
+                        continue;
+                    }
+                    let message = match std::str::from_utf8(&indexed_message.content) {
+                        Ok(message) => message,
                         Err(e) => {
-                            println!("Error processing message on processing thread: {}", e);
-                            return;
+                            progress.fail(format!(
+                                "The message at byte {} of the input is not valid UTF-8: {}",
+                                indexed_message.offset, e
+                            ));
+                            budget.release(raw_bytes);
+                            continue;
                         }
+                    };
+                    let indexed_book_message = IndexedBookMessage {
+                        index: indexed_message.index,
+                        message: parse_message(message),
+                    };
+                    budget.release(raw_bytes);
+                    timer.busy();
+                    if tx_messages.send(indexed_book_message).is_err() {
+                        progress.fail(
+                            "The book writer stopped before every message was applied".to_string(),
+                        );
                     }
+                    timer.idle();
+                    metrics.dataframes_queue.record(tx_messages.len());
                 }
-                drop(tx_dataframes);
-            });
-
-            parsing_threads.push(parsing_handle);
+                timer.idle();
+                timer.finish(&metrics.parse);
+            })
+        })
+        .collect();
+    drop(rx_parsing);
+    drop(tx_messages);
+    let input_end = InputEnd::default();
+    let writing_threads = vec![spawn_book_writer(
+        rx_messages,
+        output_path,
+        depth,
+        interval,
+        options,
+        metrics.clone(),
+        progress.clone(),
+        input_end.clone(),
+    )];
+
+    reporter.log("info", "Starting book reconstruction...")?;
+
+    // Only the tickers and the time window apply to the books
+    let read = for_each_message(&mut input, 0, &filter, progress, metrics, |message| {
+        budget.acquire(message.content.len());
+        let sent = tx_parsing.send(message);
+        metrics.parsing_queue.record(tx_parsing.len());
+        sent.map_err(|_| "Parsing queue was closed".to_string())
+    });
+    match read {
+        Ok(sent) => {
+            let _ = input_end.set((0, sent));
         }
+        // The threads still stop and are joined before the error is raised
+        Err(e) => progress.fail(e),
     }
-    let mut writing_threads = Vec::new();
-    {
-        let dataframe_handler = thread::spawn(move || {
-            const BATCH_SIZE: usize = 16384;
-            let mut dfs: Vec<LazyFrame> = Vec::new();
-            let mut next_index_to_write: usize = 0;
-            let mut dataframes_map: HashMap<usize, LazyFrame> = HashMap::new();
-            let mut batch_counter: usize = 0;
-
-            let mut expected_columns: Vec<&str> =
-                possible_fids.iter().map(|s| s.as_str()).collect();
-            expected_columns.sort();
-
-            // Ensure the output directory exists
-            fs::create_dir_all(&output_path).expect("Failed to create output directory");
-
-            while let Ok(indexed_df) = rx_dataframes.recv() {
-                let df_with_columns = indexed_df.data.clone().lazy();
-                let mut df_with_all_columns =
-                    expected_columns
-                        .iter()
-                        .fold(df_with_columns, |acc, &col_name| {
-                            // Check if column exists
-                            if indexed_df.data.schema().get(col_name).is_some() {
-                                acc
-                            } else {
-                                // Add missing column with empty string values
-                                acc.with_column(lit("").alias(col_name))
-                            }
-                        });
-                df_with_all_columns = df_with_all_columns
-                    .select(expected_columns.iter().map(|&c| col(c)).collect::<Vec<_>>());
-                dataframes_map.insert(indexed_df.index, df_with_all_columns);
-
-                while dataframes_map.contains_key(&next_index_to_write) && dfs.len() < BATCH_SIZE {
-                    dfs.push(dataframes_map.remove(&next_index_to_write).unwrap());
-                    next_index_to_write += 1;
-                }
+    drop(tx_parsing);
 
-                if dfs.len() >= BATCH_SIZE {
-                    let file_path = output_path.join(format!("part-{:06}.parquet", batch_counter));
-                    let file = File::create(&file_path).expect("Failed to create batch file");
-                    let writer = ParquetWriter::new(BufWriter::new(file));
-                    let mut batch_df = concat(dfs.drain(..), UnionArgs::default())
-                        .unwrap()
-                        .collect()
-                        .unwrap();
+    for handle in parsing_threads {
+        if handle.join().is_err() {
+            reporter.log("error", "Parsing thread panicked. This is very bad :(")?;
+            return Err(PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(
+                "Parsing thread panicked. This is very bad :(",
+            ));
+        }
+    }
 
-                    writer.finish(&mut batch_df).expect("Failed to write batch");
-                    batch_counter += 1;
-                }
-            }
+    join_writer(writing_threads, reporter)?;
+    check_failed(progress)
+}
 
-            // Final flush
-            while let Some(lf) = dataframes_map.remove(&next_index_to_write) {
-                dfs.push(lf);
-                next_index_to_write += 1;
-            }
+#[pyfunction]
+#[pyo3(signature = (paths, output_paths, memory_map=false, fid_types=None, hive_partitioning=false, compression="zstd", compression_level=None, row_group_size=None, part_size=None, statistics=true, resume=false, tickers=None, fids=None, start=None, end=None, write_stats=false, writers=None, ordered=true, memory_limit=None, schema=None, cache_schema=false, output_format="parquet", ipc_compression="uncompressed"))]
+#[allow(clippy::too_many_arguments)]
+fn run_many(
+    paths: Vec<PathBuf>,
+    output_paths: Vec<PathBuf>,
+    memory_map: bool,
+    fid_types: Option<HashMap<String, String>>,
+    hive_partitioning: bool,
+    compression: &str,
+    compression_level: Option<i32>,
+    row_group_size: Option<usize>,
+    part_size: Option<usize>,
+    statistics: bool,
+    resume: bool,
+    tickers: Option<Vec<String>>,
+    fids: Option<Vec<String>>,
+    start: Option<&str>,
+    end: Option<&str>,
+    write_stats: bool,
+    writers: Option<usize>,
+    ordered: bool,
+    memory_limit: Option<usize>,
+    schema: Option<Vec<String>>,
+    cache_schema: bool,
+    output_format: &str,
+    ipc_compression: &str,
+    py: Python,
+) -> PyResult<Vec<RunStats>> {
+    let reporter = Reporter::new(py, None)?;
+
+    if paths.len() != output_paths.len() {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+            "Got {} input files but {} output directories",
+            paths.len(),
+            output_paths.len()
+        )));
+    }
+    for path in &paths {
+        if !is_csv(path) {
+            return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+                "The file {:?} is not of type CSV, Only .csv files are supported, plain or compressed as .csv.gz or .csv.zst",
+                path
+            )));
+        }
+        fs::metadata(path).map_err(|e| {
+            PyErr::new::<pyo3::exceptions::PyIOError, _>(format!(
+                "Failed to open file {:?}: {}",
+                path, e
+            ))
+        })?;
+    }
 
-            if !dfs.is_empty() {
-                let file_path = output_path.join(format!("part-{:06}.parquet", batch_counter));
-                let file = File::create(&file_path).expect("Failed to create final batch file");
-                let writer = ParquetWriter::new(BufWriter::new(file));
-                let mut final_df = concat(dfs, UnionArgs::default())
-                    .unwrap()
-                    .collect()
-                    .unwrap();
-
-                writer
-                    .finish(&mut final_df)
-                    .expect("Failed to write final batch");
-            }
-        });
+    let fid_types = Arc::new(fid_types_from_names(fid_types)?);
+    let mut options = writer_options(
+        hive_partitioning,
+        compression,
+        compression_level,
+        row_group_size,
+        part_size,
+        statistics,
+        writers,
+        ordered,
+        resume,
+        output_format,
+        ipc_compression,
+    )?;
+    let filter = filter_options(tickers, fids, start, end)?;
+    let budget = memory_budget(memory_limit)?;
+    options.schema = pinned_schema(schema, cache_schema)?;
+    let jobs: Vec<BatchJob> = paths
+        .into_iter()
+        .zip(output_paths)
+        .map(|(input, output)| BatchJob {
+            input,
+            output,
+            metrics: Arc::default(),
+            progress: Arc::default(),
+        })
+        .collect();
 
-        writing_threads.push(dataframe_handler);
+    reporter.log(
+        "info",
+        format!("Starting processing of {} files...", jobs.len()),
+    )?;
+    let mut finished: usize = 0;
+    let mut failures: Vec<String> = Vec::new();
+    let mut logged: PyResult<()> = Ok(());
+    py.allow_threads(|| {
+        run_batch(
+            &jobs,
+            memory_map,
+            resume,
+            write_stats,
+            cache_schema,
+            fid_types,
+            filter,
+            options,
+            budget,
+            &|level: &str, message: String| log_from_worker(&reporter, level, message),
+            |i, result| {
+                finished += 1;
+                let (level, message) = match result.map_err(|e| e.to_string()) {
+                    Ok(()) => (
+                        "info",
+                        format!(
+                            "Processed {:?} ({} of {} files)",
+                            jobs[i].input,
+                            finished,
+                            jobs.len()
+                        ),
+                    ),
+                    Err(e) => {
+                        failures.push(e.clone());
+                        ("error", e)
+                    }
+                };
+                if logged.is_ok() {
+                    logged = reporter.log(level, message);
+                }
+            },
+        );
+    });
+    logged?;
+
+    if !failures.is_empty() {
+        return Err(PyErr::new::<pyo3::exceptions::PyIOError, _>(
+            failures.join("\n"),
+        ));
     }
+    // An output that was already complete reads nothing, so its stats are empty
+    Ok(jobs
+        .iter()
+        .map(|job| RunStats {
+            stats: job.metrics.stats(),
+        })
+        .collect())
+}
 
-    let start_time: time::Instant = time::Instant::now();
-    logger.call_method1("info", ("Starting file processing...",))?;
+/// Iterator over the batches of a file, produced by a pipeline running in the background.
+#[pyclass]
+struct BatchIterator {
+    rx_batches: crossbeam::channel::Receiver<Batch>,
+    handle: Option<thread::JoinHandle<()>>,
+}
 
-    let mut next_message: String = String::from("");
-    let mut found_first: bool = false;
-    let mut message_index = 0;
-    for (i, line) in reader.lines().enumerate() {
-        let line = line.map_err(|e| {
-            PyErr::new::<pyo3::exceptions::PyIOError, _>(format!("Error reading line: {}", e))
-        })?;
-        if line.contains("Market By Price") {
-            if !next_message.is_empty() && found_first {
-                let indexed_message = IndexedMessage {
-                    index: message_index,
-                    content: next_message.clone(),
-                };
+#[pymethods]
+impl BatchIterator {
+    fn __iter__(slf: PyRef<'_, Self>) -> PyRef<'_, Self> {
+        slf
+    }
 
-                tx_parsing.send(indexed_message).unwrap();
-                message_index += 1;
-                next_message.clear();
-            }
-            if !found_first {
-                found_first = true;
+    fn __next__(&mut self, py: Python) -> PyResult<Option<PyDataFrame>> {
+        let rx_batches = self.rx_batches.clone();
+        // Wait for the next batch without holding the GIL
+        match py.allow_threads(move || rx_batches.recv()) {
+            Ok(Ok(df)) => Ok(Some(PyDataFrame(df))),
+            Ok(Err(e)) => Err(PyErr::new::<pyo3::exceptions::PyIOError, _>(e)),
+            Err(_) => {
+                if let Some(handle) = self.handle.take() {
+                    if handle.join().is_err() {
+                        return Err(PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(
+                            "Parsing thread panicked. This is very bad :(",
+                        ));
+                    }
+                }
+                Ok(None)
             }
         }
-        if found_first {
-            next_message.push_str(&line);
-            next_message.push('\n');
-        }
-        if i > 0 && i % 100000 == 0 {
-            let elapsed_time: time::Duration = time::Instant::now() - start_time;
-            let estimated_total_time = (elapsed_time / i.try_into().unwrap()) * line_count;
-            let estimated_remaining = estimated_total_time - elapsed_time;
-            logger.call_method1(
-                "info",
-                (format!(
-                    "Processed: {} lines. Estimated {:02?} remaining",
-                    i, estimated_remaining
-                ),),
-            )?;
-        }
     }
+}
 
-    // Send the last message if there is one
-    if !next_message.is_empty() && found_first {
-        let indexed_message = IndexedMessage {
-            index: message_index,
-            content: next_message.clone(),
-        };
-
-        if let Err(e) = tx_parsing.send(indexed_message) {
-            logger.call_method1(
-                "error",
-                (format!(
-                    "Failed to send last message to the parsing queue: {}",
-                    e
-                ),),
-            )?;
-        }
+#[pyfunction]
+#[pyo3(signature = (path, batch_rows=65536, memory_map=false, fid_types=None, tickers=None, fids=None, start=None, end=None))]
+#[allow(clippy::too_many_arguments)]
+fn iter_batches(
+    path: PathBuf,
+    batch_rows: usize,
+    memory_map: bool,
+    fid_types: Option<HashMap<String, String>>,
+    tickers: Option<Vec<String>>,
+    fids: Option<Vec<String>>,
+    start: Option<&str>,
+    end: Option<&str>,
+) -> PyResult<BatchIterator> {
+    if !is_csv(&path) {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+            "The file {:?} is not of type CSV, Only .csv files are supported, plain or compressed as .csv.gz or .csv.zst",
+            path
+        )));
     }
-
-    // Safely close parsing job
-    while !tx_parsing.is_empty() && !rx_parsing_run.is_empty() {
-        sleep(time::Duration::from_millis(10));
+    if batch_rows == 0 {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
+            "The batch size must be at least 1 row",
+        ));
     }
-    drop(tx_parsing);
-    drop(rx_parsing_run);
+    File::open(&path).map_err(|e| {
+        PyErr::new::<pyo3::exceptions::PyIOError, _>(format!(
+            "Failed to open file {:?}: {}",
+            path, e
+        ))
+    })?;
 
-    for handle in parsing_threads {
-        match handle.join() {
-            Ok(_) => {
-                logger.call_method1("debug", ("Parsing thread completed successfully",))?;
-            }
-            Err(_e) => {
-                logger.call_method1("error", ("Parsing thread panicked. This is very bad :(",))?;
-                return Err(PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(
-                    "Parsing thread panicked. This is very bad :(",
-                ));
-            }
-        }
+    let fid_types = Arc::new(fid_types_from_names(fid_types)?);
+    let filter = filter_options(tickers, fids, start, end)?;
+    let (rx_batches, handle) = spawn_stream(path, memory_map, fid_types, filter, batch_rows);
+    Ok(BatchIterator {
+        rx_batches,
+        handle: Some(handle),
+    })
+}
+
+/// Checks that a file is a plain CSV file, whose messages can be read with seeks.
+fn check_indexable(path: &Path) -> PyResult<()> {
+    let mut file = File::open(path).map_err(|e| {
+        PyErr::new::<pyo3::exceptions::PyIOError, _>(format!(
+            "Failed to open file {:?}: {}",
+            path, e
+        ))
+    })?;
+    if !is_csv(path) || input::compression(&mut file)? != Compression::None {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+            "The file {:?} can not be indexed, only plain .csv files can be read with seeks",
+            path
+        )));
     }
+    Ok(())
+}
+
+/// Returns the index of a plain CSV file, building it if it is missing or stale.
+fn open_index(path: &Path) -> PyResult<Index> {
+    check_indexable(path)?;
+    Index::open_or_build(path).map_err(|e| {
+        PyErr::new::<pyo3::exceptions::PyIOError, _>(format!(
+            "Failed to index file {:?}: {}",
+            path, e
+        ))
+    })
+}
+
+/// Returns the index entries of the messages of a ticker or time window.
+fn select_entries(
+    index: &Index,
+    tickers: Option<Vec<String>>,
+    start: Option<&str>,
+    end: Option<&str>,
+) -> PyResult<Vec<Entry>> {
+    let filter = filter_options(tickers, None, start, end)?;
+    Ok(index.select(&filter).copied().collect())
+}
+
+#[pyfunction]
+fn build_index(path: PathBuf, py: Python) -> PyResult<usize> {
+    check_indexable(&path)?;
+    py.allow_threads(|| -> std::io::Result<usize> {
+        let index = Index::build_file(&path)?;
+        index.save(&index_path(&path))?;
+        Ok(index.entries.len())
+    })
+    .map_err(|e| {
+        PyErr::new::<pyo3::exceptions::PyIOError, _>(format!(
+            "Failed to index file {:?}: {}",
+            path, e
+        ))
+    })
+}
+
+#[pyfunction]
+fn read_index(path: PathBuf, py: Python) -> PyResult<PyDataFrame> {
+    let index = py.allow_threads(|| open_index(&path))?;
+    let entries = &index.entries;
+    let tickers: Vec<&str> = entries
+        .iter()
+        .map(|entry| index.tickers[entry.ticker as usize].as_str())
+        .collect();
+    let columns = vec![
+        Series::new(
+            "OFFSET".into(),
+            entries.iter().map(|entry| entry.offset).collect::<Vec<_>>(),
+        )
+        .into_column(),
+        Series::new(
+            "LENGTH".into(),
+            entries.iter().map(|entry| entry.length).collect::<Vec<_>>(),
+        )
+        .into_column(),
+        Series::new("TICKER".into(), tickers).into_column(),
+        Int64Chunked::from_iter_options(
+            "TIMESTAMP".into(),
+            entries.iter().map(|entry| entry.timestamp),
+        )
+        .into_datetime(TimeUnit::Nanoseconds, None)
+        .into_column(),
+        Series::new(
+            "REFRESH".into(),
+            entries
+                .iter()
+                .map(|entry| entry.refresh)
+                .collect::<Vec<_>>(),
+        )
+        .into_column(),
+    ];
+    DataFrame::new(columns)
+        .map(PyDataFrame)
+        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e.to_string()))
+}
+
+#[pyfunction]
+fn read_ipc_index(path: PathBuf, py: Python) -> PyResult<PyDataFrame> {
+    let batches = py
+        .allow_threads(|| writer::read_ipc_index(&path))
+        .map_err(PyErr::new::<pyo3::exceptions::PyIOError, _>)?;
+    let tickers: Vec<(Option<&str>, Option<&str>)> = batches
+        .iter()
+        .map(|batch| match &batch.tickers {
+            Some((min, max)) => (Some(min.as_str()), Some(max.as_str())),
+            None => (None, None),
+        })
+        .collect();
+    let (min_tickers, max_tickers): (Vec<_>, Vec<_>) = tickers.into_iter().unzip();
+    let (min_timestamps, max_timestamps): (Vec<_>, Vec<_>) = batches
+        .iter()
+        .map(|batch| (batch.timestamps.map(|t| t.0), batch.timestamps.map(|t| t.1)))
+        .unzip();
+    let columns = vec![
+        Series::new(
+            "OFFSET".into(),
+            batches
+                .iter()
+                .map(|batch| batch.offset as u64)
+                .collect::<Vec<_>>(),
+        )
+        .into_column(),
+        Series::new(
+            "ROWS".into(),
+            batches
+                .iter()
+                .map(|batch| batch.rows as u64)
+                .collect::<Vec<_>>(),
+        )
+        .into_column(),
+        Series::new("MIN_TICKER".into(), min_tickers).into_column(),
+        Series::new("MAX_TICKER".into(), max_tickers).into_column(),
+        Int64Chunked::from_iter_options("MIN_TIMESTAMP".into(), min_timestamps.into_iter())
+            .into_datetime(TimeUnit::Nanoseconds, None)
+            .into_column(),
+        Int64Chunked::from_iter_options("MAX_TIMESTAMP".into(), max_timestamps.into_iter())
+            .into_datetime(TimeUnit::Nanoseconds, None)
+            .into_column(),
+    ];
+    DataFrame::new(columns)
+        .map(PyDataFrame)
+        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e.to_string()))
+}
 
-    // Safely close writing job
-    while !tx_dataframes_run.is_empty() && !rx_dataframes_run.is_empty() {
-        sleep(time::Duration::from_millis(10));
+#[pyfunction]
+#[pyo3(name = "compact", signature = (output_path, part_size=None, row_group_size=None, compression="zstd", compression_level=None, statistics=true, memory_limit=None))]
+#[allow(clippy::too_many_arguments)]
+fn compact_output(
+    output_path: PathBuf,
+    part_size: Option<usize>,
+    row_group_size: Option<usize>,
+    compression: &str,
+    compression_level: Option<i32>,
+    statistics: bool,
+    memory_limit: Option<usize>,
+    py: Python,
+) -> PyResult<usize> {
+    let writer = writer_options(
+        false,
+        compression,
+        compression_level,
+        Some(row_group_size.unwrap_or(DEFAULT_COMPACT_ROW_GROUP_SIZE)),
+        part_size,
+        statistics,
+        None,
+        true,
+        false,
+        "parquet",
+        "uncompressed",
+    )?;
+    if memory_limit == Some(0) {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
+            "The memory limit must be at least 1 byte",
+        ));
+    }
+    let manifest = py
+        .allow_threads(|| {
+            compact::recover(&output_path)?;
+            Manifest::load(&output_path)
+        })
+        .map_err(PyErr::new::<pyo3::exceptions::PyIOError, _>)?
+        .ok_or_else(|| {
+            PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+                "{:?} has no manifest, it is not the output of a run",
+                output_path
+            ))
+        })?;
+    if !manifest.complete {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+            "The output {:?} is not complete, resume its run before compacting it",
+            output_path
+        )));
     }
-    drop(tx_dataframes_run);
-    drop(tx_dataframes);
+    if manifest.format != OutputFormat::Parquet {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
+            "Only Parquet outputs can be compacted",
+        ));
+    }
+    let options = CompactOptions {
+        part_size: writer.part_size,
+        memory_limit: memory_limit.unwrap_or(DEFAULT_COMPACT_MEMORY),
+        writer,
+    };
+    // The categorical columns of the parts are combined
+    enable_string_cache();
+    py.allow_threads(|| compact::compact(&output_path, &manifest, &options))
+        .map_err(PyErr::new::<pyo3::exceptions::PyIOError, _>)
+}
 
-    logger.call_method1("debug", ("Writing queue is empty!",))?;
+#[pyfunction]
+#[pyo3(signature = (path, tickers=None, start=None, end=None))]
+fn extract_messages(
+    path: PathBuf,
+    tickers: Option<Vec<String>>,
+    start: Option<&str>,
+    end: Option<&str>,
+    py: Python,
+) -> PyResult<Vec<String>> {
+    let index = py.allow_threads(|| open_index(&path))?;
+    let entries = select_entries(&index, tickers, start, end)?;
+    py.allow_threads(|| -> PyResult<Vec<String>> {
+        let mut file = File::open(&path)?;
+        read_messages(&mut file, &entries)?
+            .into_iter()
+            .map(|message| {
+                String::from_utf8(message).map_err(|e| {
+                    PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+                        "A message of {:?} is not valid UTF-8: {}",
+                        path, e
+                    ))
+                })
+            })
+            .collect()
+    })
+}
 
-    for handle in writing_threads {
-        match handle.join() {
-            Ok(_) => {
-                logger.call_method1("debug", ("Writing thread completed successfully",))?;
-            }
-            Err(_e) => {
-                logger.call_method1("error", ("Writing thread panicked. This is very bad :(",))?;
-                return Err(PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(
-                    "Writing thread panicked. This is very bad :(",
-                ));
-            }
-        }
+#[pyfunction]
+#[pyo3(signature = (path, tickers=None, start=None, end=None, fid_types=None))]
+fn flatten_messages(
+    path: PathBuf,
+    tickers: Option<Vec<String>>,
+    start: Option<&str>,
+    end: Option<&str>,
+    fid_types: Option<HashMap<String, String>>,
+    py: Python,
+) -> PyResult<PyDataFrame> {
+    let fid_types = Arc::new(fid_types_from_names(fid_types)?);
+    let index = py.allow_threads(|| open_index(&path))?;
+    let entries = select_entries(&index, tickers, start, end)?;
+
+    // Every worker seeks to the messages of its own chunk and parses them
+    let num_cpus: usize = available_parallelism().map(|n| n.get()).unwrap_or(1);
+    let chunk_size = entries.len().div_ceil(num_cpus).max(1);
+    let parsed: Vec<PyResult<Vec<DataFrame>>> = py.allow_threads(|| {
+        thread::scope(|s| {
+            let handles: Vec<_> = entries
+                .chunks(chunk_size)
+                .map(|chunk| {
+                    let (path, fid_types) = (&path, fid_types.clone());
+                    s.spawn(move || -> PyResult<Vec<DataFrame>> {
+                        let mut file = File::open(path)?;
+                        let mut parser = Parser::new(fid_types);
+                        read_messages(&mut file, chunk)?
+                            .iter()
+                            .map(|message| {
+                                let message = std::str::from_utf8(message).map_err(|e| {
+                                    PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+                                        "A message of {:?} is not valid UTF-8: {}",
+                                        path, e
+                                    ))
+                                })?;
+                                parser.market_by_price(message).map_err(|e| {
+                                    PyErr::new::<pyo3::exceptions::PyValueError, _>(e.to_string())
+                                })
+                            })
+                            .collect()
+                    })
+                })
+                .collect();
+            handles
+                .into_iter()
+                .map(|handle| handle.join().expect("Parsing thread panicked"))
+                .collect()
+        })
+    });
+
+    let mut dfs: Vec<DataFrame> = Vec::with_capacity(entries.len());
+    for chunk in parsed {
+        dfs.extend(chunk?);
+    }
+    py.allow_threads(|| concat_discovered(dfs, &fid_types))
+        .map(PyDataFrame)
+        .map_err(|e| PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(e.to_string()))
+}
+
+#[pyfunction]
+#[pyo3(signature = (path, size, tickers=50, refresh_ratio=0.001, map_entries=4, book_depth=20, seed=0))]
+#[allow(clippy::too_many_arguments)]
+fn generate_messages(
+    py: Python,
+    path: PathBuf,
+    size: u64,
+    tickers: usize,
+    refresh_ratio: f64,
+    map_entries: usize,
+    book_depth: usize,
+    seed: u64,
+) -> PyResult<usize> {
+    if !is_csv(&path) {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+            "The file {:?} is not of type CSV, Only .csv files are supported, plain or compressed as .csv.gz or .csv.zst",
+            path
+        )));
     }
-    Ok(true)
+    let options = SyntheticOptions {
+        tickers,
+        refresh_ratio,
+        map_entries,
+        book_depth,
+        seed,
+    };
+    options
+        .validate()
+        .map_err(PyErr::new::<pyo3::exceptions::PyValueError, _>)?;
+
+    py.allow_threads(|| write_file(&path, options, size))
+        .map_err(|e| {
+            PyErr::new::<pyo3::exceptions::PyIOError, _>(format!(
+                "Failed to write file {:?}: {}",
+                path, e
+            ))
+        })
 }
 
 #[pymodule]
@@ -566,6 +1435,19 @@ fn _lobmp(_py: Python, m: &Bound<'_, PyModule>) -> PyResult<()> {
     m.add_function(wrap_pyfunction!(extract_fids, m)?)?;
     m.add_function(wrap_pyfunction!(flatten_map_entry, m)?)?;
     m.add_function(wrap_pyfunction!(flatten_market_by_price, m)?)?;
+    m.add_function(wrap_pyfunction!(flatten_market_by_price_many, m)?)?;
     m.add_function(wrap_pyfunction!(run, m)?)?;
+    m.add_function(wrap_pyfunction!(run_many, m)?)?;
+    m.add_function(wrap_pyfunction!(reconstruct_book, m)?)?;
+    m.add_function(wrap_pyfunction!(iter_batches, m)?)?;
+    m.add_class::<BatchIterator>()?;
+    m.add_class::<RunStats>()?;
+    m.add_function(wrap_pyfunction!(generate_messages, m)?)?;
+    m.add_function(wrap_pyfunction!(build_index, m)?)?;
+    m.add_function(wrap_pyfunction!(read_index, m)?)?;
+    m.add_function(wrap_pyfunction!(read_ipc_index, m)?)?;
+    m.add_function(wrap_pyfunction!(compact_output, m)?)?;
+    m.add_function(wrap_pyfunction!(extract_messages, m)?)?;
+    m.add_function(wrap_pyfunction!(flatten_messages, m)?)?;
     Ok(())
 }
@@ -0,0 +1,224 @@
+//! Checkpoint manifest of the parts written to an output directory.
+//!
+//! The writer saves `_manifest.json` every time it flushes a part. It records,
+//! for every part, the messages and input bytes it holds and a CRC-32 of the
+//! file, and the first message (and its input byte offset) that is not in a
+//! part yet. A resumed run verifies the parts listed in the manifest, removes
+//! the parts written after it was saved and starts reading the input again at
+//! that offset.
+//!
+//! The parts of an unordered output hold messages in the order they were
+//! parsed, so there is no such first message and the output can not be
+//! resumed. Their manifest records the range of `MESSAGE_INDEX` of every part.
+//!
+//! When both Parquet and IPC files are written, a part is listed by its
+//! Parquet file, and the CRC-32 of the IPC file next to it is recorded too.
+//!
+//! A compacted output keeps its manifest, with the compacted parts, which are
+//! not message ranges any more; it is complete, so it is never resumed.
+
+use crate::writer::{ipc_sibling, OutputFormat};
+use flate2::Crc;
+use serde::{Deserialize, Serialize};
+use std::fs::{self, File};
+use std::io::{self, Read};
+use std::path::{Path, PathBuf};
+
+pub const MANIFEST_FILE: &str = "_manifest.json";
+
+/// A part file and the messages it holds.
+#[derive(Clone, Debug, PartialEq, Serialize, Deserialize)]
+pub struct Part {
+    /// Path of the part, relative to the output directory
+    pub file: String,
+    pub first_message: usize,
+    pub last_message: usize,
+    /// Input byte offset of the first message
+    pub start_offset: usize,
+    /// Input byte offset right after the last message
+    pub end_offset: usize,
+    pub rows: usize,
+    pub columns: usize,
+    pub crc32: u32,
+    /// CRC-32 of the IPC file next to the part, when both formats are written
+    #[serde(default, skip_serializing_if = "Option::is_none")]
+    pub ipc_crc32: Option<u32>,
+    /// Smallest and largest `MESSAGE_INDEX` of a part of an unordered output
+    #[serde(default, skip_serializing_if = "Option::is_none")]
+    pub message_indices: Option<(u64, u64)>,
+}
+
+impl Part {
+    /// Directory of the part relative to the output directory, its partition.
+    pub fn partition(&self) -> PathBuf {
+        Path::new(&self.file)
+            .parent()
+            .map(Path::to_path_buf)
+            .unwrap_or_default()
+    }
+}
+
+#[derive(Clone, Debug, Default, PartialEq, Serialize, Deserialize)]
+pub struct Manifest {
+    /// Size of the input file, compressed or not, to detect a different input
+    pub input_size: u64,
+    pub hive_partitioning: bool,
+    /// Files written for every part
+    #[serde(default)]
+    pub format: OutputFormat,
+    /// Every message before this one is in `parts`
+    pub messages: usize,
+    /// Input byte offset of message `messages`, where a resumed run starts reading
+    pub offset: usize,
+    /// Every message is written and every part has the final schema
+    pub complete: bool,
+    /// The parts were merged and sorted by a compaction, every one of them
+    /// holds rows of the whole input
+    #[serde(default, skip_serializing_if = "std::ops::Not::not")]
+    pub compacted: bool,
+    pub parts: Vec<Part>,
+}
+
+impl Manifest {
+    pub fn new(input_size: u64, hive_partitioning: bool, format: OutputFormat) -> Manifest {
+        Manifest {
+            input_size,
+            hive_partitioning,
+            format,
+            ..Manifest::default()
+        }
+    }
+
+    /// Loads the manifest of `output_path`, if there is one.
+    pub fn load(output_path: &Path) -> Result<Option<Manifest>, String> {
+        let path = output_path.join(MANIFEST_FILE);
+        let content = match fs::read_to_string(&path) {
+            Ok(content) => content,
+            Err(e) if e.kind() == io::ErrorKind::NotFound => return Ok(None),
+            Err(e) => return Err(format!("Failed to read manifest {:?}: {}", path, e)),
+        };
+        serde_json::from_str(&content)
+            .map(Some)
+            .map_err(|e| format!("Failed to parse manifest {:?}: {}", path, e))
+    }
+
+    /// Replaces the manifest of `output_path` in a single rename.
+    pub fn save(&self, output_path: &Path) -> io::Result<()> {
+        let path = output_path.join(MANIFEST_FILE);
+        let tmp_path = path.with_extension("json.tmp");
+        fs::write(&tmp_path, serde_json::to_vec_pretty(self)?)?;
+        fs::rename(&tmp_path, &path)
+    }
+
+    /// Returns the manifest a run of an input of `input_size` bytes starts from:
+    /// a new one, or with `resume`, the verified manifest of the previous run.
+    pub fn open(
+        output_path: &Path,
+        input_size: u64,
+        hive_partitioning: bool,
+        format: OutputFormat,
+        resume: bool,
+    ) -> Result<Manifest, String> {
+        let manifest = if resume {
+            Manifest::load(output_path)?
+        } else {
+            None
+        };
+        let Some(manifest) = manifest else {
+            return Ok(Manifest::new(input_size, hive_partitioning, format));
+        };
+        if manifest.input_size != input_size {
+            return Err(format!(
+                "The manifest of {:?} was written for an input of {} bytes, not {}",
+                output_path, manifest.input_size, input_size
+            ));
+        }
+        if manifest.hive_partitioning != hive_partitioning {
+            return Err(format!(
+                "The manifest of {:?} was written with hive_partitioning={}",
+                output_path, manifest.hive_partitioning
+            ));
+        }
+        if manifest.format != format {
+            return Err(format!(
+                "The manifest of {:?} was written with output_format={:?}",
+                output_path, manifest.format
+            ));
+        }
+        if manifest
+            .parts
+            .iter()
+            .any(|part| part.message_indices.is_some())
+        {
+            return Err(format!(
+                "The output {:?} was written unordered and can not be resumed",
+                output_path
+            ));
+        }
+        manifest.verify(output_path)?;
+        Ok(manifest)
+    }
+
+    /// Checks the checksum of every part and removes the part files that are
+    /// not in the manifest, such as a part written after it was last saved.
+    pub fn verify(&self, output_path: &Path) -> Result<(), String> {
+        let mut listed: Vec<PathBuf> = Vec::new();
+        for part in &self.parts {
+            let path = output_path.join(&part.file);
+            let ipc = part
+                .ipc_crc32
+                .map(|ipc_crc32| (ipc_sibling(&path), ipc_crc32));
+            for (path, expected) in [(path, part.crc32)].into_iter().chain(ipc) {
+                let crc32 = checksum(&path)
+                    .map_err(|e| format!("Failed to read part {:?}: {}", path, e))?;
+                if crc32 != expected {
+                    return Err(format!(
+                        "Part {:?} does not match the checksum in the manifest",
+                        path
+                    ));
+                }
+                listed.push(path);
+            }
+        }
+        for path in part_files(output_path)
+            .map_err(|e| format!("Failed to list {:?}: {}", output_path, e))?
+        {
+            if !listed.contains(&path) {
+                fs::remove_file(&path)
+                    .map_err(|e| format!("Failed to remove part {:?}: {}", path, e))?;
+            }
+        }
+        Ok(())
+    }
+}
+
+/// Returns the CRC-32 of a file.
+pub fn checksum(path: &Path) -> io::Result<u32> {
+    let mut file = File::open(path)?;
+    let mut crc = Crc::new();
+    let mut buffer = vec![0; 1 << 20];
+    loop {
+        let read = file.read(&mut buffer)?;
+        if read == 0 {
+            return Ok(crc.sum());
+        }
+        crc.update(&buffer[..read]);
+    }
+}
+
+/// Returns every `part-*` file under `dir`, partitions included.
+fn part_files(dir: &Path) -> io::Result<Vec<PathBuf>> {
+    let mut files = Vec::new();
+    for entry in fs::read_dir(dir)? {
+        let path = entry?.path();
+        if path.is_dir() {
+            files.extend(part_files(&path)?);
+        } else if path
+            .file_name()
+            .is_some_and(|name| name.to_string_lossy().starts_with("part-"))
+        {
+            files.push(path);
+        }
+    }
+    Ok(files)
+}
@@ -0,0 +1,303 @@
+//! Parsing of `Market By Price` messages into columns.
+//!
+//! A `Parser` interns every FID name into a dense id the first time it sees
+//! it, and keeps those ids for all the messages it parses. The cells of a
+//! message are appended straight into per-column buffers that borrow from the
+//! message text, with `None` marking the missing cells, and every column is
+//! built in one go with the type of the registry. The FIDs outside of the
+//! projection of its `Filter` are dropped as soon as their name is read.
+
+use crate::fid_types::{parse_gmt_offset, typed_column, FidType, FidTypes};
+use crate::filter::Filter;
+use crate::tokenizer::{RecordKind, StrRecord};
+use polars::prelude::*;
+use std::collections::HashMap;
+use std::sync::Arc;
+
+const TICKER: usize = 0;
+const TIMESTAMP: usize = 1;
+const GMT_OFFSET: usize = 2;
+const MARKET_MESSAGE_TYPE: usize = 3;
+const MAP_ENTRY_TYPE: usize = 4;
+const MAP_ENTRY_KEY: usize = 5;
+
+/// Columns interned by every parser, with the ids of the constants above.
+const PREINTERNED: [&str; 6] = [
+    "TICKER",
+    "TIMESTAMP",
+    "GMT_OFFSET",
+    "MARKET_MESSAGE_TYPE",
+    "MAP_ENTRY_TYPE",
+    "MAP_ENTRY_KEY",
+];
+
+/// Cells of one message, indexed by column id.
+struct Cells<'a> {
+    num_rows: usize,
+    columns: Vec<Option<Vec<Option<&'a str>>>>,
+    header: Vec<(usize, &'a str)>,
+}
+
+impl<'a> Cells<'a> {
+    fn new(num_ids: usize) -> Cells<'a> {
+        Cells {
+            num_rows: 0,
+            columns: vec![None; num_ids],
+            header: Vec::new(),
+        }
+    }
+
+    /// Sets the value of column `id` in the last row.
+    fn set(&mut self, id: usize, value: &'a str) {
+        if self.columns.len() <= id {
+            self.columns.resize(id + 1, None);
+        }
+        let row = self.num_rows - 1;
+        let cells = self.columns[id].get_or_insert_with(Vec::new);
+        if cells.len() > row {
+            cells[row] = Some(value);
+        } else {
+            cells.resize(row, None);
+            cells.push(Some(value));
+        }
+    }
+
+    /// Sets a value that applies to every row of the message.
+    fn set_header(&mut self, id: usize, value: &'a str) {
+        match self
+            .header
+            .iter_mut()
+            .find(|(header_id, _)| *header_id == id)
+        {
+            Some(entry) => entry.1 = value,
+            None => self.header.push((id, value)),
+        }
+    }
+}
+
+/// Parser of messages that keeps the FID ids between messages.
+pub struct Parser {
+    fid_types: Arc<FidTypes>,
+    ids: HashMap<String, usize>,
+    names: Vec<String>,
+    types: Vec<FidType>,
+    filter: Arc<Filter>,
+    /// Whether every id is in the FID projection
+    kept: Vec<bool>,
+}
+
+impl Parser {
+    pub fn new(fid_types: Arc<FidTypes>) -> Parser {
+        Parser::with_filter(fid_types, Arc::new(Filter::default()))
+    }
+
+    pub fn with_filter(fid_types: Arc<FidTypes>, filter: Arc<Filter>) -> Parser {
+        let mut parser = Parser {
+            fid_types,
+            ids: HashMap::new(),
+            names: Vec::new(),
+            types: Vec::new(),
+            filter,
+            kept: Vec::new(),
+        };
+        for name in PREINTERNED {
+            let id = parser.intern(name);
+            parser.kept[id] = true;
+        }
+        parser
+    }
+
+    pub fn filter(&self) -> Arc<Filter> {
+        self.filter.clone()
+    }
+
+    fn intern(&mut self, name: &str) -> usize {
+        if let Some(&id) = self.ids.get(name) {
+            return id;
+        }
+        let id = self.names.len();
+        self.ids.insert(name.to_string(), id);
+        self.names.push(name.to_string());
+        self.types.push(self.fid_types.get(name));
+        self.kept.push(self.filter.keeps_fid(name));
+        id
+    }
+
+    /// Splits a message into cells. Without `with_header`, header and summary
+    /// lines are not treated specially, as `flatten_map_entry` expects.
+    fn cells<'a>(&mut self, message: &'a str, with_header: bool) -> Cells<'a> {
+        let mut cells = Cells::new(self.names.len());
+        let mut in_summary: bool = false;
+
+        for line in message.lines() {
+            let record = StrRecord::new(line);
+
+            match record.kind() {
+                RecordKind::Header if with_header => {
+                    // Extract header information
+                    let (Some(ticker), Some(timestamp)) = (record.get(0), record.get(2)) else {
+                        continue;
+                    };
+                    cells.set_header(TICKER, ticker);
+                    cells.set_header(TIMESTAMP, timestamp);
+                    if let Some(gmt_offset) = record.get(3) {
+                        cells.set_header(GMT_OFFSET, gmt_offset);
+                    }
+                    if let Some(market_message_type) = record.get(5) {
+                        cells.set_header(MARKET_MESSAGE_TYPE, market_message_type);
+                    }
+                }
+                RecordKind::Summary if with_header => {
+                    in_summary = true;
+                }
+                RecordKind::MapEntry => {
+                    in_summary = false;
+                    // Start a new row
+                    cells.num_rows += 1;
+                    if let Some(entry_type) = record.get(6) {
+                        cells.set(MAP_ENTRY_TYPE, entry_type);
+                    }
+                    if let Some(entry_id) = record.get(12) {
+                        cells.set(MAP_ENTRY_KEY, entry_id);
+                    }
+                }
+                RecordKind::Fid => {
+                    let Some((key, value)) = record.fid() else {
+                        continue;
+                    };
+                    if !in_summary && cells.num_rows == 0 {
+                        continue;
+                    }
+                    let id = self.intern(key);
+                    if !self.kept[id] {
+                        // Outside of the FID projection
+                        continue;
+                    }
+                    if in_summary {
+                        // Summary values apply to every row
+                        cells.set_header(id, value);
+                    } else {
+                        cells.set(id, value);
+                    }
+                }
+                _ => {}
+            }
+        }
+        cells
+    }
+
+    /// Ids of the row columns present in `cells`, sorted by name.
+    fn sorted_ids(&self, cells: &Cells) -> Vec<usize> {
+        let mut ids: Vec<usize> = (0..cells.columns.len())
+            .filter(|&id| cells.columns[id].is_some())
+            .collect();
+        ids.sort_by(|&a, &b| self.names[a].cmp(&self.names[b]));
+        ids
+    }
+
+    /// Flattens a `Market By Price` message into one row per map entry, with
+    /// the header and summary values repeated on every row.
+    pub fn market_by_price(&mut self, message: &str) -> PolarsResult<DataFrame> {
+        let cells = self.cells(message, true);
+        self.frame(cells)
+    }
+
+    /// Flattens a raw message found at byte `offset` of the input, failing
+    /// with an error that says where it is if it is not valid UTF-8 or can not
+    /// be parsed.
+    pub fn market_by_price_at(
+        &mut self,
+        message: &[u8],
+        offset: usize,
+    ) -> Result<DataFrame, String> {
+        let message = std::str::from_utf8(message).map_err(|e| {
+            format!(
+                "The message at byte {} of the input is not valid UTF-8: {}",
+                offset, e
+            )
+        })?;
+        self.market_by_price(message).map_err(|e| {
+            format!(
+                "Failed to parse the message at byte {} of the input: {}",
+                offset, e
+            )
+        })
+    }
+
+    /// Flattens the map entries of a message into one row per map entry,
+    /// without the header and summary values.
+    pub fn map_entry_frame(&mut self, message: &str) -> PolarsResult<DataFrame> {
+        let cells = self.cells(message, false);
+        self.frame(cells)
+    }
+
+    /// Builds the typed columns of the cells of a message.
+    fn frame(&self, mut cells: Cells<'_>) -> PolarsResult<DataFrame> {
+        // A message without map entries still has one row if it has a header
+        let height = match (cells.num_rows, cells.header.is_empty()) {
+            (0, false) => 1,
+            (num_rows, _) => num_rows,
+        };
+        let gmt_offset = cells
+            .header
+            .iter()
+            .find(|(id, _)| *id == GMT_OFFSET)
+            .and_then(|(_, value)| parse_gmt_offset(value))
+            .unwrap_or(0);
+
+        let ids = self.sorted_ids(&cells);
+        let mut columns: Vec<Column> = Vec::with_capacity(ids.len() + cells.header.len());
+        let mut positions: Vec<Option<usize>> = vec![None; self.names.len()];
+        for id in ids {
+            let mut values = cells.columns[id].take().unwrap_or_default();
+            values.resize(height, None);
+            positions[id] = Some(columns.len());
+            columns.push(typed_column(
+                &self.names[id],
+                self.types[id],
+                &values,
+                gmt_offset,
+            ));
+        }
+        for &(id, value) in &cells.header {
+            let column = typed_column(
+                &self.names[id],
+                self.types[id],
+                &vec![Some(value); height],
+                gmt_offset,
+            );
+            // Header and summary values take precedence over the map entries
+            match positions[id] {
+                Some(position) => columns[position] = column,
+                None => columns.push(column),
+            }
+        }
+        DataFrame::new(columns)
+    }
+
+    /// Flattens the map entries of a message into a header row of column
+    /// names followed by one row of values per map entry.
+    pub fn map_entry(&mut self, message: &str) -> Vec<Vec<String>> {
+        let cells = self.cells(message, false);
+        let ids = self.sorted_ids(&cells);
+
+        let mut matrix: Vec<Vec<String>> = Vec::with_capacity(cells.num_rows + 1);
+        matrix.push(ids.iter().map(|&id| self.names[id].clone()).collect());
+        for row in 0..cells.num_rows {
+            let values = ids
+                .iter()
+                .map(|&id| {
+                    let column = cells.columns[id].as_ref().unwrap();
+                    column
+                        .get(row)
+                        .copied()
+                        .flatten()
+                        .unwrap_or_default()
+                        .to_string()
+                })
+                .collect::<Vec<String>>();
+            matrix.push(values);
+        }
+        matrix
+    }
+}
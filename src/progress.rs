@@ -0,0 +1,180 @@
+//! Progress reporting of a run that does not hold the GIL.
+//!
+//! A run works with the GIL released. Its threads only update the atomic
+//! counters of a `Progress`, and the thread that called it waits in
+//! `Reporter::watch`, which takes the GIL now and then to check for signals
+//! and, at most once per `REPORT_INTERVAL`, logs the progress and calls the
+//! progress callback. An error raised by the callback, or a `KeyboardInterrupt`,
+//! cancels the run: the reader stops at the next message and the parts of the
+//! messages read so far are written, so the output can be resumed.
+//!
+//! A worker that fails, such as on a message that can not be parsed, records
+//! its error with `Progress::fail`, which cancels the run the same way, and the
+//! run returns that error once its threads are done.
+
+use pyo3::prelude::*;
+use std::sync::atomic::{AtomicBool, AtomicU64, Ordering};
+use std::sync::Mutex;
+use std::thread::{self, sleep};
+use std::time::{Duration, Instant};
+
+/// Time between two checks of the signals and of the run.
+const POLL_INTERVAL: Duration = Duration::from_millis(100);
+/// Time between two progress reports.
+const REPORT_INTERVAL: Duration = Duration::from_secs(1);
+/// Lines a reader reads between two updates of the progress.
+pub const UPDATE_LINES: usize = 4096;
+
+/// Progress of a run, shared by its threads.
+#[derive(Default)]
+pub struct Progress {
+    /// Bytes of the input file read so far, compressed or not
+    bytes_done: AtomicU64,
+    bytes_total: AtomicU64,
+    cancelled: AtomicBool,
+    /// First error of a worker, which failed the run
+    error: Mutex<Option<String>>,
+}
+
+impl Progress {
+    pub fn start(&self, bytes_total: u64) {
+        self.bytes_total.store(bytes_total, Ordering::Relaxed);
+    }
+
+    pub fn set(&self, bytes_done: u64) {
+        self.bytes_done.store(bytes_done, Ordering::Relaxed);
+    }
+
+    pub fn add(&self, bytes: u64) {
+        self.bytes_done.fetch_add(bytes, Ordering::Relaxed);
+    }
+
+    pub fn cancel(&self) {
+        self.cancelled.store(true, Ordering::Relaxed);
+    }
+
+    pub fn is_cancelled(&self) -> bool {
+        self.cancelled.load(Ordering::Relaxed)
+    }
+
+    /// Fails the run with `error`, unless it already failed, and cancels it.
+    pub fn fail(&self, error: String) {
+        self.error.lock().unwrap().get_or_insert(error);
+        self.cancel();
+    }
+
+    pub fn has_failed(&self) -> bool {
+        self.error.lock().unwrap().is_some()
+    }
+
+    pub fn error(&self) -> Option<String> {
+        self.error.lock().unwrap().clone()
+    }
+
+    fn bytes(&self) -> (u64, u64) {
+        (
+            self.bytes_done.load(Ordering::Relaxed),
+            self.bytes_total.load(Ordering::Relaxed),
+        )
+    }
+}
+
+/// Logs to the `lobmp` logger and reports the progress of a run to Python.
+pub struct Reporter {
+    logger: Py<PyAny>,
+    callback: Option<Py<PyAny>>,
+}
+
+impl Reporter {
+    pub fn new(py: Python, callback: Option<Py<PyAny>>) -> PyResult<Reporter> {
+        let logger = PyModule::import(py, "logging")?
+            .getattr("getLogger")?
+            .call1(("lobmp",))?
+            .unbind();
+        Ok(Reporter { logger, callback })
+    }
+
+    /// Logs `message` at `level`, taking the GIL to do so.
+    pub fn log(&self, level: &str, message: impl Into<String>) -> PyResult<()> {
+        Python::with_gil(|py| {
+            self.logger
+                .call_method1(py, level, (message.into(),))
+                .map(|_| ())
+        })
+    }
+
+    /// Runs `work` on another thread and reports its progress until it ends.
+    ///
+    /// Must be called with the GIL released. If reporting fails, the run is
+    /// cancelled and the error is returned once `work` has stopped.
+    pub fn watch<T: Send>(
+        &self,
+        progress: &Progress,
+        work: impl FnOnce() -> PyResult<T> + Send,
+    ) -> PyResult<T> {
+        let start = Instant::now();
+        thread::scope(|s| {
+            let handle = s.spawn(work);
+            let mut reported = Instant::now();
+            let mut error: Option<PyErr> = None;
+            while !handle.is_finished() {
+                sleep(POLL_INTERVAL);
+                if error.is_some() {
+                    continue;
+                }
+                let checked = Python::with_gil(|py| -> PyResult<()> {
+                    py.check_signals()?;
+                    if reported.elapsed() >= REPORT_INTERVAL {
+                        reported = Instant::now();
+                        self.report(py, progress, start.elapsed())?;
+                    }
+                    Ok(())
+                });
+                if let Err(e) = checked {
+                    progress.cancel();
+                    error = Some(e);
+                }
+            }
+            let result = handle.join().map_err(|_| {
+                PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(
+                    "Processing thread panicked. This is very bad :(",
+                )
+            })?;
+            match error {
+                Some(e) => Err(e),
+                None => {
+                    let value = result?;
+                    // The callback always sees the end of the run
+                    let (_, total) = progress.bytes();
+                    progress.set(total);
+                    Python::with_gil(|py| self.call_back(py, progress))?;
+                    Ok(value)
+                }
+            }
+        })
+    }
+
+    fn report(&self, py: Python, progress: &Progress, elapsed: Duration) -> PyResult<()> {
+        let (done, total) = progress.bytes();
+        if done > 0 && total > 0 {
+            let estimated_total_time = elapsed.mul_f64(total as f64 / done.min(total) as f64);
+            let estimated_remaining = estimated_total_time.saturating_sub(elapsed);
+            self.logger.call_method1(
+                py,
+                "info",
+                (format!(
+                    "Processed: {} of {} bytes. Estimated {:02?} remaining",
+                    done, total, estimated_remaining
+                ),),
+            )?;
+        }
+        self.call_back(py, progress)
+    }
+
+    fn call_back(&self, py: Python, progress: &Progress) -> PyResult<()> {
+        if let Some(callback) = &self.callback {
+            callback.call1(py, progress.bytes())?;
+        }
+        Ok(())
+    }
+}
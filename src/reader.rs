@@ -0,0 +1,117 @@
+//! Reading of the messages of a decoded input, line by line.
+//!
+//! A message starts on a `Market By Price` header line and runs until the
+//! next one. The lines before the first header are skipped, and the messages
+//! dropped by the filter are not even buffered. Every run that reads its
+//! input as a stream, converting it or replaying its books, goes through this
+//! reader, while a memory-mapped input is cut by `splitter` instead.
+
+use crate::filter::Filter;
+use crate::input::Input;
+use crate::progress::{Progress, UPDATE_LINES};
+use crate::stats::{Metrics, Timer};
+use crate::tokenizer::is_header;
+use std::io::BufRead;
+use std::sync::atomic::Ordering;
+
+/// A message read from the input.
+pub struct IndexedMessage {
+    /// Position of the message among the ones kept
+    pub index: usize,
+    /// Input byte offset of the message
+    pub offset: usize,
+    pub content: Vec<u8>,
+}
+
+/// Reads the messages of `input` kept by `filter`, from the decoded byte
+/// offset `start` on, and hands them to `send` in input order.
+///
+/// Updates `progress` as it goes and stops once it is cancelled, leaving out
+/// the message being read, so an output resumes from it. Returns the number of
+/// messages sent.
+pub fn for_each_message(
+    input: &mut Input,
+    start: usize,
+    filter: &Filter,
+    progress: &Progress,
+    metrics: &Metrics,
+    mut send: impl FnMut(IndexedMessage) -> Result<(), String>,
+) -> Result<usize, String> {
+    let mut timer = Timer::new();
+    let mut line: Vec<u8> = Vec::new();
+    let mut next_message: Vec<u8> = Vec::new();
+    let mut found_first: bool = false;
+    let mut message_index = 0;
+    // Bytes of the decoded input read so far, and the offset of `next_message`
+    let mut position: usize = 0;
+    let mut message_offset: usize = 0;
+    let mut keep: bool = true;
+    let mut messages_read: usize = 0;
+
+    // Waiting for the next stages to take a message is idle time
+    let mut hand_over = |timer: &mut Timer, index: usize, offset: usize, content: Vec<u8>| {
+        timer.busy();
+        let sent = send(IndexedMessage {
+            index,
+            offset,
+            content,
+        });
+        timer.idle();
+        sent
+    };
+
+    for i in 0_usize.. {
+        if i % UPDATE_LINES == 0 {
+            progress.set(input.position());
+            if progress.is_cancelled() {
+                next_message.clear();
+                break;
+            }
+        }
+        line.clear();
+        let read = input
+            .reader
+            .read_until(b'\n', &mut line)
+            .map_err(|e| format!("Error reading line: {}", e))?;
+        if read == 0 {
+            break;
+        }
+        position += read;
+        if position <= start {
+            // Already written by the run being resumed
+            continue;
+        }
+        if is_header(&line) {
+            if !next_message.is_empty() && found_first {
+                let content = std::mem::take(&mut next_message);
+                hand_over(&mut timer, message_index, message_offset, content)?;
+                message_index += 1;
+            }
+            found_first = true;
+            messages_read += 1;
+            message_offset = position - read;
+            keep = filter.keeps_message(&line);
+        }
+        if found_first && keep {
+            next_message.extend_from_slice(&line);
+        }
+    }
+
+    // Send the last message if there is one
+    if !next_message.is_empty() && found_first {
+        hand_over(&mut timer, message_index, message_offset, next_message)?;
+        message_index += 1;
+    }
+    timer.busy();
+    timer.finish(&metrics.read);
+    metrics
+        .bytes_read
+        .fetch_add(position.saturating_sub(start) as u64, Ordering::Relaxed);
+    metrics
+        .messages_read
+        .fetch_add(messages_read, Ordering::Relaxed);
+    metrics
+        .messages_parsed
+        .fetch_add(message_index, Ordering::Relaxed);
+    Ok(message_index)
+}
@@ -0,0 +1,207 @@
+//! Output schema of a run: discovered, cached or pinned.
+//!
+//! By default the writer discovers the schema while writing and pads the parts
+//! written before the last FID was found, which rewrites them once the input
+//! is over. A pinned schema skips the discovery: every part has exactly its
+//! columns, in its order, and the FIDs outside of it are dropped.
+//!
+//! A cached schema is the one discovered by an earlier run of the same input
+//! with the same filter. It is saved in `<input>.lobmpschema.json`, keyed by
+//! the size, the modification time and a CRC-32 of the head and tail of the
+//! input, and the writer starts from it, so every part is written with the
+//! final schema and none is rewritten.
+
+use crate::filter::Filter;
+use crate::index::signature;
+use flate2::Crc;
+use serde::{Deserialize, Serialize};
+use std::collections::HashSet;
+use std::fs::{self, File};
+use std::io::{self, Read, Seek, SeekFrom};
+use std::path::{Path, PathBuf};
+use std::sync::Arc;
+
+/// Suffix added to the name of the input file.
+pub const SCHEMA_SUFFIX: &str = ".lobmpschema.json";
+/// Bytes hashed at the start and at the end of the input.
+const SAMPLE_SIZE: u64 = 1 << 20;
+
+/// Columns of the output of a run.
+#[derive(Clone, Debug, Default)]
+pub enum OutputSchema {
+    /// Discovered while writing
+    #[default]
+    Discovered,
+    /// Discovered while writing, starting from the cached columns, and cached at the end
+    Cached(Arc<SchemaCache>),
+    /// Exactly these columns, in this order
+    Pinned(Arc<Vec<String>>),
+}
+
+/// What a cached schema was discovered from.
+#[derive(Clone, Debug, PartialEq, Serialize, Deserialize)]
+struct CacheKey {
+    /// Version of lobmp, as the parser decides the column names
+    version: String,
+    input_size: u64,
+    input_modified: u64,
+    input_crc32: u32,
+    /// Filter of the run, as it decides the columns kept
+    filter: String,
+}
+
+#[derive(Serialize, Deserialize)]
+struct CacheFile {
+    key: CacheKey,
+    columns: Vec<String>,
+}
+
+/// Schema cache of an input file.
+#[derive(Debug)]
+pub struct SchemaCache {
+    path: PathBuf,
+    key: CacheKey,
+    /// Columns cached for this input and filter, if any
+    columns: Vec<String>,
+}
+
+impl SchemaCache {
+    /// Opens the cache of `input`, which only holds columns if it matches the
+    /// input and `filter`.
+    pub fn open(input: &Path, filter: &Filter) -> io::Result<SchemaCache> {
+        let (input_size, input_modified) = signature(input)?;
+        let key = CacheKey {
+            version: env!("CARGO_PKG_VERSION").to_string(),
+            input_size,
+            input_modified,
+            input_crc32: sample_crc32(input, input_size)?,
+            filter: describe(filter),
+        };
+        let path = schema_path(input);
+        // A cache that can not be read is rebuilt
+        let columns = fs::read(&path)
+            .ok()
+            .and_then(|content| serde_json::from_slice::<CacheFile>(&content).ok())
+            .filter(|cached| cached.key == key)
+            .map(|cached| cached.columns)
+            .unwrap_or_default();
+        Ok(SchemaCache { path, key, columns })
+    }
+
+    pub fn columns(&self) -> &[String] {
+        &self.columns
+    }
+
+    /// Saves `columns` if they differ from the cached ones.
+    pub fn store(&self, columns: Vec<String>) -> io::Result<()> {
+        if columns == self.columns {
+            return Ok(());
+        }
+        let cached = CacheFile {
+            key: self.key.clone(),
+            columns,
+        };
+        let tmp_path = self.path.with_extension("json.tmp");
+        fs::write(&tmp_path, serde_json::to_vec_pretty(&cached)?)?;
+        fs::rename(&tmp_path, &self.path)
+    }
+}
+
+/// Path of the schema cache of `input`.
+pub fn schema_path(input: &Path) -> PathBuf {
+    let mut name = input.as_os_str().to_owned();
+    name.push(SCHEMA_SUFFIX);
+    PathBuf::from(name)
+}
+
+/// CRC-32 of the first and last `SAMPLE_SIZE` bytes of the file, which tells
+/// apart most inputs rewritten in place with the same size and time.
+fn sample_crc32(path: &Path, size: u64) -> io::Result<u32> {
+    let mut file = File::open(path)?;
+    let mut crc = Crc::new();
+    let mut buffer = Vec::new();
+    (&mut file).take(SAMPLE_SIZE).read_to_end(&mut buffer)?;
+    crc.update(&buffer);
+    if size > SAMPLE_SIZE {
+        buffer.clear();
+        file.seek(SeekFrom::Start(
+            size.saturating_sub(SAMPLE_SIZE).max(SAMPLE_SIZE),
+        ))?;
+        file.take(SAMPLE_SIZE).read_to_end(&mut buffer)?;
+        crc.update(&buffer);
+    }
+    Ok(crc.sum())
+}
+
+/// Canonical description of a filter, with its sets sorted.
+fn describe(filter: &Filter) -> String {
+    fn sorted(values: &Option<HashSet<String>>) -> Option<Vec<&String>> {
+        values.as_ref().map(|values| {
+            let mut values: Vec<&String> = values.iter().collect();
+            values.sort();
+            values
+        })
+    }
+    format!(
+        "tickers={:?} fids={:?} start={:?} end={:?}",
+        sorted(&filter.tickers),
+        sorted(&filter.fids),
+        filter.start,
+        filter.end
+    )
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn input(name: &str, content: &[u8]) -> PathBuf {
+        let path =
+            std::env::temp_dir().join(format!("lobmp-schema-{}-{}", std::process::id(), name));
+        fs::write(&path, content).unwrap();
+        let _ = fs::remove_file(schema_path(&path));
+        path
+    }
+
+    #[test]
+    fn caches_the_columns_of_an_input() {
+        let path = input("cache.csv", b"messages");
+        let filter = Filter::default();
+        let cache = SchemaCache::open(&path, &filter).unwrap();
+        assert!(cache.columns().is_empty());
+        cache
+            .store(vec!["BID".to_string(), "TICKER".to_string()])
+            .unwrap();
+
+        let cache = SchemaCache::open(&path, &filter).unwrap();
+        assert_eq!(cache.columns(), ["BID", "TICKER"]);
+        // Another filter discovers other columns
+        let filter = Filter::new(None, Some(vec!["BID".to_string()]), None, None).unwrap();
+        assert!(SchemaCache::open(&path, &filter)
+            .unwrap()
+            .columns()
+            .is_empty());
+    }
+
+    #[test]
+    fn ignores_the_cache_of_a_changed_input() {
+        let path = input("changed.csv", b"messages");
+        let filter = Filter::default();
+        SchemaCache::open(&path, &filter)
+            .unwrap()
+            .store(vec!["BID".to_string()])
+            .unwrap();
+        fs::write(&path, b"MESSAGES").unwrap();
+        assert!(SchemaCache::open(&path, &filter)
+            .unwrap()
+            .columns()
+            .is_empty());
+    }
+
+    #[test]
+    fn describes_filters_in_a_stable_order() {
+        let a = Filter::new(Some(vec!["A".into(), "B".into()]), None, None, None).unwrap();
+        let b = Filter::new(Some(vec!["B".into(), "A".into()]), None, None, None).unwrap();
+        assert_eq!(describe(&a), describe(&b));
+    }
+}
@@ -0,0 +1,85 @@
+//! Splitting of raw LSEG bytes into `Market By Price` messages.
+//!
+//! A memory-mapped file is cut into byte ranges that always start on a
+//! `Market By Price` header line and end right before the next one, so every
+//! parsing worker can scan and parse its own range without a shared reader.
+
+use crate::tokenizer::is_header;
+use memchr::memchr;
+use std::ops::Range;
+
+/// Approximate number of bytes handed to a worker at a time.
+pub const RANGE_SIZE: usize = 4 * 1024 * 1024;
+
+/// Returns the end (exclusive, newline included) of the line starting at `start`.
+fn line_end(data: &[u8], start: usize) -> usize {
+    match memchr(b'\n', &data[start..]) {
+        Some(i) => start + i + 1,
+        None => data.len(),
+    }
+}
+
+/// Returns the first line start at or after `pos`.
+fn line_start_at_or_after(data: &[u8], pos: usize) -> usize {
+    if pos == 0 || pos >= data.len() {
+        return pos.min(data.len());
+    }
+    match memchr(b'\n', &data[pos - 1..]) {
+        Some(i) => pos + i,
+        None => data.len(),
+    }
+}
+
+/// Returns the start of the first header line at or after the line start `from`,
+/// or `data.len()` if there is none.
+pub fn next_header(data: &[u8], from: usize) -> usize {
+    let mut start = from;
+    while start < data.len() {
+        let end = line_end(data, start);
+        if is_header(&data[start..end]) {
+            return start;
+        }
+        start = end;
+    }
+    data.len()
+}
+
+/// Splits `data` into consecutive ranges of roughly `target` bytes. Every range
+/// starts on a header line and ends on the next header line (or the end of the
+/// data). Anything before the first header is skipped, as the line reader does.
+pub fn message_ranges(data: &[u8], target: usize) -> Vec<Range<usize>> {
+    let mut ranges = Vec::new();
+    let mut start = next_header(data, 0);
+    while start < data.len() {
+        let candidate = line_start_at_or_after(data, start.saturating_add(target.max(1)));
+        let end = next_header(data, candidate);
+        ranges.push(start..end);
+        start = end;
+    }
+    ranges
+}
+
+/// Iterator over the messages of a range that starts on a header line.
+pub struct Messages<'a> {
+    data: &'a [u8],
+    pos: usize,
+}
+
+impl<'a> Iterator for Messages<'a> {
+    type Item = &'a [u8];
+
+    fn next(&mut self) -> Option<Self::Item> {
+        if self.pos >= self.data.len() {
+            return None;
+        }
+        let start = self.pos;
+        self.pos = next_header(self.data, line_end(self.data, start));
+        Some(&self.data[start..self.pos])
+    }
+}
+
+/// Returns an iterator over the messages contained in `data`, which must start
+/// on a header line, such as a range produced by `message_ranges`.
+pub fn messages(data: &[u8]) -> Messages<'_> {
+    Messages { data, pos: 0 }
+}
@@ -0,0 +1,266 @@
+//! Metrics of a run, per stage of the pipeline.
+//!
+//! Every thread of a run keeps a `Timer` that splits its time between busy,
+//! doing the work of its stage, and idle, waiting on a queue, and adds it to
+//! the shared `Metrics` when it ends. The queues and the reorder buffer record
+//! the most items they held. Once the run is over, `Metrics::stats` takes a
+//! snapshot that can be returned to Python and saved as JSON.
+//!
+//! The stages are `read` (reading, decoding and splitting the input), `parse`
+//! (the parsing workers), `write` (the writer thread, which orders and batches
+//! the messages) and `encode` (the threads that align and write the part
+//! files; for book snapshots, the part of the writer busy time spent writing
+//! them).
+
+use serde::Serialize;
+use std::collections::BTreeMap;
+use std::fs;
+use std::io;
+use std::path::Path;
+use std::sync::atomic::{AtomicU64, AtomicUsize, Ordering};
+use std::sync::Mutex;
+use std::time::{Duration, Instant};
+
+pub const STATS_FILE: &str = "_stats.json";
+
+/// Busy and idle time of the threads of a stage, summed.
+#[derive(Default)]
+pub struct Stage {
+    busy: AtomicU64,
+    idle: AtomicU64,
+}
+
+impl Stage {
+    pub fn add(&self, busy: Duration, idle: Duration) {
+        self.busy
+            .fetch_add(busy.as_nanos() as u64, Ordering::Relaxed);
+        self.idle
+            .fetch_add(idle.as_nanos() as u64, Ordering::Relaxed);
+    }
+
+    fn stats(&self) -> StageStats {
+        StageStats {
+            busy: self.busy.load(Ordering::Relaxed) as f64 / 1e9,
+            idle: self.idle.load(Ordering::Relaxed) as f64 / 1e9,
+        }
+    }
+}
+
+/// Splits the time of one thread into busy and idle periods.
+pub struct Timer {
+    last: Instant,
+    busy: Duration,
+    idle: Duration,
+}
+
+impl Timer {
+    pub fn new() -> Timer {
+        Timer {
+            last: Instant::now(),
+            busy: Duration::ZERO,
+            idle: Duration::ZERO,
+        }
+    }
+
+    /// Counts the time since the last mark as busy.
+    pub fn busy(&mut self) {
+        let now = Instant::now();
+        self.busy += now - self.last;
+        self.last = now;
+    }
+
+    /// Counts the time since the last mark as idle.
+    pub fn idle(&mut self) {
+        let now = Instant::now();
+        self.idle += now - self.last;
+        self.last = now;
+    }
+
+    /// Adds the time of the thread to `stage`.
+    pub fn finish(self, stage: &Stage) {
+        stage.add(self.busy, self.idle);
+    }
+}
+
+impl Default for Timer {
+    fn default() -> Timer {
+        Timer::new()
+    }
+}
+
+/// Largest value seen of a count, such as the length of a queue.
+#[derive(Default)]
+pub struct HighWater(AtomicUsize);
+
+impl HighWater {
+    pub fn record(&self, value: usize) {
+        self.0.fetch_max(value, Ordering::Relaxed);
+    }
+
+    fn get(&self) -> usize {
+        self.0.load(Ordering::Relaxed)
+    }
+}
+
+/// Metrics shared by the threads of a run.
+pub struct Metrics {
+    start: Instant,
+    /// Decoded input bytes read
+    pub bytes_read: AtomicU64,
+    /// Messages found in the input
+    pub messages_read: AtomicUsize,
+    /// Messages kept by the filter and sent to the parsing workers
+    pub messages_parsed: AtomicUsize,
+    pub read: Stage,
+    pub parse: Stage,
+    pub write: Stage,
+    pub encode: Stage,
+    pub parsing_queue: HighWater,
+    pub dataframes_queue: HighWater,
+    pub reorder_buffer: HighWater,
+    parts: Mutex<Vec<PartStats>>,
+}
+
+impl Default for Metrics {
+    fn default() -> Metrics {
+        Metrics {
+            start: Instant::now(),
+            bytes_read: AtomicU64::default(),
+            messages_read: AtomicUsize::default(),
+            messages_parsed: AtomicUsize::default(),
+            read: Stage::default(),
+            parse: Stage::default(),
+            write: Stage::default(),
+            encode: Stage::default(),
+            parsing_queue: HighWater::default(),
+            dataframes_queue: HighWater::default(),
+            reorder_buffer: HighWater::default(),
+            parts: Mutex::new(Vec::new()),
+        }
+    }
+}
+
+impl Metrics {
+    /// Records a part file written to `path`, or its new size if it was rewritten.
+    pub fn part(&self, file: &str, path: &Path, rows: usize) {
+        let bytes = fs::metadata(path)
+            .map(|metadata| metadata.len())
+            .unwrap_or(0);
+        let mut parts = self.parts.lock().unwrap();
+        match parts.iter_mut().find(|part| part.file == file) {
+            Some(part) => {
+                part.rows = rows;
+                part.bytes = bytes;
+            }
+            None => parts.push(PartStats {
+                file: file.to_string(),
+                rows,
+                bytes,
+            }),
+        }
+    }
+
+    /// Takes a snapshot of the metrics.
+    pub fn stats(&self) -> Stats {
+        let parts = self.parts.lock().unwrap().clone();
+        Stats {
+            elapsed: self.start.elapsed().as_secs_f64(),
+            bytes_read: self.bytes_read.load(Ordering::Relaxed),
+            messages_read: self.messages_read.load(Ordering::Relaxed),
+            messages_parsed: self.messages_parsed.load(Ordering::Relaxed),
+            rows_written: parts.iter().map(|part| part.rows).sum(),
+            bytes_written: parts.iter().map(|part| part.bytes).sum(),
+            stages: BTreeMap::from([
+                ("read".to_string(), self.read.stats()),
+                ("parse".to_string(), self.parse.stats()),
+                ("write".to_string(), self.write.stats()),
+                ("encode".to_string(), self.encode.stats()),
+            ]),
+            parsing_queue_peak: self.parsing_queue.get(),
+            dataframes_queue_peak: self.dataframes_queue.get(),
+            reorder_buffer_peak: self.reorder_buffer.get(),
+            parts,
+            peak_rss: peak_rss(),
+        }
+    }
+}
+
+/// Seconds the threads of a stage spent working and waiting.
+#[derive(Clone, Debug, Serialize)]
+pub struct StageStats {
+    pub busy: f64,
+    pub idle: f64,
+}
+
+/// A part file written by the run.
+#[derive(Clone, Debug, Serialize)]
+pub struct PartStats {
+    /// Path of the part, relative to the output directory
+    pub file: String,
+    pub rows: usize,
+    pub bytes: u64,
+}
+
+/// Snapshot of the metrics of a run.
+#[derive(Clone, Debug, Serialize)]
+pub struct Stats {
+    /// Seconds since the run started
+    pub elapsed: f64,
+    pub bytes_read: u64,
+    pub messages_read: usize,
+    pub messages_parsed: usize,
+    pub rows_written: usize,
+    pub bytes_written: u64,
+    pub stages: BTreeMap<String, StageStats>,
+    pub parsing_queue_peak: usize,
+    pub dataframes_queue_peak: usize,
+    pub reorder_buffer_peak: usize,
+    pub parts: Vec<PartStats>,
+    /// Peak resident set size of the process in bytes, where the platform reports it
+    pub peak_rss: Option<u64>,
+}
+
+impl Stats {
+    /// Writes the stats to `_stats.json` in `output_path`.
+    pub fn save(&self, output_path: &Path) -> io::Result<()> {
+        fs::create_dir_all(output_path)?;
+        fs::write(
+            output_path.join(STATS_FILE),
+            serde_json::to_vec_pretty(self)?,
+        )
+    }
+}
+
+/// Peak resident set size of the process, from `VmHWM` in `/proc/self/status`.
+fn peak_rss() -> Option<u64> {
+    let status = fs::read_to_string("/proc/self/status").ok()?;
+    let line = status.lines().find(|line| line.starts_with("VmHWM:"))?;
+    let kilobytes: u64 = line
+        .trim_start_matches("VmHWM:")
+        .trim()
+        .trim_end_matches("kB")
+        .trim()
+        .parse()
+        .ok()?;
+    Some(kilobytes * 1024)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn records_parts_and_high_water_marks() {
+        let metrics = Metrics::default();
+        metrics.parsing_queue.record(3);
+        metrics.parsing_queue.record(1);
+        metrics.part("part-000000.parquet", Path::new("missing"), 10);
+        metrics.part("part-000001.parquet", Path::new("missing"), 5);
+        metrics.part("part-000000.parquet", Path::new("missing"), 12);
+
+        let stats = metrics.stats();
+        assert_eq!(stats.parsing_queue_peak, 3);
+        assert_eq!(stats.parts.len(), 2);
+        assert_eq!(stats.rows_written, 17);
+    }
+}
@@ -0,0 +1,122 @@
+//! Streaming of the parsed messages of a file as DataFrames, without writing them.
+//!
+//! The file is parsed by the same pool of workers as `run_many`, and the
+//! messages are put back in input order and concatenated into batches of at
+//! least `batch_rows` rows. The queue of batches is short, so a slow consumer
+//! holds the whole pipeline back instead of letting batches pile up in memory.
+//!
+//! The schema is discovered while streaming, so a batch has every column seen
+//! so far and later batches may have more columns than earlier ones.
+//!
+//! A message that can not be parsed, or that never reaches the batches, ends
+//! the stream with an error once the batches before it are sent.
+
+use crate::batch::parse_file;
+use crate::fid_types::FidTypes;
+use crate::filter::Filter;
+use crate::writer::{concat_aligned, initial_columns, IndexedDataFrame, Reorder, FAILED_RANGE};
+use crossbeam::channel::{bounded, Receiver, Sender};
+use polars::prelude::*;
+use std::collections::BTreeMap;
+use std::path::PathBuf;
+use std::sync::Arc;
+use std::thread::{self, available_parallelism};
+
+/// Batches produced ahead of the consumer.
+const QUEUED_BATCHES: usize = 2;
+
+/// A batch of messages, or the error that ended the stream.
+pub type Batch = Result<DataFrame, String>;
+
+/// Spawns the pipeline that parses `path` into batches of at least `batch_rows` rows.
+pub fn spawn_stream(
+    path: PathBuf,
+    memory_map: bool,
+    fid_types: Arc<FidTypes>,
+    filter: Arc<Filter>,
+    batch_rows: usize,
+) -> (Receiver<Batch>, thread::JoinHandle<()>) {
+    let (tx_batches, rx_batches) = bounded::<Batch>(QUEUED_BATCHES);
+    let handle = thread::spawn(move || {
+        let num_cpus: usize = available_parallelism().map(|n| n.get()).unwrap_or(1);
+        let (tx_dataframes, rx_dataframes) = bounded::<IndexedDataFrame>(2 * num_cpus);
+        thread::scope(|s| {
+            let batcher =
+                s.spawn(|| send_batches(rx_dataframes, &fid_types, batch_rows, &tx_batches));
+            let parsed = parse_file(&path, memory_map, &fid_types, &filter, tx_dataframes);
+            let streamed = match batcher.join() {
+                Ok(reorder) => parsed.and_then(|end| check_complete(&reorder, end)),
+                Err(_) => Err("Batching thread panicked".to_string()),
+            };
+            if let Err(e) = streamed {
+                // Nobody is listening if the consumer stopped early
+                let _ = tx_batches.send(Err(e));
+            }
+        });
+    });
+    (rx_batches, handle)
+}
+
+/// Orders the messages of `rx_dataframes` and sends them in batches. Returns
+/// the reorder, which holds the messages that were never sent.
+fn send_batches(
+    rx_dataframes: Receiver<IndexedDataFrame>,
+    fid_types: &FidTypes,
+    batch_rows: usize,
+    tx_batches: &Sender<Batch>,
+) -> Reorder {
+    let mut reorder = Reorder::default();
+    let mut columns = initial_columns(fid_types);
+    let mut dfs: Vec<DataFrame> = Vec::new();
+    let mut rows: usize = 0;
+
+    let send = |dfs: Vec<DataFrame>, columns: &BTreeMap<String, DataType>| {
+        let batch = concat_aligned(dfs, columns).map_err(|e| e.to_string());
+        tx_batches.send(batch).is_ok()
+    };
+
+    while let Ok(indexed_df) = rx_dataframes.recv() {
+        if indexed_df.range == FAILED_RANGE {
+            // A parser failed, its error ends the stream
+            continue;
+        }
+        for column in indexed_df.data.get_columns() {
+            if !columns.contains_key(column.name().as_str()) {
+                columns.insert(column.name().to_string(), column.dtype().clone());
+            }
+        }
+        reorder.push(indexed_df);
+
+        while let Some(indexed_df) = reorder.pop() {
+            if indexed_df.data.width() == 0 {
+                continue;
+            }
+            rows += indexed_df.data.height();
+            dfs.push(indexed_df.data);
+            if rows >= batch_rows {
+                if !send(std::mem::take(&mut dfs), &columns) {
+                    // The consumer is gone, closing the queue stops the workers
+                    return reorder;
+                }
+                rows = 0;
+            }
+        }
+    }
+    if !dfs.is_empty() {
+        send(dfs, &columns);
+    }
+    reorder
+}
+
+/// Checks that every message up to `end` was sent in the batches.
+fn check_complete(reorder: &Reorder, end: (usize, usize)) -> Result<(), String> {
+    if reorder.pending() == 0 && reorder.next() == end {
+        return Ok(());
+    }
+    Err(format!(
+        "Message {} of range {} was never parsed, and {} later messages were left waiting for it",
+        reorder.next().1,
+        reorder.next().0,
+        reorder.pending()
+    ))
+}
@@ -0,0 +1,353 @@
+//! Synthetic `Market By Price` messages, shaped like an LSEG download.
+//!
+//! The benchmarks need large inputs that behave like the real data, without
+//! shipping any. The generator keeps a book per ticker: the first message of a
+//! ticker, and a fraction `refresh_ratio` of the others, are REFRESH messages
+//! that add `book_depth` levels per side, and the rest are UPDATE messages that
+//! add, change or delete a few levels. A few tickers send most of the messages,
+//! as in a real market. The output only depends on the options, seed included.
+
+use crate::fid_types::format_date;
+use flate2::write::GzEncoder;
+use std::collections::HashSet;
+use std::fmt::Write as _;
+use std::fs::File;
+use std::io::{self, BufWriter, Write};
+use std::path::Path;
+
+const NANOS_PER_DAY: i64 = 86_400_000_000_000;
+const NANOS_PER_HOUR: i64 = 3_600_000_000_000;
+
+/// 2020-01-11T08:00:00Z, the timestamp of the first message.
+const START: i64 = 18_272 * NANOS_PER_DAY + 8 * NANOS_PER_HOUR;
+
+/// Most nanoseconds between two messages.
+const MAX_GAP: u64 = 2_000_000;
+
+#[derive(Clone, Debug)]
+pub struct SyntheticOptions {
+    pub tickers: usize,
+    /// Fraction of the messages of a ticker, after its first one, that are REFRESH messages
+    pub refresh_ratio: f64,
+    /// Mean number of map entries of an UPDATE message
+    pub map_entries: usize,
+    /// Levels per side of a REFRESH message
+    pub book_depth: usize,
+    pub seed: u64,
+}
+
+impl Default for SyntheticOptions {
+    fn default() -> SyntheticOptions {
+        SyntheticOptions {
+            tickers: 50,
+            refresh_ratio: 0.001,
+            map_entries: 4,
+            book_depth: 20,
+            seed: 0,
+        }
+    }
+}
+
+impl SyntheticOptions {
+    pub fn validate(&self) -> Result<(), String> {
+        if self.tickers == 0 || self.map_entries == 0 || self.book_depth == 0 {
+            return Err("tickers, map_entries and book_depth must be positive".to_string());
+        }
+        if !(0.0..=1.0).contains(&self.refresh_ratio) {
+            return Err(format!(
+                "refresh_ratio must be between 0 and 1, not {}",
+                self.refresh_ratio
+            ));
+        }
+        Ok(())
+    }
+}
+
+/// SplitMix64, small and good enough to draw the shape of the messages.
+struct Rng(u64);
+
+impl Rng {
+    fn next(&mut self) -> u64 {
+        self.0 = self.0.wrapping_add(0x9e37_79b9_7f4a_7c15);
+        let mut z = self.0;
+        z = (z ^ (z >> 30)).wrapping_mul(0xbf58_476d_1ce4_e5b9);
+        z = (z ^ (z >> 27)).wrapping_mul(0x94d0_49bb_1331_11eb);
+        z ^ (z >> 31)
+    }
+
+    /// A number in `0..n`.
+    fn below(&mut self, n: usize) -> usize {
+        (self.next() % n as u64) as usize
+    }
+
+    fn chance(&mut self, probability: f64) -> bool {
+        ((self.next() >> 11) as f64 / (1_u64 << 53) as f64) < probability
+    }
+}
+
+/// Price levels of a ticker, in ticks of 0.01 around a fixed mid price.
+struct Book {
+    ticker: String,
+    mid: i64,
+    /// Live levels, as `(is_ask, ticks)`
+    levels: HashSet<(bool, i64)>,
+}
+
+pub struct Generator {
+    options: SyntheticOptions,
+    rng: Rng,
+    books: Vec<Book>,
+    timestamp: i64,
+    sequence: usize,
+}
+
+impl Generator {
+    pub fn new(options: SyntheticOptions) -> Generator {
+        let books = (0..options.tickers)
+            .map(|i| Book {
+                ticker: format!("SYNTH{:04}.MC", i),
+                mid: 1_000 + 100 * i as i64,
+                levels: HashSet::new(),
+            })
+            .collect();
+        Generator {
+            rng: Rng(options.seed),
+            options,
+            books,
+            timestamp: START,
+            sequence: 0,
+        }
+    }
+
+    /// Appends the next message to `out`.
+    pub fn next_message(&mut self, out: &mut String) {
+        // The square root of a uniform draw is skewed towards the last tickers
+        let tickers = self.books.len();
+        let index = tickers - 1 - self.rng.below(tickers * tickers).isqrt();
+        self.timestamp += self.rng.below(MAX_GAP as usize) as i64;
+        let local = self.timestamp + NANOS_PER_HOUR;
+        let refresh =
+            self.books[index].levels.is_empty() || self.rng.chance(self.options.refresh_ratio);
+
+        let book = &self.books[index];
+        out.push_str(&book.ticker);
+        out.push_str(",Market By Price,");
+        push_timestamp(out, self.timestamp);
+        if refresh {
+            out.push_str(",+1,Raw,REFRESH,,,,,3240,0,");
+        } else {
+            out.push_str(",+1,Raw,UPDATE,UNSPECIFIED,,,,3240,,");
+        }
+        writeln!(out, "{},0", self.sequence).unwrap();
+        self.sequence += 1;
+
+        let milliseconds = local.rem_euclid(NANOS_PER_DAY) / 1_000_000;
+        if refresh {
+            out.push_str(",,,,Summary,,,,,,,,,4\n,,,,FID,1,,PROD_PERM,3240,\n");
+            out.push_str(",,,,FID,15,,CURRENCY,978,EUR\n,,,,FID,17,,ACTIV_DATE,");
+            out.push_str(&format_date(local.div_euclid(NANOS_PER_DAY)));
+            writeln!(out, ",\n,,,,FID,4148,,TIMACT_MS,{},", milliseconds).unwrap();
+            self.refresh(index, local, out);
+        } else {
+            out.push_str(",,,,Summary,,,,,,,,,2\n,,,,FID,1,,PROD_PERM,3240,\n");
+            writeln!(out, ",,,,FID,4148,,TIMACT_MS,{},", milliseconds).unwrap();
+            self.update(index, local, out);
+        }
+    }
+
+    /// Replaces the book of a ticker with `book_depth` levels per side.
+    fn refresh(&mut self, index: usize, local: i64, out: &mut String) {
+        let depth = self.options.book_depth as i64;
+        let book = &mut self.books[index];
+        book.levels.clear();
+        for distance in 1..=depth {
+            for is_ask in [false, true] {
+                let ticks = if is_ask {
+                    book.mid + distance
+                } else {
+                    book.mid - distance
+                };
+                book.levels.insert((is_ask, ticks));
+                push_entry(out, &mut self.rng, "ADD", is_ask, ticks, local);
+            }
+        }
+    }
+
+    /// Adds, changes or deletes levels around the mid price.
+    fn update(&mut self, index: usize, local: i64, out: &mut String) {
+        let entries = 1 + self.rng.below(2 * self.options.map_entries - 1);
+        for _ in 0..entries {
+            let is_ask = self.rng.chance(0.5);
+            let distance = 1 + self.rng.below(self.options.book_depth) as i64;
+            let book = &mut self.books[index];
+            let ticks = if is_ask {
+                book.mid + distance
+            } else {
+                book.mid - distance
+            };
+            if !book.levels.contains(&(is_ask, ticks)) {
+                book.levels.insert((is_ask, ticks));
+                push_entry(out, &mut self.rng, "ADD", is_ask, ticks, local);
+            } else if self.rng.chance(1.0 / 3.0) {
+                book.levels.remove(&(is_ask, ticks));
+                writeln!(out, ",,,,MapEntry,,DELETE,,,,,,{},0", key(is_ask, ticks)).unwrap();
+            } else {
+                push_entry(out, &mut self.rng, "UPDATE", is_ask, ticks, local);
+            }
+        }
+    }
+}
+
+impl Iterator for Generator {
+    type Item = String;
+
+    fn next(&mut self) -> Option<String> {
+        let mut message = String::new();
+        self.next_message(&mut message);
+        Some(message)
+    }
+}
+
+/// Formats a price in ticks of 0.01 with the given number of decimals.
+fn price(ticks: i64, decimals: usize) -> String {
+    format!(
+        "{}.{:0<width$}",
+        ticks / 100,
+        format!("{:02}", ticks % 100),
+        width = decimals
+    )
+}
+
+fn key(is_ask: bool, ticks: i64) -> String {
+    format!("{}_{}", price(ticks, 6), if is_ask { "A" } else { "B" })
+}
+
+fn push_timestamp(out: &mut String, nanos: i64) {
+    out.push_str(&format_date(nanos.div_euclid(NANOS_PER_DAY)));
+    out.push('T');
+    push_time(out, nanos);
+    out.push('Z');
+}
+
+fn push_time(out: &mut String, nanos: i64) {
+    let nanos = nanos.rem_euclid(NANOS_PER_DAY);
+    let seconds = nanos / 1_000_000_000;
+    write!(
+        out,
+        "{:02}:{:02}:{:02}.{:09}",
+        seconds / 3600,
+        seconds / 60 % 60,
+        seconds % 60,
+        nanos % 1_000_000_000
+    )
+    .unwrap();
+}
+
+/// Appends an ADD or UPDATE map entry with the FIDs of a price level.
+fn push_entry(out: &mut String, rng: &mut Rng, action: &str, is_ask: bool, ticks: i64, local: i64) {
+    writeln!(
+        out,
+        ",,,,MapEntry,,{},,,,,,{},6",
+        action,
+        key(is_ask, ticks)
+    )
+    .unwrap();
+    if is_ask {
+        out.push_str(",,,,FID,267,,ASK_TIME,");
+    } else {
+        out.push_str(",,,,FID,266,,BID_TIME,");
+    }
+    push_time(out, local);
+    writeln!(out, ",\n,,,,FID,3427,,ORDER_PRC,{},", price(ticks, 2)).unwrap();
+    if is_ask {
+        out.push_str(",,,,FID,3428,,ORDER_SIDE,2,ASK\n");
+    } else {
+        out.push_str(",,,,FID,3428,,ORDER_SIDE,1,BID\n");
+    }
+    writeln!(out, ",,,,FID,3430,,NO_ORD,{},", 1 + rng.below(20)).unwrap();
+    writeln!(out, ",,,,FID,4356,,ACC_SIZE,{},", 1 + rng.below(5_000)).unwrap();
+    out.push_str(",,,,FID,14268,,LV_TIM_NS,");
+    push_time(out, local);
+    out.push_str(",\n");
+}
+
+/// Writes messages until at least `size` bytes are written, and returns how many.
+pub fn write_messages<W: Write>(
+    mut writer: W,
+    options: SyntheticOptions,
+    size: u64,
+) -> io::Result<usize> {
+    let mut generator = Generator::new(options);
+    let mut message = String::new();
+    let mut written: u64 = 0;
+    let mut count = 0;
+    while written < size {
+        message.clear();
+        generator.next_message(&mut message);
+        writer.write_all(message.as_bytes())?;
+        written += message.len() as u64;
+        count += 1;
+    }
+    writer.flush()?;
+    Ok(count)
+}
+
+/// Writes a synthetic file of at least `size` bytes of CSV, compressed as
+/// gzip or zstd when `path` ends with `.gz` or `.zst`.
+pub fn write_file(path: &Path, options: SyntheticOptions, size: u64) -> io::Result<usize> {
+    let file = BufWriter::new(File::create(path)?);
+    match path.extension().and_then(|ext| ext.to_str()) {
+        Some("gz") => {
+            let mut encoder = GzEncoder::new(file, flate2::Compression::default());
+            let count = write_messages(&mut encoder, options, size)?;
+            encoder.finish()?.flush()?;
+            Ok(count)
+        }
+        Some("zst") => {
+            let mut encoder = zstd::Encoder::new(file, 0)?;
+            let count = write_messages(&mut encoder, options, size)?;
+            encoder.finish()?.flush()?;
+            Ok(count)
+        }
+        _ => write_messages(file, options, size),
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::splitter::messages;
+    use crate::tokenizer::{Record, RecordKind};
+
+    #[test]
+    fn generates_the_same_messages_for_a_seed() {
+        let options = SyntheticOptions::default();
+        let first: Vec<String> = Generator::new(options.clone()).take(100).collect();
+        let second: Vec<String> = Generator::new(options).take(100).collect();
+        assert_eq!(first, second);
+    }
+
+    #[test]
+    fn generates_well_formed_messages() {
+        let options = SyntheticOptions {
+            tickers: 3,
+            ..SyntheticOptions::default()
+        };
+        let data: String = Generator::new(options).take(50).collect();
+        let mut refreshed = HashSet::new();
+        for (i, message) in messages(data.as_bytes()).enumerate() {
+            let header = Record::new(message);
+            let ticker = header.get(0).unwrap();
+            let is_refresh = header.get(5) == Some(b"REFRESH".as_slice());
+            assert!(is_refresh || refreshed.contains(ticker));
+            refreshed.insert(ticker);
+            assert_eq!(header.get(12), Some(i.to_string().as_bytes()));
+            for line in message.split(|&b| b == b'\n').skip(1) {
+                if !line.is_empty() {
+                    assert_ne!(Record::new(line).kind(), RecordKind::Other);
+                }
+            }
+        }
+        assert_eq!(messages(data.as_bytes()).count(), 50);
+    }
+}
@@ -0,0 +1,136 @@
+//! Byte-level tokenizer of LSEG CSV lines.
+//!
+//! Lines are never split into owned strings. A `Record` finds the field
+//! delimiters with `memchr`, only up to the last column any record kind uses,
+//! and recognises the kind of record by comparing the fixed columns where
+//! LSEG writes it: `Market By Price` in column 1 for a message header, and
+//! `Summary`, `MapEntry` or `FID` in column 4 for the lines of its body.
+
+use memchr::{memchr, memchr_iter};
+
+/// Marker that identifies the header line of a message, in column 1.
+pub const HEADER_MARKER: &[u8] = b"Market By Price";
+
+/// Number of leading columns that are tokenized, enough to reach the map entry key in column 12.
+pub const MAX_FIELDS: usize = 13;
+
+/// Kind of an LSEG CSV line.
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+pub enum RecordKind {
+    Header,
+    Summary,
+    MapEntry,
+    Fid,
+    Other,
+}
+
+/// Returns true if the line is a `Market By Price` header, without tokenizing the whole line.
+pub fn is_header(line: &[u8]) -> bool {
+    let Some(comma) = memchr(b',', line) else {
+        return false;
+    };
+    let rest = &line[comma + 1..];
+    rest.starts_with(HEADER_MARKER)
+        && matches!(
+            rest.get(HEADER_MARKER.len()),
+            None | Some(b',' | b'\r' | b'\n')
+        )
+}
+
+/// The leading fields of a line, borrowed from it.
+pub struct Record<'a> {
+    line: &'a [u8],
+    bounds: [(usize, usize); MAX_FIELDS],
+    count: usize,
+}
+
+impl<'a> Record<'a> {
+    pub fn new(line: &'a [u8]) -> Record<'a> {
+        let line = line.strip_suffix(b"\n").unwrap_or(line);
+        let line = line.strip_suffix(b"\r").unwrap_or(line);
+        let mut bounds = [(0, 0); MAX_FIELDS];
+        let mut count = 0;
+        let mut start = 0;
+        for comma in memchr_iter(b',', line) {
+            bounds[count] = (start, comma);
+            count += 1;
+            start = comma + 1;
+            if count == MAX_FIELDS {
+                return Record {
+                    line,
+                    bounds,
+                    count,
+                };
+            }
+        }
+        bounds[count] = (start, line.len());
+        Record {
+            line,
+            bounds,
+            count: count + 1,
+        }
+    }
+
+    /// Field `index`, if the line has it and it is one of the tokenized columns.
+    pub fn get(&self, index: usize) -> Option<&'a [u8]> {
+        if index < self.count {
+            let (start, end) = self.bounds[index];
+            Some(&self.line[start..end])
+        } else {
+            None
+        }
+    }
+
+    pub fn kind(&self) -> RecordKind {
+        if self.get(1) == Some(HEADER_MARKER) {
+            return RecordKind::Header;
+        }
+        match self.get(4) {
+            Some(b"FID") => RecordKind::Fid,
+            Some(b"MapEntry") => RecordKind::MapEntry,
+            Some(b"Summary") => RecordKind::Summary,
+            _ => RecordKind::Other,
+        }
+    }
+
+    /// Name and value of a `FID` line. The value is in column 9 when the FID
+    /// has a second (enumerated) value, and in column 8 otherwise.
+    pub fn fid(&self) -> Option<(&'a [u8], &'a [u8])> {
+        let value_index = match self.get(9) {
+            Some(value) if !value.is_empty() => 9,
+            _ => 8,
+        };
+        Some((self.get(7)?, self.get(value_index)?))
+    }
+}
+
+/// A `Record` of a line that is known to be valid UTF-8, with string fields.
+pub struct StrRecord<'a>(Record<'a>);
+
+impl<'a> StrRecord<'a> {
+    pub fn new(line: &'a str) -> StrRecord<'a> {
+        StrRecord(Record::new(line.as_bytes()))
+    }
+
+    pub fn get(&self, index: usize) -> Option<&'a str> {
+        // Safety: the line is valid UTF-8 and fields are split on ASCII commas,
+        // so every field is valid UTF-8 too
+        self.0
+            .get(index)
+            .map(|field| unsafe { std::str::from_utf8_unchecked(field) })
+    }
+
+    pub fn kind(&self) -> RecordKind {
+        self.0.kind()
+    }
+
+    pub fn fid(&self) -> Option<(&'a str, &'a str)> {
+        // Safety: as in `get`
+        self.0.fid().map(|(name, value)| unsafe {
+            (
+                std::str::from_utf8_unchecked(name),
+                std::str::from_utf8_unchecked(value),
+            )
+        })
+    }
+}
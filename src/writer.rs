@@ -0,0 +1,1222 @@
+//! Writing of parsed messages into `part-*.parquet` files.
+//!
+//! The writer receives one DataFrame per message, restores the message order
+//! and writes them in batches, flushing a part file once the estimated
+//! in-memory size of its messages reaches the target part size. The batches
+//! are aligned to the schema and encoded by a few threads of the writer, so
+//! several parts are written at the same time.
+//!
+//! The output schema is discovered while writing: it grows as new FIDs
+//! appear, and the parts written before the last FID was found are padded
+//! with empty columns once every message has been written. A cached schema
+//! starts the discovery from the columns of an earlier run, and a pinned one
+//! replaces it, see `OutputSchema`.
+//! Missing string columns are filled with empty strings and typed ones with nulls.
+//!
+//! With a memory limit, the messages are charged to the `Budget` of the run
+//! until their part is encoded, and while it is exhausted the writer flushes
+//! its largest batch early instead of waiting for the target part size.
+//!
+//! After every part, the writer saves the checkpoint manifest of the output
+//! directory, so an interrupted run can be resumed from the first message that
+//! is not in a part.
+//!
+//! An unordered writer skips the reordering and writes the messages in the
+//! order they are parsed, so a slow message does not hold the later ones
+//! back. Every row then has a `MESSAGE_INDEX`, the input byte offset of its
+//! message, and every part records its smallest and largest index in the
+//! Parquet key-value metadata, so the input order can be restored by sorting.
+//!
+//! Parts are written as Parquet, as Arrow IPC files (`part-*.arrow`) that can
+//! be memory-mapped, or both. An IPC part is cut into record batches of
+//! `row_group_size` rows, and its schema metadata holds a small index of the
+//! rows, tickers and timestamps of every batch, so a reader can jump to the
+//! batches of a slice from the footer alone.
+//!
+//! With Hive partitioning, every message goes to the partition of its ticker
+//! and trading date, `TICKER=<ticker>/date=<YYYY-MM-DD>`, which batches and
+//! numbers its own parts. `TICKER` is then only kept in the directory names.
+
+use crate::budget::Budget;
+use crate::fid_types::{format_date, parse_gmt_offset, parse_timestamp, FidTypes};
+use crate::manifest::{Manifest, Part};
+use crate::progress::Progress;
+use crate::schema::OutputSchema;
+use crate::stats::{Metrics, Timer};
+use crossbeam::channel::{bounded, unbounded, Receiver, Select, Sender};
+use flate2::CrcWriter;
+use polars::io::parquet::write::KeyValueMetadata;
+use polars::prelude::*;
+use serde::{Deserialize, Serialize};
+use std::collections::{BTreeMap, HashMap};
+use std::fs::{self, File};
+use std::io::{BufWriter, Write};
+use std::ops::Range;
+use std::panic::{self, AssertUnwindSafe};
+use std::path::{Path, PathBuf};
+use std::sync::{Arc, OnceLock};
+use std::thread;
+
+/// Default target of the estimated in-memory size of the messages of a part file.
+pub const DEFAULT_PART_SIZE: usize = 128 * 1024 * 1024;
+
+/// Default number of threads that align and encode the part files of an output.
+pub const DEFAULT_WRITERS: usize = 4;
+
+/// Columns that are always present in the output, even if no message has them.
+pub const SUPPLEMENT_COLUMNS: [&str; 6] = [
+    "TICKER",
+    "TIMESTAMP",
+    "GMT_OFFSET",
+    "MARKET_MESSAGE_TYPE",
+    "MAP_ENTRY_TYPE",
+    "MAP_ENTRY_KEY",
+];
+
+/// Column of the input byte offset of the message of every row, in unordered output.
+pub const MESSAGE_INDEX: &str = "MESSAGE_INDEX";
+
+/// Parquet key-value metadata with the smallest and largest `MESSAGE_INDEX` of a part.
+pub const MIN_MESSAGE_INDEX_KEY: &str = "lobmp.min_message_index";
+pub const MAX_MESSAGE_INDEX_KEY: &str = "lobmp.max_message_index";
+
+/// IPC schema metadata with the index of the record batches of a part.
+pub const IPC_INDEX_KEY: &str = "lobmp.batch_index";
+
+/// Default rows of the record batches of an IPC part.
+pub const DEFAULT_IPC_BATCH_ROWS: usize = 65536;
+
+/// Fraction of the memory limit a batch needs to be flushed early while parts
+/// are still being encoded, so the parts stay large under memory pressure.
+const EARLY_FLUSH_SHARE: usize = 8;
+
+/// Value of a partition that a message does not have, as Hive names it.
+const DEFAULT_PARTITION: &str = "__HIVE_DEFAULT_PARTITION__";
+
+/// How the parsed messages are written.
+#[derive(Clone, Debug)]
+pub struct WriterOptions {
+    /// Write every ticker and trading date to its own `TICKER=/date=` directory
+    pub hive_partitioning: bool,
+    /// Parquet codec and level
+    pub compression: ParquetCompression,
+    /// Rows of every row group, or the Polars default
+    pub row_group_size: Option<usize>,
+    /// Write the min, max and null count statistics of every column
+    pub statistics: bool,
+    /// Estimated in-memory bytes of the messages that trigger a flush
+    pub part_size: usize,
+    /// Threads that align and encode part files at the same time
+    pub writers: usize,
+    /// Write the messages in input order, or as they are parsed with a `MESSAGE_INDEX`
+    pub ordered: bool,
+    /// Columns written, discovered, cached or pinned
+    pub schema: OutputSchema,
+    /// Files written for every part
+    pub format: OutputFormat,
+    /// Codec of the IPC parts, or none so they can be read without copies
+    pub ipc_compression: Option<IpcCompression>,
+}
+
+impl Default for WriterOptions {
+    fn default() -> WriterOptions {
+        WriterOptions {
+            hive_partitioning: false,
+            compression: ParquetCompression::Zstd(None),
+            row_group_size: None,
+            statistics: true,
+            part_size: DEFAULT_PART_SIZE,
+            writers: DEFAULT_WRITERS,
+            ordered: true,
+            schema: OutputSchema::Discovered,
+            format: OutputFormat::Parquet,
+            ipc_compression: None,
+        }
+    }
+}
+
+impl WriterOptions {
+    pub fn parquet_writer<W: Write>(&self, writer: W) -> ParquetWriter<W> {
+        let statistics = if self.statistics {
+            StatisticsOptions::default()
+        } else {
+            StatisticsOptions::empty()
+        };
+        ParquetWriter::new(writer)
+            .with_compression(self.compression)
+            .with_row_group_size(self.row_group_size)
+            .with_statistics(statistics)
+    }
+}
+
+/// Files written for every part.
+#[derive(Clone, Copy, Debug, Default, PartialEq, Eq, Serialize, Deserialize)]
+#[serde(rename_all = "lowercase")]
+pub enum OutputFormat {
+    /// `part-*.parquet`
+    #[default]
+    Parquet,
+    /// `part-*.arrow`, Arrow IPC files
+    Ipc,
+    /// Both, every `part-*.arrow` next to its `part-*.parquet`
+    Both,
+}
+
+impl OutputFormat {
+    pub fn parse(name: &str) -> Result<OutputFormat, String> {
+        match name {
+            "parquet" => Ok(OutputFormat::Parquet),
+            "ipc" => Ok(OutputFormat::Ipc),
+            "both" => Ok(OutputFormat::Both),
+            _ => Err(format!(
+                "Unknown output format {:?}, choose from parquet, ipc or both",
+                name
+            )),
+        }
+    }
+
+    /// Extension of the part files listed in the manifest.
+    fn extension(self) -> &'static str {
+        match self {
+            OutputFormat::Ipc => "arrow",
+            OutputFormat::Parquet | OutputFormat::Both => "parquet",
+        }
+    }
+}
+
+/// Parses the codec of IPC parts.
+pub fn parse_ipc_compression(name: &str) -> Result<Option<IpcCompression>, String> {
+    match name {
+        "uncompressed" => Ok(None),
+        "lz4" => Ok(Some(IpcCompression::LZ4)),
+        "zstd" => Ok(Some(IpcCompression::ZSTD)),
+        _ => Err(format!(
+            "Unknown IPC compression {:?}, choose from uncompressed, lz4 or zstd",
+            name
+        )),
+    }
+}
+
+/// Parses a codec name and its optional level into a Parquet compression.
+pub fn parse_compression(name: &str, level: Option<i32>) -> Result<ParquetCompression, String> {
+    let invalid_level = |e: PolarsError| format!("Invalid {} compression level: {}", name, e);
+    let no_level = |compression: ParquetCompression| match level {
+        Some(_) => Err(format!("The {} compression has no levels", name)),
+        None => Ok(compression),
+    };
+    match name {
+        "uncompressed" => no_level(ParquetCompression::Uncompressed),
+        "snappy" => no_level(ParquetCompression::Snappy),
+        "lz4" => no_level(ParquetCompression::Lz4Raw),
+        "zstd" => Ok(ParquetCompression::Zstd(
+            level
+                .map(ZstdLevel::try_new)
+                .transpose()
+                .map_err(invalid_level)?,
+        )),
+        "gzip" => Ok(ParquetCompression::Gzip(
+            level
+                .map(|level| GzipLevel::try_new(u8::try_from(level).unwrap_or(u8::MAX)))
+                .transpose()
+                .map_err(invalid_level)?,
+        )),
+        "brotli" => Ok(ParquetCompression::Brotli(
+            level
+                .map(|level| BrotliLevel::try_new(u32::try_from(level).unwrap_or(u32::MAX)))
+                .transpose()
+                .map_err(invalid_level)?,
+        )),
+        _ => Err(format!(
+            "Unknown compression {:?}, choose from uncompressed, snappy, lz4, zstd, gzip or brotli",
+            name
+        )),
+    }
+}
+
+/// A parsed message and its position in the input.
+///
+/// Messages are ordered by `range` and then by `index` inside the range. A
+/// reader that does not split its input always uses range zero, and the
+/// message that closes a range is flagged with `last_in_range`. `span` holds
+/// the input bytes of the message, which the manifest records.
+pub struct IndexedDataFrame {
+    pub range: usize,
+    pub index: usize,
+    pub last_in_range: bool,
+    pub span: Range<usize>,
+    pub data: DataFrame,
+}
+
+impl IndexedDataFrame {
+    /// Closes a range whose messages are all filtered out, so the order moves
+    /// on. It has no columns and is not written.
+    pub fn empty_range(range: usize, end: usize) -> IndexedDataFrame {
+        IndexedDataFrame {
+            range,
+            index: 0,
+            last_in_range: true,
+            span: end..end,
+            data: DataFrame::empty(),
+        }
+    }
+}
+
+/// Range of the message that wakes a writer up once its run failed.
+pub const FAILED_RANGE: usize = usize::MAX;
+
+/// Fails the run of a writer with `error`. The writer is woken up with a
+/// message that no position reaches, so it drops the messages held for the one
+/// that failed even if nothing else is sent to it.
+pub fn fail_writer(progress: &Progress, tx_dataframes: &Sender<IndexedDataFrame>, error: String) {
+    progress.fail(error);
+    let _ = tx_dataframes.send(IndexedDataFrame {
+        range: FAILED_RANGE,
+        index: 0,
+        last_in_range: false,
+        span: 0..0,
+        data: DataFrame::empty(),
+    });
+}
+
+/// Position after the last message sent to a writer, set by its reader once
+/// every message of the input is sent.
+pub type InputEnd = Arc<OnceLock<(usize, usize)>>;
+
+/// Restores the input order of the parsed messages.
+#[derive(Default)]
+pub struct Reorder {
+    next: (usize, usize),
+    pending: HashMap<(usize, usize), IndexedDataFrame>,
+}
+
+impl Reorder {
+    pub fn push(&mut self, indexed_df: IndexedDataFrame) {
+        self.pending
+            .insert((indexed_df.range, indexed_df.index), indexed_df);
+    }
+
+    /// Returns the next message in input order, once it has been received.
+    pub fn pop(&mut self) -> Option<IndexedDataFrame> {
+        let indexed_df = self.pending.remove(&self.next)?;
+        self.next = next_position(self.next, indexed_df.last_in_range);
+        Some(indexed_df)
+    }
+
+    /// Position of the next message in input order.
+    pub fn next(&self) -> (usize, usize) {
+        self.next
+    }
+
+    /// Messages received that wait for an earlier one.
+    pub fn pending(&self) -> usize {
+        self.pending.len()
+    }
+
+    /// Drops the messages that wait for an earlier one and returns their
+    /// estimated size.
+    pub fn discard(&mut self) -> usize {
+        self.pending
+            .drain()
+            .map(|(_, indexed_df)| indexed_df.data.estimated_size())
+            .sum()
+    }
+}
+
+/// Columns every output starts with, typed following `fid_types`.
+pub fn initial_columns(fid_types: &FidTypes) -> BTreeMap<String, DataType> {
+    SUPPLEMENT_COLUMNS
+        .iter()
+        .map(|name| (name.to_string(), fid_types.get(name).dtype()))
+        .collect()
+}
+
+/// Column of `height` empty values of `dtype`, as `FidTypes::fill_value` fills them.
+fn fill_column(name: &str, dtype: &DataType, height: usize) -> Column {
+    match dtype {
+        DataType::String => StringChunked::full(name.into(), "", height)
+            .into_series()
+            .into(),
+        dtype => Column::full_null(name.into(), height, dtype),
+    }
+}
+
+/// Adds the missing `columns` as empty values and selects them in order.
+fn align_columns(df: &DataFrame, columns: &BTreeMap<String, DataType>) -> PolarsResult<DataFrame> {
+    let height = df.height();
+    let aligned: Vec<Column> = columns
+        .iter()
+        .map(|(name, dtype)| match df.column(name) {
+            Ok(column) => column.clone(),
+            Err(_) => fill_column(name, dtype, height),
+        })
+        .collect();
+    DataFrame::new(aligned)
+}
+
+/// Concatenates messages, aligned to `columns`, into one DataFrame.
+///
+/// Every message is aligned eagerly, which only clones the columns it has and
+/// allocates the ones it misses, and the batch is rechunked once at the end.
+pub fn concat_aligned(
+    dfs: Vec<DataFrame>,
+    columns: &BTreeMap<String, DataType>,
+) -> PolarsResult<DataFrame> {
+    let mut batch_df = align_columns(&DataFrame::empty(), columns)?;
+    for df in &dfs {
+        batch_df.vstack_mut(&align_columns(df, columns)?)?;
+    }
+    batch_df.as_single_chunk_par();
+    Ok(batch_df)
+}
+
+/// Selects the columns of `df` in the order of the pinned schema `names`,
+/// followed by the message index of an unordered output.
+fn pinned_order(df: &DataFrame, names: &[String]) -> PolarsResult<DataFrame> {
+    let order = names
+        .iter()
+        .map(String::as_str)
+        .chain([MESSAGE_INDEX])
+        .filter(|name| df.get_column_index(name).is_some());
+    df.select(order)
+}
+
+/// Writes `df` to `file_path` and returns the CRC-32 of the file. The range of
+/// `MESSAGE_INDEX` of an unordered part goes to the key-value metadata.
+fn write_parquet(
+    file_path: &Path,
+    df: &mut DataFrame,
+    options: &WriterOptions,
+    message_indices: Option<(u64, u64)>,
+) -> u32 {
+    let file = File::create(file_path).expect("Failed to create part file");
+    let mut writer = CrcWriter::new(BufWriter::new(file));
+    let metadata = message_indices.map(|(min, max)| {
+        KeyValueMetadata::from_static(vec![
+            (MIN_MESSAGE_INDEX_KEY.to_string(), min.to_string()),
+            (MAX_MESSAGE_INDEX_KEY.to_string(), max.to_string()),
+        ])
+    });
+    options
+        .parquet_writer(&mut writer)
+        .with_key_value_metadata(metadata)
+        .finish(df)
+        .expect("Failed to write part file");
+    writer.flush().expect("Failed to write part file");
+    writer.crc().sum()
+}
+
+/// A record batch of an IPC part, as its index lists it.
+#[derive(Clone, Debug, PartialEq, Serialize, Deserialize)]
+pub struct IpcBatch {
+    /// First row of the batch in the part
+    pub offset: usize,
+    pub rows: usize,
+    /// Smallest and largest `TICKER`
+    pub tickers: Option<(String, String)>,
+    /// Smallest and largest `TIMESTAMP` as written, in nanoseconds since the epoch
+    pub timestamps: Option<(i64, i64)>,
+}
+
+impl IpcBatch {
+    fn new(offset: usize, df: &DataFrame) -> IpcBatch {
+        let strings = |name: &str| {
+            let column = df.column(name).ok()?.str().ok()?;
+            Some((column.min_str()?, column.max_str()?))
+        };
+        let timestamps = match df.column("TIMESTAMP").map(|column| column.dtype()) {
+            Ok(DataType::String) => strings("TIMESTAMP")
+                .and_then(|(min, max)| Some((parse_timestamp(min)?, parse_timestamp(max)?))),
+            Ok(DataType::Datetime(_, _)) => df
+                .column("TIMESTAMP")
+                .and_then(|column| column.cast(&DataType::Int64))
+                .ok()
+                .and_then(|column| {
+                    let column = column.i64().ok()?;
+                    Some((column.min()?, column.max()?))
+                }),
+            _ => None,
+        };
+        IpcBatch {
+            offset,
+            rows: df.height(),
+            tickers: strings("TICKER").map(|(min, max)| (min.to_string(), max.to_string())),
+            timestamps,
+        }
+    }
+}
+
+/// Reads the index of the record batches of an IPC part.
+pub fn read_ipc_index(file_path: &Path) -> Result<Vec<IpcBatch>, String> {
+    let file =
+        File::open(file_path).map_err(|e| format!("Failed to open {:?}: {}", file_path, e))?;
+    let metadata = IpcReader::new(file)
+        .custom_metadata()
+        .map_err(|e| format!("Failed to read {:?}: {}", file_path, e))?;
+    let index = metadata
+        .as_ref()
+        .and_then(|metadata| metadata.get(IPC_INDEX_KEY))
+        .ok_or_else(|| format!("{:?} has no batch index", file_path))?;
+    serde_json::from_str(index)
+        .map_err(|e| format!("Failed to parse the batch index of {:?}: {}", file_path, e))
+}
+
+/// Writes `df` as an Arrow IPC file, in record batches of `row_group_size`
+/// rows with their index in the schema metadata, and returns its CRC-32.
+fn write_ipc(file_path: &Path, df: &DataFrame, options: &WriterOptions) -> u32 {
+    let batch_rows = options
+        .row_group_size
+        .unwrap_or(DEFAULT_IPC_BATCH_ROWS)
+        .max(1);
+    // Every chunk of the DataFrame is written as a record batch
+    let batches: Vec<DataFrame> = (0..df.height().max(1))
+        .step_by(batch_rows)
+        .map(|offset| df.slice(offset as i64, batch_rows))
+        .collect();
+    let mut chunked = batches[0].clone();
+    for batch in &batches[1..] {
+        chunked
+            .vstack_mut(batch)
+            .expect("Failed to split the part into batches");
+    }
+
+    let mut offset = 0;
+    let index: Vec<IpcBatch> = batches
+        .iter()
+        .map(|batch| {
+            offset += batch.height();
+            IpcBatch::new(offset - batch.height(), batch)
+        })
+        .collect();
+    let index = serde_json::to_string(&index).expect("Failed to encode the batch index");
+
+    let file = File::create(file_path).expect("Failed to create part file");
+    let mut writer = CrcWriter::new(BufWriter::new(file));
+    let mut ipc_writer = IpcWriter::new(&mut writer).with_compression(options.ipc_compression);
+    ipc_writer.set_custom_schema_metadata(Arc::new(BTreeMap::from([(
+        IPC_INDEX_KEY.into(),
+        index.into(),
+    )])));
+    ipc_writer
+        .finish(&mut chunked)
+        .expect("Failed to write part file");
+    writer.flush().expect("Failed to write part file");
+    writer.crc().sum()
+}
+
+/// Path of the IPC file written next to the Parquet part at `file_path`.
+pub fn ipc_sibling(file_path: &Path) -> PathBuf {
+    file_path.with_extension("arrow")
+}
+
+/// Writes `df` as the files of a part, the one listed in the manifest at
+/// `file_path`, and returns their CRC-32s: of that file, and of the IPC file
+/// next to it if both formats are written. With `replace`, every file is
+/// written aside and renamed over the old one, so no part is left half-written.
+fn write_files(
+    file_path: &Path,
+    df: &mut DataFrame,
+    options: &WriterOptions,
+    message_indices: Option<(u64, u64)>,
+    replace: bool,
+) -> (u32, Option<u32>) {
+    if let OutputSchema::Pinned(names) = &options.schema {
+        *df = pinned_order(df, names).expect("Failed to order the pinned columns");
+    }
+    let write = |path: &Path, df: &mut DataFrame, ipc: bool| {
+        let mut target = path.as_os_str().to_owned();
+        if replace {
+            target.push(".tmp");
+        }
+        let target = PathBuf::from(target);
+        let crc32 = if ipc {
+            write_ipc(&target, df, options)
+        } else {
+            write_parquet(&target, df, options, message_indices)
+        };
+        if replace {
+            fs::rename(&target, path).expect("Failed to replace part file");
+        }
+        crc32
+    };
+    match options.format {
+        OutputFormat::Parquet => (write(file_path, df, false), None),
+        OutputFormat::Ipc => (write(file_path, df, true), None),
+        OutputFormat::Both => {
+            let ipc_crc32 = write(&ipc_sibling(file_path), df, true);
+            (write(file_path, df, false), Some(ipc_crc32))
+        }
+    }
+}
+
+/// Reads a Parquet or IPC part file.
+fn read_part(file_path: &Path) -> DataFrame {
+    let file = File::open(file_path).expect("Failed to open part file");
+    let df = if file_path
+        .extension()
+        .is_some_and(|extension| extension == "arrow")
+    {
+        IpcReader::new(file).finish()
+    } else {
+        ParquetReader::new(file).finish()
+    };
+    df.expect("Failed to read part file")
+}
+
+/// Rows of an encoded part and the CRC-32s of its files.
+type EncodedPart = (usize, u32, Option<u32>);
+
+/// Writes a batch of messages, aligned to `columns`, and returns its rows and CRC-32s.
+fn write_part(
+    file_path: &Path,
+    dfs: Vec<DataFrame>,
+    columns: &BTreeMap<String, DataType>,
+    options: &WriterOptions,
+    message_indices: Option<(u64, u64)>,
+) -> EncodedPart {
+    let mut batch_df = concat_aligned(dfs, columns).expect("Failed to concatenate batch");
+    let (crc32, ipc_crc32) = write_files(file_path, &mut batch_df, options, message_indices, false);
+    (batch_df.height(), crc32, ipc_crc32)
+}
+
+/// Rewrites a part written with an older, smaller schema so it has all
+/// `columns`, and returns its rows and new CRC-32s.
+fn pad_part(
+    file_path: &Path,
+    columns: &BTreeMap<String, DataType>,
+    options: &WriterOptions,
+    message_indices: Option<(u64, u64)>,
+) -> EncodedPart {
+    let df = read_part(file_path);
+    let mut padded_df = align_columns(&df, columns).expect("Failed to pad part file");
+    let (crc32, ipc_crc32) = write_files(file_path, &mut padded_df, options, message_indices, true);
+    (padded_df.height(), crc32, ipc_crc32)
+}
+
+/// Work of the encoding threads, numbered by the slot its result is returned with.
+enum Job {
+    /// Align a batch of messages and write it as a part file
+    Write {
+        slot: usize,
+        file_path: PathBuf,
+        dfs: Vec<DataFrame>,
+        /// Charge of the messages, released once the part is written
+        bytes: usize,
+        columns: Arc<BTreeMap<String, DataType>>,
+        message_indices: Option<(u64, u64)>,
+    },
+    /// Pad a part file to the final schema
+    Pad {
+        slot: usize,
+        file_path: PathBuf,
+        columns: Arc<BTreeMap<String, DataType>>,
+        message_indices: Option<(u64, u64)>,
+    },
+}
+
+/// The encoded part of a slot, or the panic that stopped its encoding.
+type Encoded = (usize, thread::Result<EncodedPart>);
+
+/// Runs the jobs of `rx_jobs` until the writer closes the queue.
+fn encode(
+    rx_jobs: Receiver<Job>,
+    tx_encoded: Sender<Encoded>,
+    options: &WriterOptions,
+    metrics: &Metrics,
+    budget: &Budget,
+) {
+    let mut timer = Timer::new();
+    while let Ok(job) = rx_jobs.recv() {
+        timer.idle();
+        // A panic is handed to the writer, which would otherwise wait for the part forever
+        let encoded = match job {
+            Job::Write {
+                slot,
+                file_path,
+                dfs,
+                bytes,
+                columns,
+                message_indices,
+            } => {
+                let result = panic::catch_unwind(AssertUnwindSafe(|| {
+                    write_part(&file_path, dfs, &columns, options, message_indices)
+                }));
+                budget.release(bytes);
+                (slot, result)
+            }
+            Job::Pad {
+                slot,
+                file_path,
+                columns,
+                message_indices,
+            } => (
+                slot,
+                panic::catch_unwind(AssertUnwindSafe(|| {
+                    pad_part(&file_path, &columns, options, message_indices)
+                })),
+            ),
+        };
+        timer.busy();
+        if tx_encoded.send(encoded).is_err() {
+            break;
+        }
+    }
+    timer.idle();
+    timer.finish(&metrics.encode);
+}
+
+/// Returns the rows and CRC-32s of an encoded part, or resumes the panic of its encoding.
+fn encoded_part(result: thread::Result<EncodedPart>) -> EncodedPart {
+    result.unwrap_or_else(|e| panic::resume_unwind(e))
+}
+
+/// The parts handed to the encoding threads that are not in the manifest yet.
+///
+/// Parts are added to the manifest in the order they were numbered, so a part
+/// is never checkpointed before an earlier part of its partition.
+struct Encoders {
+    tx_jobs: Sender<Job>,
+    rx_encoded: Receiver<Encoded>,
+    /// Parts by slot, with their rows and CRC-32 once encoded
+    pending: BTreeMap<usize, (Part, bool)>,
+    next_slot: usize,
+}
+
+impl Encoders {
+    /// Hands a batch to the encoding threads, waiting for one to be free.
+    fn write(
+        &mut self,
+        (part, file_path, dfs, bytes): (Part, PathBuf, Vec<DataFrame>, usize),
+        columns: Arc<BTreeMap<String, DataType>>,
+    ) {
+        let slot = self.next_slot;
+        self.next_slot += 1;
+        let message_indices = part.message_indices;
+        self.pending.insert(slot, (part, false));
+        self.tx_jobs
+            .send(Job::Write {
+                slot,
+                file_path,
+                dfs,
+                bytes,
+                columns,
+                message_indices,
+            })
+            .expect("Encoding threads stopped");
+    }
+
+    /// Whether a part handed to the encoding threads is not encoded yet.
+    fn encoding(&self) -> bool {
+        self.pending.values().any(|(_, done)| !done)
+    }
+
+    /// First message and input byte offset of the parts not in the manifest yet.
+    fn first(&self) -> Option<(usize, usize)> {
+        self.pending
+            .values()
+            .map(|(part, _)| (part.first_message, part.start_offset))
+            .min()
+    }
+
+    /// Moves the encoded parts, in order, to `manifest`, waiting for every
+    /// pending part if `wait`. Returns whether any part was moved.
+    fn collect(
+        &mut self,
+        manifest: &mut Manifest,
+        output_path: &Path,
+        metrics: &Metrics,
+        wait: bool,
+    ) -> bool {
+        loop {
+            let encoded = if wait && self.encoding() {
+                self.rx_encoded.recv().ok()
+            } else {
+                self.rx_encoded.try_recv().ok()
+            };
+            let Some((slot, result)) = encoded else {
+                break;
+            };
+            let (rows, crc32, ipc_crc32) = encoded_part(result);
+            let (part, done) = self.pending.get_mut(&slot).expect("Unknown part slot");
+            (part.rows, part.crc32, part.ipc_crc32, *done) = (rows, crc32, ipc_crc32, true);
+        }
+        let mut moved = false;
+        while let Some(entry) = self.pending.first_entry() {
+            if !entry.get().1 {
+                break;
+            }
+            let (part, _) = entry.remove();
+            metrics.part(&part.file, &output_path.join(&part.file), part.rows);
+            manifest.parts.push(part);
+            moved = true;
+        }
+        moved
+    }
+
+    /// Pads the parts of `manifest` written before the schema was complete.
+    fn pad(
+        &mut self,
+        manifest: &mut Manifest,
+        output_path: &Path,
+        columns: &BTreeMap<String, DataType>,
+        metrics: &Metrics,
+    ) {
+        let columns = Arc::new(columns.clone());
+        let outdated: Vec<usize> = (0..manifest.parts.len())
+            .filter(|&i| manifest.parts[i].columns < columns.len())
+            .collect();
+        // The results queue is not bounded, so the jobs can all be sent first
+        for &i in &outdated {
+            self.tx_jobs
+                .send(Job::Pad {
+                    slot: i,
+                    file_path: output_path.join(&manifest.parts[i].file),
+                    columns: columns.clone(),
+                    message_indices: manifest.parts[i].message_indices,
+                })
+                .expect("Encoding threads stopped");
+        }
+        for _ in &outdated {
+            let (i, result) = self.rx_encoded.recv().expect("Encoding threads stopped");
+            let (rows, crc32, ipc_crc32) = encoded_part(result);
+            let part = &mut manifest.parts[i];
+            (part.crc32, part.ipc_crc32, part.columns) = (crc32, ipc_crc32, columns.len());
+            metrics.part(&part.file, &output_path.join(&part.file), rows);
+            manifest
+                .save(output_path)
+                .expect("Failed to save the manifest");
+        }
+    }
+}
+
+/// Escapes the characters that can not be used in a Hive partition directory name.
+fn escape_partition_value(value: &str) -> String {
+    let mut escaped = String::with_capacity(value.len());
+    for byte in value.bytes() {
+        if byte.is_ascii_alphanumeric() || matches!(byte, b'.' | b'-' | b'_' | b' ') {
+            escaped.push(byte as char);
+        } else {
+            escaped.push_str(&format!("%{:02X}", byte));
+        }
+    }
+    escaped
+}
+
+/// Trading date of a message: the date of its `TIMESTAMP` in exchange local time.
+fn trading_date(df: &DataFrame) -> Option<String> {
+    let timestamp = match df.column("TIMESTAMP").ok()?.get(0).ok()? {
+        AnyValue::Datetime(timestamp, _, _) => timestamp,
+        AnyValue::String(timestamp) => {
+            let gmt_offset = match df.column("GMT_OFFSET").ok().map(|c| c.get(0)) {
+                Some(Ok(AnyValue::String(gmt_offset))) => parse_gmt_offset(gmt_offset),
+                _ => None,
+            };
+            parse_timestamp(timestamp)? + gmt_offset.unwrap_or(0)
+        }
+        _ => return None,
+    };
+    Some(format_date(timestamp.div_euclid(86_400_000_000_000)))
+}
+
+/// Directory of the partition of a message, relative to the output directory.
+fn partition_of(df: &DataFrame) -> PathBuf {
+    let ticker = match df.column("TICKER").ok().map(|c| c.get(0)) {
+        Some(Ok(AnyValue::String(ticker))) if !ticker.is_empty() => escape_partition_value(ticker),
+        _ => DEFAULT_PARTITION.to_string(),
+    };
+    let date = trading_date(df).unwrap_or_else(|| DEFAULT_PARTITION.to_string());
+    Path::new(&format!("TICKER={}", ticker)).join(format!("date={}", date))
+}
+
+/// Messages waiting to be written to one output directory.
+struct Partition {
+    /// Directory of the partition relative to the output directory
+    key: PathBuf,
+    dfs: Vec<DataFrame>,
+    /// Estimated in-memory size of `dfs`
+    bytes: usize,
+    /// Message number and input byte offset of the first message in `dfs`
+    first: (usize, usize),
+    /// Message number and input byte end of the last message in `dfs`
+    last: (usize, usize),
+    /// Smallest and largest input byte offset of the messages in `dfs`
+    indices: (u64, u64),
+    batch_counter: usize,
+}
+
+impl Partition {
+    fn new(output_path: &Path, key: PathBuf, batch_counter: usize) -> Partition {
+        fs::create_dir_all(output_path.join(&key)).expect("Failed to create output directory");
+        Partition {
+            key,
+            dfs: Vec::new(),
+            bytes: 0,
+            first: (0, 0),
+            last: (0, 0),
+            indices: (0, 0),
+            batch_counter,
+        }
+    }
+
+    fn push(&mut self, message: usize, span: Range<usize>, df: DataFrame) {
+        let index = span.start as u64;
+        if self.dfs.is_empty() {
+            self.first = (message, span.start);
+            self.indices = (index, index);
+        }
+        self.last = (message, span.end);
+        self.indices = (self.indices.0.min(index), self.indices.1.max(index));
+        self.bytes += df.estimated_size();
+        self.dfs.push(df);
+    }
+
+    /// Takes the batch of the partition as its next part, with its estimated
+    /// size. The part has no rows or CRC-32 until it is encoded.
+    fn take(
+        &mut self,
+        output_path: &Path,
+        columns: &BTreeMap<String, DataType>,
+        options: &WriterOptions,
+    ) -> (Part, PathBuf, Vec<DataFrame>, usize) {
+        let file = self.key.join(format!(
+            "part-{:06}.{}",
+            self.batch_counter,
+            options.format.extension()
+        ));
+        let file_path = output_path.join(&file);
+        let bytes = std::mem::take(&mut self.bytes);
+        self.batch_counter += 1;
+        let part = Part {
+            file: file.to_string_lossy().into_owned(),
+            first_message: self.first.0,
+            last_message: self.last.0,
+            start_offset: self.first.1,
+            end_offset: self.last.1,
+            rows: 0,
+            columns: columns.len(),
+            crc32: 0,
+            ipc_crc32: None,
+            message_indices: (!options.ordered).then_some(self.indices),
+        };
+        (part, file_path, std::mem::take(&mut self.dfs), bytes)
+    }
+}
+
+/// Moves the resume point of `manifest` to the first message that is not in a
+/// part of it, or to `next` if every message received so far is.
+fn commit(
+    manifest: &mut Manifest,
+    partitions: &HashMap<PathBuf, Partition>,
+    encoders: &Encoders,
+    next: (usize, usize),
+) {
+    (manifest.messages, manifest.offset) = partitions
+        .values()
+        .filter(|partition| !partition.dfs.is_empty())
+        .map(|partition| partition.first)
+        .chain(encoders.first())
+        .min()
+        .unwrap_or(next);
+}
+
+/// Spawns the thread that orders, batches and writes the parsed messages.
+///
+/// The writer thread only orders the messages, batches them and numbers the
+/// parts. The batches are aligned to the schema and encoded by
+/// `options.writers` threads of its own, several parts at a time, and the
+/// writer adds them to the manifest in order as they are done.
+///
+/// The messages received are numbered from `manifest.messages` on, and the
+/// ones already in a part of `manifest`, written by the run being resumed, are
+/// skipped. The output is only marked complete if the run was not cancelled
+/// and every message up to `input_end` was received, and the writer fails if
+/// one is missing.
+/// The parsed messages are charged to `budget`, which is released as their
+/// parts are written.
+#[allow(clippy::too_many_arguments)]
+pub fn spawn_writer(
+    rx_dataframes: Receiver<IndexedDataFrame>,
+    output_path: PathBuf,
+    fid_types: Arc<FidTypes>,
+    options: WriterOptions,
+    manifest: Manifest,
+    metrics: Arc<Metrics>,
+    progress: Arc<Progress>,
+    budget: Arc<Budget>,
+    input_end: InputEnd,
+) -> thread::JoinHandle<Result<(), String>> {
+    thread::spawn(move || {
+        thread::scope(|s| {
+            // A batch is only handed over to a free thread, so at most
+            // `options.writers` batches are encoded while the next one fills
+            let (tx_jobs, rx_jobs) = bounded::<Job>(0);
+            let (tx_encoded, rx_encoded) = unbounded::<Encoded>();
+            for _ in 0..options.writers {
+                let (rx_jobs, tx_encoded) = (rx_jobs.clone(), tx_encoded.clone());
+                let (options, metrics, budget) = (&options, &metrics, &budget);
+                s.spawn(move || encode(rx_jobs, tx_encoded, options, metrics, budget));
+            }
+            let encoders = Encoders {
+                tx_jobs,
+                rx_encoded,
+                pending: BTreeMap::new(),
+                next_slot: 0,
+            };
+            write_ordered(
+                rx_dataframes,
+                &output_path,
+                &fid_types,
+                &options,
+                manifest,
+                &metrics,
+                &progress,
+                &budget,
+                &input_end,
+                encoders,
+            )
+        })
+    })
+}
+
+/// Orders and batches the messages of `rx_dataframes` and hands the batches to `encoders`.
+#[allow(clippy::too_many_arguments)]
+fn write_ordered(
+    rx_dataframes: Receiver<IndexedDataFrame>,
+    output_path: &Path,
+    fid_types: &FidTypes,
+    options: &WriterOptions,
+    mut manifest: Manifest,
+    metrics: &Metrics,
+    progress: &Progress,
+    budget: &Budget,
+    input_end: &OnceLock<(usize, usize)>,
+    mut encoders: Encoders,
+) -> Result<(), String> {
+    let mut timer = Timer::new();
+    let mut reorder = Reorder::default();
+
+    // Every column seen so far and its type, in output order
+    let mut columns = match &options.schema {
+        OutputSchema::Pinned(names) => names
+            .iter()
+            .map(|name| (name.clone(), fid_types.get(name).dtype()))
+            .collect(),
+        _ => initial_columns(fid_types),
+    };
+    if let OutputSchema::Cached(cache) = &options.schema {
+        for name in cache.columns() {
+            if !columns.contains_key(name.as_str()) {
+                columns.insert(name.clone(), fid_types.get(name).dtype());
+            }
+        }
+    }
+    let discover = !matches!(options.schema, OutputSchema::Pinned(_));
+    if options.hive_partitioning {
+        // The ticker is already in the partition path
+        columns.remove("TICKER");
+    }
+    if !options.ordered {
+        columns.insert(MESSAGE_INDEX.to_string(), DataType::UInt64);
+    }
+    // Last message of every partition that is already in a part
+    let mut written: HashMap<PathBuf, usize> = HashMap::new();
+    for part in &manifest.parts {
+        let last = written.entry(part.partition()).or_default();
+        *last = (*last).max(part.last_message);
+    }
+    // The schema only grows, so the last part has every column written so far
+    if let Some(part) = manifest.parts.last().filter(|_| discover) {
+        let df = read_part(&output_path.join(&part.file));
+        for (name, dtype) in df.schema().iter() {
+            if !columns.contains_key(name.as_str()) {
+                columns.insert(name.to_string(), dtype.clone());
+            }
+        }
+    }
+    let mut next: (usize, usize) = (manifest.messages, manifest.offset);
+
+    // Ensure the output directory exists
+    fs::create_dir_all(output_path).expect("Failed to create output directory");
+    let mut partitions: HashMap<PathBuf, Partition> = HashMap::new();
+    // The message just received, when they are written as they come
+    let mut unordered: Option<IndexedDataFrame> = None;
+
+    timer.busy();
+    loop {
+        // While the memory is exhausted, the writer also wakes up when a part
+        // is encoded, as that releases memory for its next batch
+        let received = if budget.is_exhausted() && encoders.encoding() {
+            let mut select = Select::new();
+            select.recv(&rx_dataframes);
+            select.recv(&encoders.rx_encoded);
+            (select.ready() == 0).then(|| rx_dataframes.recv())
+        } else {
+            Some(rx_dataframes.recv())
+        };
+        timer.idle();
+        if let Some(received) = received {
+            let Ok(indexed_df) = received else {
+                break;
+            };
+            if discover {
+                for column in indexed_df.data.get_columns() {
+                    if !columns.contains_key(column.name().as_str())
+                        && !(options.hive_partitioning && column.name().as_str() == "TICKER")
+                    {
+                        columns.insert(column.name().to_string(), column.dtype().clone());
+                    }
+                }
+            }
+            if indexed_df.range == FAILED_RANGE {
+                // Only wakes the writer up to drop the messages it holds
+            } else if options.ordered {
+                reorder.push(indexed_df);
+                metrics.reorder_buffer.record(reorder.pending());
+            } else {
+                // Only the positions are ordered, to find a missing message at the end
+                reorder.push(IndexedDataFrame {
+                    span: indexed_df.span.clone(),
+                    data: DataFrame::empty(),
+                    ..indexed_df
+                });
+                while reorder.pop().is_some() {}
+                unordered = Some(indexed_df);
+            }
+        }
+
+        while let Some(IndexedDataFrame {
+            span, data: mut df, ..
+        }) = unordered.take().or_else(|| reorder.pop())
+        {
+            let message = next.0;
+            if df.width() == 0 {
+                next.1 = span.end;
+                continue;
+            }
+            next = (message + 1, span.end);
+            if !options.ordered {
+                let bytes = df.estimated_size();
+                let index =
+                    UInt64Chunked::full(MESSAGE_INDEX.into(), span.start as u64, df.height());
+                df.with_column(index.into_series())
+                    .expect("Failed to add the message index");
+                budget.charge(df.estimated_size().saturating_sub(bytes));
+            }
+            let key = if options.hive_partitioning && df.height() > 0 {
+                partition_of(&df)
+            } else {
+                PathBuf::new()
+            };
+            if written.get(&key).is_some_and(|&last| message <= last) {
+                budget.release(df.estimated_size());
+                continue;
+            }
+            let partition = partitions.entry(key).or_insert_with_key(|key| {
+                let parts = manifest
+                    .parts
+                    .iter()
+                    .filter(|part| part.partition() == *key)
+                    .count();
+                Partition::new(output_path, key.clone(), parts)
+            });
+            partition.push(message, span, df);
+            if partition.bytes >= options.part_size {
+                let batch = partition.take(output_path, &columns, options);
+                // Waiting for a free encoding thread is not work of the writer
+                timer.busy();
+                encoders.write(batch, Arc::new(columns.clone()));
+                timer.idle();
+            }
+        }
+        if progress.has_failed() {
+            // The messages after the one that failed can never be written in
+            // order, and the memory they hold would keep the readers waiting
+            budget.release(reorder.discard());
+        }
+        if budget.is_exhausted() {
+            // Nothing else releases memory once every part is encoded, so the
+            // largest batch is then flushed whatever its size
+            let min_bytes = if encoders.encoding() {
+                budget.limit().unwrap_or(0) / EARLY_FLUSH_SHARE
+            } else {
+                0
+            };
+            if let Some(partition) = partitions
+                .values_mut()
+                .filter(|partition| !partition.dfs.is_empty() && partition.bytes >= min_bytes)
+                .max_by_key(|partition| partition.bytes)
+            {
+                let batch = partition.take(output_path, &columns, options);
+                timer.busy();
+                encoders.write(batch, Arc::new(columns.clone()));
+                timer.idle();
+            }
+        }
+        if encoders.collect(&mut manifest, output_path, metrics, false) {
+            commit(&mut manifest, &partitions, &encoders, next);
+            manifest
+                .save(output_path)
+                .expect("Failed to save the manifest");
+        }
+        timer.busy();
+    }
+
+    // Final flush
+    let mut remaining: Vec<&mut Partition> = partitions
+        .values_mut()
+        .filter(|partition| !partition.dfs.is_empty())
+        .collect();
+    remaining.sort_by(|a, b| a.key.cmp(&b.key));
+    let final_columns = Arc::new(columns.clone());
+    for partition in remaining {
+        encoders.write(
+            partition.take(output_path, &columns, options),
+            final_columns.clone(),
+        );
+    }
+    partitions.clear();
+    timer.busy();
+    encoders.collect(&mut manifest, output_path, metrics, true);
+    timer.idle();
+    commit(&mut manifest, &partitions, &encoders, next);
+    manifest
+        .save(output_path)
+        .expect("Failed to save the manifest");
+
+    // Reconcile the parts written before the schema was complete
+    encoders.pad(&mut manifest, output_path, &columns, metrics);
+    timer.busy();
+    // A message that never arrived leaves later ones waiting, or the order short of the end
+    let missing = reorder.pending() > 0 || input_end.get() != Some(&reorder.next());
+    manifest.complete = !progress.is_cancelled() && !missing;
+    if let (OutputSchema::Cached(cache), true) = (&options.schema, manifest.complete) {
+        let names = columns
+            .into_keys()
+            .filter(|name| name != MESSAGE_INDEX)
+            .collect();
+        // The cache only saves time, a run whose input directory is read-only still succeeds
+        let _ = cache.store(names);
+    }
+    manifest
+        .save(output_path)
+        .expect("Failed to save the manifest");
+    timer.finish(&metrics.write);
+    if missing && !progress.is_cancelled() {
+        return Err(format!(
+            "The output {:?} is incomplete: message {} of range {} was never received, and {} \
+             later messages were left waiting for it",
+            output_path,
+            reorder.next().1,
+            reorder.next().0,
+            reorder.pending()
+        ));
+    }
+    Ok(())
+}
+
+fn next_position((range, index): (usize, usize), last_in_range: bool) -> (usize, usize) {
+    if last_in_range {
+        (range + 1, 0)
+    } else {
+        (range, index + 1)
+    }
+}
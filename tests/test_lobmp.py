@@ -7,15 +7,41 @@ Plese remember to follow the basic four steps:
 4. Cleanup
 """
 
+import asyncio
+import gzip
+import json
+import shutil
+import zlib
+from datetime import date, datetime, time
+from itertools import accumulate
 from pathlib import Path
 
 import polars as pl
 import pytest
 from polars.testing import assert_frame_equal
 
-from lobmp import find_market_by_price_lines, flatten_map_entry, flatten_market_by_price, run
-from lobmp.definitions.fids import known_fids, supplement
+from lobmp import (
+    Stats,
+    build_index,
+    compact,
+    extract_messages,
+    find_market_by_price_lines,
+    flatten_map_entry,
+    flatten_market_by_price,
+    flatten_market_by_price_many,
+    flatten_messages,
+    generate_messages,
+    iter_batches,
+    read_index,
+    read_ipc_index,
+    reconstruct_book,
+    run,
+    run_async,
+    run_many,
+)
+from lobmp.definitions.fids import fid_types, known_fids, supplement
 from lobmp.logger import activate_logger, set_logger_level
+from lobmp.main import main
 
 activate_logger()
 set_logger_level("DEBUG")
@@ -145,6 +171,27 @@ def test_find_market_by_price_lines_header_and_empty_summary(
     ]  # Should find the headers in the correct places
 
 
+def test_find_market_by_price_lines_ignores_marker_in_values(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    file.touch()
+    test_messages = ""
+    for num_message in range(3):
+        test_messages += generate_market_by_price_message(
+            "TESTTICKER.MC",
+            "2020-01-11T00:00:00.000000000Z",
+            "+0",
+            True,
+            num_message,
+            {"DSPLY_NAME": ["Market By Price"]},
+            None,
+        )
+    file.write_text(test_messages)
+    lines = find_market_by_price_lines(file)
+
+    # Only column 1 of a header line identifies a message
+    assert lines == [0, 3, 6]
+
+
 @pytest.mark.parametrize("num_messages", [0, 100])
 def test_find_market_by_price_lines_header_and_summary(tmp_path: Path, num_messages: int) -> None:
     file = tmp_path / "test_file.csv"
@@ -222,7 +269,7 @@ def test_flatten_map_entry_update_ok(num_map_entries):
                 "LV_TIM_NS": ["06:31:00.020570000"],
             },
         )
-    result = flatten_map_entry(test_string)
+    result = flatten_map_entry(test_string, as_lists=True)
     if num_map_entries == 0:
         assert result == [[]]
     elif num_map_entries > 0:
@@ -276,7 +323,7 @@ def test_flatten_map_entry_add_ok(num_map_entries):
                 "LV_TIM_NS": ["06:31:00.020570000"],
             },
         )
-    result = flatten_map_entry(test_string)
+    result = flatten_map_entry(test_string, as_lists=True)
     if num_map_entries == 0:
         assert result == [[]]
     elif num_map_entries > 0:
@@ -317,7 +364,7 @@ def test_flatten_map_entry_delete_ok(num_map_entries):
     test_string = ""
     for _ in range(num_map_entries):
         test_string += generate_map_entry("DELETE", "1.000000_B", {})
-    result = flatten_map_entry(test_string)
+    result = flatten_map_entry(test_string, as_lists=True)
     if num_map_entries == 0:
         assert result == [[]]
     elif num_map_entries > 0:
@@ -332,6 +379,24 @@ def test_flatten_map_entry_delete_ok(num_map_entries):
         assert result == expected
 
 
+@pytest.mark.parametrize("num_map_entries", [0, 1, 100])
+def test_flatten_map_entry_dataframe_ok(num_map_entries):
+    test_string = "".join(
+        generate_map_entry("ADD", f"{i}.000000_B", {"ORDER_PRC": [f"{i}.5"], "NO_ORD": ["9"]})
+        for i in range(num_map_entries)
+    )
+
+    result = flatten_map_entry(test_string)
+    header, *rows = flatten_map_entry(test_string, as_lists=True)
+    expected = pl.DataFrame(rows, schema=header, orient="row") if header else pl.DataFrame()
+    assert_frame_equal(result, expected)
+
+    typed = flatten_map_entry(test_string, fid_types)
+    if num_map_entries > 0:
+        assert typed["ORDER_PRC"].dtype == pl.Float64
+        assert typed["NO_ORD"].to_list() == [9] * num_map_entries
+
+
 @pytest.mark.parametrize("num_messages", [0, 1, 100, 500])  # Number of Market By Price messages
 @pytest.mark.parametrize(
     "num_map_entries", [0, 1, 50]
@@ -483,3 +548,1201 @@ def test_flatten_market_by_price_ok(
     res = flatten_market_by_price(test_messages)
 
     assert_frame_equal(res, expected, check_column_order=False)
+
+
+@pytest.mark.parametrize("num_messages", [0, 1, 100, 500])  # Number of Market By Price messages
+@pytest.mark.parametrize(
+    "num_map_entries", [0, 1, 50]
+)  # Number of MapEntry messages per Market By Price message
+def test_run_memory_map_matches_run(
+    tmp_path: Path, num_messages: int, num_map_entries: int
+) -> None:
+    file = tmp_path / "test_file.csv"
+    test_messages = "#RIC,Domain,Date-Time,GMT Offset,Type\n"
+    for num_message in range(num_messages):
+        random_map_entries = {}
+        for index in range(num_map_entries):
+            random_map_entries[("UPDATE", f"{index}.000000_B")] = {
+                "BID_TIME": ["06:31:00.000000000"],
+                "ORDER_PRC": [f"{num_message}.{index}"],
+                "ORDER_SIDE": ["1", "BID"],
+                "NO_ORD": ["9"],
+            }
+        test_messages += generate_market_by_price_message(
+            "TESTTICKER.MC",
+            "2020-01-11T00:00:00.000000000Z",
+            "+0",
+            num_message % 2 == 0,
+            num_message,
+            {"PROD_PERM": ["3240"], "DSPLY_NAME": ["TESTING SA"], "CURRENCY": ["999", "TESTCOIN"]},
+            random_map_entries,
+        )
+    file.write_text(test_messages)
+
+    assert run(file, tmp_path / "lines")
+    assert run(file, tmp_path / "mapped", memory_map=True)
+
+    expected_parts = sorted(path.name for path in (tmp_path / "lines").glob("part-*.parquet"))
+    assert sorted(path.name for path in (tmp_path / "mapped").glob("part-*.parquet")) == (
+        expected_parts
+    )
+    if expected_parts:
+        assert_frame_equal(
+            pl.read_parquet(tmp_path / "mapped" / "part-*.parquet"),
+            pl.read_parquet(tmp_path / "lines" / "part-*.parquet"),
+        )
+
+
+def test_run_memory_map_raises_valueerror_when_file_is_not_csv_extension(tmp_path: Path):
+    file = tmp_path / "test_file.txt"
+    file.touch()
+
+    with pytest.raises(ValueError, match="is not of type CSV, Only .csv files are supported"):
+        run(Path(file), Path(tmp_path), memory_map=True)
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_run_pads_parts_written_before_a_new_fid_appears(tmp_path: Path, memory_map: bool) -> None:
+    file = tmp_path / "test_file.csv"
+    num_messages = 3
+    test_messages = ""
+    for num_message in range(num_messages):
+        map_entries = None
+        if num_message == num_messages - 1:
+            map_entries = {("ADD", "1.000000_B"): {"ORDER_PRC": ["100.0"]}}
+        test_messages += generate_market_by_price_message(
+            "TESTTICKER.MC",
+            "2020-01-11T00:00:00.000000000Z",
+            "+0",
+            False,
+            num_message,
+            {"PROD_PERM": ["3240"]},
+            map_entries,
+        )
+    file.write_text(test_messages)
+
+    # A part size of one byte writes every message to its own part
+    assert run(file, tmp_path / "output", memory_map=memory_map, part_size=1)
+
+    parts = [pl.read_parquet(path) for path in sorted((tmp_path / "output").glob("part-*.parquet"))]
+    assert len(parts) == num_messages
+    for part in parts:
+        assert part.columns == sorted([*supplement, "PROD_PERM", "ORDER_PRC"])
+    assert parts[0]["ORDER_PRC"].to_list() == [""]
+    assert parts[-1]["ORDER_PRC"].to_list() == ["100.0"]
+
+
+@pytest.mark.parametrize(
+    ("compression", "compression_level"),
+    [("uncompressed", None), ("snappy", None), ("gzip", 9), ("lz4", None), ("zstd", 19)],
+)
+def test_run_parquet_options_keep_the_data(
+    tmp_path: Path, compression: str, compression_level: int | None
+) -> None:
+    file = tmp_path / "test_file.csv"
+    test_messages = ""
+    for num_message in range(100):
+        test_messages += generate_market_by_price_message(
+            "TESTTICKER.MC",
+            "2020-01-11T00:00:00.000000000Z",
+            "+0",
+            False,
+            num_message,
+            {"PROD_PERM": ["3240"]},
+            {("ADD", "1.000000_B"): {"ORDER_PRC": [f"{num_message}.0"]}},
+        )
+    file.write_text(test_messages)
+
+    assert run(file, tmp_path / "default")
+    assert run(
+        file,
+        tmp_path / "configured",
+        compression=compression,
+        compression_level=compression_level,
+        row_group_size=7,
+        statistics=False,
+    )
+
+    assert_frame_equal(
+        pl.read_parquet(tmp_path / "configured" / "part-*.parquet"),
+        pl.read_parquet(tmp_path / "default" / "part-*.parquet"),
+    )
+
+
+@pytest.mark.parametrize(
+    ("compression", "compression_level"), [("zip", None), ("zstd", 100), ("snappy", 1)]
+)
+def test_run_raises_valueerror_on_bad_compression(
+    tmp_path: Path, compression: str, compression_level: int | None
+) -> None:
+    file = tmp_path / "test_file.csv"
+    file.touch()
+
+    with pytest.raises(ValueError, match="compression"):
+        run(file, tmp_path / "output", compression=compression, compression_level=compression_level)
+
+
+def test_flatten_market_by_price_typed_ok() -> None:
+    message = generate_market_by_price_message(
+        "TESTTICKER.MC",
+        "2020-01-11T08:00:00.000000000Z",
+        "+1",
+        False,
+        0,
+        {"PROD_PERM": ["3240"], "CURRENCY": ["999", "TESTCOIN"], "ACTIV_DATE": ["2020-01-11"]},
+        {
+            ("ADD", "1.000000_B"): {
+                "ORDER_PRC": ["100.5"],
+                "ORDER_SIDE": ["1", "BID"],
+                "ACC_SIZE": ["203"],
+                "NO_ORD": ["9"],
+                "LV_TIM_NS": ["06:31:00.020570000"],
+            },
+            ("DELETE", "2.000000_A"): {},
+        },
+    )
+
+    res = flatten_market_by_price(message, fid_types)
+
+    assert res.schema["ORDER_PRC"] == pl.Float64
+    assert res.schema["ACC_SIZE"] == pl.Int64
+    assert res.schema["NO_ORD"] == pl.Int64
+    assert res.schema["PROD_PERM"] == pl.Int64
+    assert res.schema["ORDER_SIDE"] == pl.Categorical
+    assert res.schema["MAP_ENTRY_TYPE"] == pl.Categorical
+    assert res.schema["ACTIV_DATE"] == pl.Date
+    assert res.schema["LV_TIM_NS"] == pl.Time
+    assert res.schema["TIMESTAMP"] == pl.Datetime("ns")
+    assert res["ORDER_PRC"].to_list() == [100.5, None]
+    assert res["ORDER_SIDE"].cast(pl.String).to_list() == ["BID", None]
+    assert res["TIMESTAMP"].to_list() == [datetime(2020, 1, 11, 9, 0)] * 2  # GMT_OFFSET applied
+    assert res["LV_TIM_NS"].to_list()[0] == time(6, 31, 0, 20570)
+    assert res["ACTIV_DATE"].to_list() == [date(2020, 1, 11)] * 2
+    assert res["CURRENCY"].cast(pl.String).to_list() == ["TESTCOIN"] * 2
+
+
+def test_flatten_market_by_price_raises_valueerror_on_unknown_type() -> None:
+    with pytest.raises(ValueError, match="Unknown type"):
+        flatten_market_by_price("", {"ORDER_PRC": "Float128"})
+
+
+def test_flatten_market_by_price_many(tmp_path: Path) -> None:
+    messages = write_indexed_messages(tmp_path / "test_file.csv")
+    expected = pl.concat(
+        [
+            flatten_market_by_price(message).with_columns(
+                pl.lit(i, dtype=pl.UInt64).alias("MESSAGE_POSITION")
+            )
+            for i, message in enumerate(messages)
+        ],
+        how="diagonal",
+    )
+    offsets = [len(("Header\n" + "".join(messages[:i])).encode()) for i in range(len(messages))]
+
+    from_list = flatten_market_by_price_many(messages)
+    # Lines before the first header are skipped but still count in the offsets
+    from_buffer = flatten_market_by_price_many(("Header\n" + "".join(messages)).encode())
+
+    assert_frame_equal(from_list, expected, check_column_order=False)
+    assert_frame_equal(
+        from_buffer,
+        from_list.rename({"MESSAGE_POSITION": "MESSAGE_INDEX"}).with_columns(
+            pl.col("MESSAGE_INDEX").replace_strict(
+                list(range(len(messages))), offsets, return_dtype=pl.UInt64
+            )
+        ),
+    )
+    assert flatten_market_by_price_many([]).height == 0
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_run_typed_ok(tmp_path: Path, memory_map: bool) -> None:
+    file = tmp_path / "test_file.csv"
+    test_messages = ""
+    for num_message in range(10):
+        test_messages += generate_market_by_price_message(
+            "TESTTICKER.MC",
+            "2020-01-11T00:00:00.000000000Z",
+            "+0",
+            num_message == 0,
+            num_message,
+            {"PROD_PERM": ["3240"]} if num_message == 0 else None,
+            {("UPDATE", "1.000000_B"): {"ORDER_PRC": [f"{num_message}.5"], "NO_ORD": ["9"]}},
+        )
+    file.write_text(test_messages)
+
+    assert run(file, tmp_path / "output", memory_map=memory_map, fid_types=fid_types)
+
+    res = pl.read_parquet(tmp_path / "output" / "part-*.parquet")
+    assert res.columns == sorted([*supplement, "PROD_PERM", "ORDER_PRC", "NO_ORD"])
+    assert res.schema["ORDER_PRC"] == pl.Float64
+    assert res.schema["PROD_PERM"] == pl.Int64
+    assert res.schema["TIMESTAMP"] == pl.Datetime("ns")
+    assert res["ORDER_PRC"].to_list() == [num_message + 0.5 for num_message in range(10)]
+    assert res["PROD_PERM"].to_list() == [3240] + [None] * 9  # Missing typed cells are nulls
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_run_many_matches_run(tmp_path: Path, memory_map: bool) -> None:
+    files = []
+    for num_file in range(3):
+        file = tmp_path / f"test_file_{num_file}.csv"
+        test_messages = ""
+        for num_message in range(10 * num_file):
+            test_messages += generate_market_by_price_message(
+                f"TESTTICKER{num_file}.MC",
+                "2020-01-11T00:00:00.000000000Z",
+                "+0",
+                True,
+                num_message,
+                {"PROD_PERM": ["3240"], "CURRENCY": ["999", "TESTCOIN"]},
+                {("ADD", "1.000000_B"): {"ORDER_PRC": [f"{num_message}.0"]}},
+            )
+        file.write_text(test_messages)
+        files.append(file)
+
+    outputs = [tmp_path / "many" / file.stem for file in files]
+    all_stats = run_many(files, outputs, memory_map=memory_map)
+
+    assert [stats.messages_read for stats in all_stats] == [0, 10, 20]
+    for file, output in zip(files, outputs, strict=True):
+        assert run(file, tmp_path / "single" / file.stem, memory_map=memory_map)
+        expected_parts = sorted(path.name for path in (tmp_path / "single" / file.stem).iterdir())
+        assert sorted(path.name for path in output.iterdir()) == expected_parts
+        if expected_parts:
+            assert_frame_equal(
+                pl.read_parquet(output / "part-*.parquet"),
+                pl.read_parquet(tmp_path / "single" / file.stem / "part-*.parquet"),
+            )
+
+
+def test_run_many_raises_oserror_when_a_file_not_exists(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    file.touch()
+
+    with pytest.raises(OSError):
+        run_many([file, tmp_path / "missing.csv"], [tmp_path / "a", tmp_path / "b"])
+
+
+def test_main_processes_every_csv_file_in_a_directory(tmp_path: Path) -> None:
+    input_directory = tmp_path / "downloads"
+    input_directory.mkdir()
+    for num_file in range(2):
+        (input_directory / f"test_file_{num_file}.csv").write_text(
+            generate_market_by_price_message(
+                "TESTTICKER.MC",
+                "2020-01-11T00:00:00.000000000Z",
+                "+0",
+                True,
+                0,
+                {"PROD_PERM": ["3240"]},
+                None,
+            )
+        )
+    (input_directory / "notes.txt").write_text("not an input file")
+
+    assert main(str(input_directory), str(tmp_path / "output")) == 0
+    assert sorted(path.name for path in (tmp_path / "output").iterdir()) == [
+        "test_file_0.parquet",
+        "test_file_1.parquet",
+    ]
+
+
+def test_main_names_ipc_outputs_after_their_format(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 3)
+
+    assert main(str(file), str(tmp_path / "output"), output_format="ipc") == 0
+    assert [path.name for path in (tmp_path / "output").iterdir()] == ["test_file.arrow"]
+    assert (tmp_path / "output" / "test_file.arrow" / "part-000000.arrow").exists()
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_run_gzip_matches_run(tmp_path: Path, memory_map: bool) -> None:
+    test_messages = ""
+    for num_message in range(100):
+        test_messages += generate_market_by_price_message(
+            "TESTTICKER.MC",
+            "2020-01-11T00:00:00.000000000Z",
+            "+0",
+            num_message % 2 == 0,
+            num_message,
+            {"PROD_PERM": ["3240"], "CURRENCY": ["999", "TESTCOIN"]},
+            {("ADD", "1.000000_B"): {"ORDER_PRC": [f"{num_message}.0"]}},
+        )
+    file = tmp_path / "test_file.csv"
+    file.write_text(test_messages)
+    # Two members, as written by concatenating gzip files
+    compressed_file = tmp_path / "test_file.csv.gz"
+    half = len(test_messages) // 2
+    compressed_file.write_bytes(
+        gzip.compress(test_messages[:half].encode()) + gzip.compress(test_messages[half:].encode())
+    )
+
+    assert run(file, tmp_path / "plain")
+    assert run(compressed_file, tmp_path / "compressed", memory_map=memory_map)
+
+    assert_frame_equal(
+        pl.read_parquet(tmp_path / "compressed" / "part-*.parquet"),
+        pl.read_parquet(tmp_path / "plain" / "part-*.parquet"),
+    )
+    assert find_market_by_price_lines(compressed_file) == find_market_by_price_lines(file)
+
+
+@pytest.mark.parametrize("book_depth", [None, 3])
+def test_run_raises_oserror_on_truncated_gzip(tmp_path: Path, book_depth: int | None) -> None:
+    file = tmp_path / "test_file.csv.gz"
+    compressed = gzip.compress("".join(generate_book_messages()).encode())
+    file.write_bytes(compressed[: len(compressed) // 2])
+
+    with pytest.raises(OSError, match="Error reading line"):
+        run(file, tmp_path / "output", book_depth=book_depth)
+
+
+def generate_book_messages() -> list[str]:
+    return [
+        generate_market_by_price_message(
+            "TESTTICKER.MC",
+            "2020-01-11T00:00:00.000000000Z",
+            "+0",
+            True,
+            0,
+            {"CURRENCY": ["999", "TESTCOIN"]},
+            {
+                ("ADD", "100.5_B"): {
+                    "ORDER_PRC": ["100.5"],
+                    "ORDER_SIDE": ["1", "BID"],
+                    "ACC_SIZE": ["10"],
+                    "NO_ORD": ["1"],
+                },
+                ("ADD", "100.7_B"): {
+                    "ORDER_PRC": ["100.7"],
+                    "ORDER_SIDE": ["1", "BID"],
+                    "ACC_SIZE": ["5"],
+                    "NO_ORD": ["2"],
+                },
+                ("ADD", "101.0_A"): {
+                    "ORDER_PRC": ["101.0"],
+                    "ORDER_SIDE": ["2", "ASK"],
+                    "ACC_SIZE": ["7"],
+                    "NO_ORD": ["1"],
+                },
+            },
+        ),
+        generate_market_by_price_message(
+            "TESTTICKER.MC",
+            "2020-01-11T00:00:01.500000000Z",
+            "+0",
+            False,
+            1,
+            None,
+            {
+                ("DELETE", "100.7_B"): {},
+                ("UPDATE", "100.5_B"): {"ACC_SIZE": ["12"]},
+            },
+        ),
+    ]
+
+
+def test_reconstruct_book_ok() -> None:
+    snapshots = reconstruct_book(generate_book_messages(), depth=2)
+
+    assert snapshots.columns[:5] == [
+        "TICKER",
+        "TIMESTAMP",
+        "BID_PRICE_1",
+        "BID_SIZE_1",
+        "BID_ORDERS_1",
+    ]
+    assert snapshots.height == 2
+    assert snapshots["BID_PRICE_1"].to_list() == [100.7, 100.5]
+    assert snapshots["BID_SIZE_1"].to_list() == [5, 12]
+    assert snapshots["BID_ORDERS_1"].to_list() == [2, 1]  # Kept from the ADD entry
+    assert snapshots["BID_PRICE_2"].to_list() == [100.5, None]
+    assert snapshots["ASK_PRICE_1"].to_list() == [101.0, 101.0]
+    assert snapshots["ASK_PRICE_2"].to_list() == [None, None]
+
+
+def test_reconstruct_book_resampled() -> None:
+    snapshots = reconstruct_book(generate_book_messages(), depth=1, interval="1s")
+
+    # One snapshot at the end of every second with messages
+    assert snapshots["TIMESTAMP"].to_list() == [
+        datetime(2020, 1, 11, 0, 0, 1),
+        datetime(2020, 1, 11, 0, 0, 2),
+    ]
+    assert snapshots["BID_PRICE_1"].to_list() == [100.7, 100.5]
+
+
+def generate_book_refresh(message_number: int, level: str) -> str:
+    return generate_market_by_price_message(
+        "TESTTICKER.MC",
+        f"2020-01-11T00:00:0{message_number}.000000000Z",
+        "+0",
+        True,
+        message_number,
+        None,
+        {("ADD", f"{level}_B"): {"ORDER_PRC": [level], "ORDER_SIDE": ["1", "BID"]}},
+    )
+
+
+def test_reconstruct_book_replaces_the_book_on_every_refresh() -> None:
+    messages = [generate_book_refresh(0, "100.5"), generate_book_refresh(1, "99.5")]
+
+    snapshots = reconstruct_book(messages, depth=2)
+
+    assert snapshots["BID_PRICE_1"].to_list() == [100.5, 99.5]
+    assert snapshots["BID_PRICE_2"].to_list() == [None, None]
+
+
+def test_reconstruct_book_merges_the_parts_of_a_refresh() -> None:
+    # The parts of a refresh carry the same sequence number
+    messages = [generate_book_refresh(0, "100.5"), generate_book_refresh(0, "99.5")]
+
+    snapshots = reconstruct_book(messages, depth=2)
+
+    assert snapshots["BID_PRICE_1"].to_list() == [100.5, 100.5]
+    assert snapshots["BID_PRICE_2"].to_list() == [None, 99.5]
+
+
+def test_reconstruct_book_raises_valueerror_on_bad_interval() -> None:
+    with pytest.raises(ValueError, match="Unknown unit"):
+        reconstruct_book(generate_book_messages(), interval="1 fortnight")
+
+
+def test_run_book_matches_reconstruct_book(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    messages = generate_book_messages()
+    file.write_text("".join(messages))
+
+    assert run(file, tmp_path / "book", book_depth=3)
+
+    assert_frame_equal(
+        pl.read_parquet(tmp_path / "book" / "part-*.parquet"),
+        reconstruct_book(messages, depth=3),
+    )
+
+
+def test_run_book_raises_oserror_on_invalid_utf8(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    messages = [message.encode() for message in generate_book_messages()]
+    messages[1] = messages[1].replace(b"Raw", b"R\xffaw")
+    file.write_bytes(b"".join(messages))
+
+    with pytest.raises(OSError, match="not valid UTF-8"):
+        run(file, tmp_path / "book", book_depth=3)
+
+
+def test_run_book_raises_valueerror_on_unsupported_options(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    file.write_text("".join(generate_book_messages()))
+
+    with pytest.raises(ValueError, match="Book reconstruction can not be used"):
+        run(file, tmp_path / "book", book_depth=3, hive_partitioning=True)
+    with pytest.raises(ValueError, match="Book reconstruction can not be used"):
+        run(file, tmp_path / "book", book_depth=3, memory_map=True)
+    with pytest.raises(ValueError, match="Book reconstruction can not be used"):
+        run(file, tmp_path / "book", book_depth=3, fid_types=fid_types)
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_run_hive_partitioning_ok(tmp_path: Path, memory_map: bool) -> None:
+    file = tmp_path / "test_file.csv"
+    test_messages = ""
+    for num_message, (ticker, timestamp) in enumerate(
+        [
+            ("TESTTICKER.MC", "2020-01-11T10:00:00.000000000Z"),
+            ("OTHER.MC", "2020-01-11T10:00:01.000000000Z"),
+            ("TESTTICKER.MC", "2020-01-12T10:00:00.000000000Z"),
+            ("TESTTICKER.MC", "2020-01-11T23:30:00.000000000Z"),  # 2020-01-12 in local time
+        ]
+    ):
+        test_messages += generate_market_by_price_message(
+            ticker,
+            timestamp,
+            "+1",
+            True,
+            num_message,
+            {"PROD_PERM": ["3240"]},
+            {("ADD", "1.000000_B"): {"ORDER_PRC": [f"{num_message}.0"]}},
+        )
+    file.write_text(test_messages)
+
+    assert run(file, tmp_path / "output", memory_map=memory_map, hive_partitioning=True)
+
+    partitions = sorted(
+        str(path.parent.relative_to(tmp_path / "output"))
+        for path in (tmp_path / "output").rglob("part-*.parquet")
+    )
+    assert partitions == [
+        "TICKER=OTHER.MC/date=2020-01-11",
+        "TICKER=TESTTICKER.MC/date=2020-01-11",
+        "TICKER=TESTTICKER.MC/date=2020-01-12",
+    ]
+    df = pl.read_parquet(
+        tmp_path / "output" / "TICKER=TESTTICKER.MC" / "date=2020-01-12" / "part-*.parquet"
+    )
+    assert "TICKER" not in df.columns
+    assert df["ORDER_PRC"].to_list() == ["2.0", "3.0"]
+
+
+def write_test_messages(file: Path, num_messages: int) -> list[str]:
+    messages = [
+        generate_market_by_price_message(
+            "TESTTICKER.MC",
+            "2020-01-11T00:00:00.000000000Z",
+            "+0",
+            False,
+            num_message,
+            {"PROD_PERM": ["3240"]},
+            {("ADD", "1.000000_B"): {"ORDER_PRC": [f"{num_message}.0"]}},
+        )
+        for num_message in range(num_messages)
+    ]
+    file.write_text("".join(messages))
+    return messages
+
+
+def write_invalid_message(file: Path) -> None:
+    messages = [message.encode() for message in write_test_messages(file, 3)]
+    # The second message has a byte that is not valid UTF-8
+    messages[1] = messages[1].replace(b"Raw", b"R\xffaw")
+    file.write_bytes(b"".join(messages))
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_run_raises_ioerror_on_invalid_utf8(tmp_path: Path, memory_map: bool) -> None:
+    file = tmp_path / "test_file.csv"
+    write_invalid_message(file)
+
+    with pytest.raises(OSError, match="not valid UTF-8"):
+        run(file, tmp_path / "output", memory_map=memory_map)
+
+    manifest = json.loads((tmp_path / "output" / "_manifest.json").read_text())
+    assert not manifest["complete"]
+
+
+def test_run_resumes_a_failed_run(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    write_invalid_message(file)
+    with pytest.raises(OSError, match="not valid UTF-8"):
+        run(file, tmp_path / "output")
+
+    # The same input, fixed in place
+    file.write_bytes(file.read_bytes().replace(b"R\xffaw", b"R_aw"))
+    run(file, tmp_path / "output", resume=True)
+
+    manifest = json.loads((tmp_path / "output" / "_manifest.json").read_text())
+    assert manifest["complete"]
+    assert pl.read_parquet(tmp_path / "output" / "part-*.parquet").height == 3
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_run_many_reports_a_file_with_an_invalid_message(tmp_path: Path, memory_map: bool) -> None:
+    valid, invalid = tmp_path / "valid.csv", tmp_path / "invalid.csv"
+    write_test_messages(valid, 3)
+    write_invalid_message(invalid)
+    outputs = [tmp_path / "valid", tmp_path / "invalid"]
+
+    with pytest.raises(OSError, match="invalid.csv.*not valid UTF-8"):
+        run_many([valid, invalid], outputs, memory_map=memory_map)
+
+    # The other file is still converted
+    assert json.loads((outputs[0] / "_manifest.json").read_text())["complete"]
+    assert not json.loads((outputs[1] / "_manifest.json").read_text())["complete"]
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_run_writes_manifest(tmp_path: Path, memory_map: bool) -> None:
+    file = tmp_path / "test_file.csv"
+    messages = write_test_messages(file, 3)
+
+    assert run(file, tmp_path / "output", memory_map=memory_map, part_size=1)
+
+    manifest = json.loads((tmp_path / "output" / "_manifest.json").read_text())
+    assert manifest["complete"]
+    assert manifest["messages"] == 3
+    assert manifest["offset"] == file.stat().st_size
+    offset = 0
+    for i, (part, message) in enumerate(zip(manifest["parts"], messages, strict=True)):
+        assert part["file"] == f"part-{i:06}.parquet"
+        assert part["first_message"] == part["last_message"] == i
+        assert (part["start_offset"], part["end_offset"]) == (offset, offset + len(message))
+        assert part["rows"] == 1
+        assert part["crc32"] == zlib.crc32((tmp_path / "output" / part["file"]).read_bytes())
+        offset += len(message)
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_run_resume_matches_run(tmp_path: Path, memory_map: bool) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 5)
+    assert run(file, tmp_path / "full", part_size=1)
+
+    # Interrupted after the second part was committed and while the third was written
+    shutil.copytree(tmp_path / "full", tmp_path / "resumed")
+    manifest = json.loads((tmp_path / "full" / "_manifest.json").read_text())
+    committed = manifest["parts"][:2]
+    interrupted = {
+        **manifest,
+        "complete": False,
+        "messages": committed[-1]["last_message"] + 1,
+        "offset": committed[-1]["end_offset"],
+        "parts": committed,
+    }
+    (tmp_path / "resumed" / "_manifest.json").write_text(json.dumps(interrupted))
+    for part in manifest["parts"][2:]:
+        (tmp_path / "resumed" / part["file"]).unlink()
+    (tmp_path / "resumed" / "part-000002.parquet").write_bytes(b"PAR1")
+
+    assert run(file, tmp_path / "resumed", memory_map=memory_map, part_size=1, resume=True)
+
+    assert json.loads((tmp_path / "resumed" / "_manifest.json").read_text()) == manifest
+    assert_frame_equal(
+        pl.read_parquet(tmp_path / "resumed" / "part-*.parquet"),
+        pl.read_parquet(tmp_path / "full" / "part-*.parquet"),
+    )
+
+
+def test_run_resume_raises_valueerror_when_a_part_changed(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 3)
+    assert run(file, tmp_path / "output", part_size=1)
+    manifest = json.loads((tmp_path / "output" / "_manifest.json").read_text())
+    (tmp_path / "output" / "_manifest.json").write_text(json.dumps({**manifest, "complete": False}))
+    (tmp_path / "output" / "part-000000.parquet").write_bytes(b"PAR1")
+
+    with pytest.raises(ValueError, match="does not match the checksum"):
+        run(file, tmp_path / "output", resume=True)
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_iter_batches_matches_run(tmp_path: Path, memory_map: bool) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 100)
+    assert run(file, tmp_path / "output")
+
+    batches = list(iter_batches(file, batch_rows=7, memory_map=memory_map))
+
+    assert all(batch.height >= 7 for batch in batches[:-1])
+    assert_frame_equal(
+        pl.concat(batches, how="diagonal"),
+        pl.read_parquet(tmp_path / "output" / "part-*.parquet"),
+    )
+
+
+def test_iter_batches_stops_when_the_consumer_stops(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 1000)
+
+    batches = iter_batches(file, batch_rows=1)
+    first = next(batches)
+    del batches
+
+    assert first["ORDER_PRC"].to_list() == ["0.0"]
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_iter_batches_raises_oserror_on_invalid_utf8(tmp_path: Path, memory_map: bool) -> None:
+    file = tmp_path / "test_file.csv"
+    write_invalid_message(file)
+
+    with pytest.raises(OSError, match="not valid UTF-8"):
+        list(iter_batches(file, batch_rows=1, memory_map=memory_map))
+
+
+def test_iter_batches_raises_valueerror_when_file_is_not_csv_extension(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.txt"
+    file.touch()
+
+    with pytest.raises(ValueError, match="is not of type CSV, Only .csv files are supported"):
+        iter_batches(file)
+
+
+def write_filter_test_messages(file: Path) -> None:
+    messages = [
+        generate_market_by_price_message(
+            ticker,
+            f"2020-01-11T{hour:02d}:00:00.000000000Z",
+            "+1",
+            False,
+            num_message,
+            {"PROD_PERM": ["3240"]},
+            {("ADD", "1.000000_B"): {"ORDER_PRC": [f"{num_message}.0"], "ACC_SIZE": ["10"]}},
+        )
+        for num_message, (ticker, hour) in enumerate(
+            (ticker, hour) for hour in range(8, 12) for ticker in ("AAA.MC", "BBB.MC")
+        )
+    ]
+    file.write_text("".join(messages))
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_run_filters_tickers_fids_and_window(tmp_path: Path, memory_map: bool) -> None:
+    file = tmp_path / "test_file.csv"
+    write_filter_test_messages(file)
+
+    assert run(file, tmp_path / "output", memory_map=memory_map)
+    assert run(
+        file,
+        tmp_path / "filtered",
+        memory_map=memory_map,
+        tickers=["AAA.MC"],
+        fids=["ORDER_PRC"],
+        start="2020-01-11T09:00:00",
+        end="2020-01-11T11:00:00",
+    )
+
+    df = pl.read_parquet(tmp_path / "output" / "part-*.parquet")
+    expected = df.filter(
+        (pl.col("TICKER") == "AAA.MC")
+        & pl.col("TIMESTAMP").is_in(
+            ["2020-01-11T09:00:00.000000000Z", "2020-01-11T10:00:00.000000000Z"]
+        )
+    ).drop("PROD_PERM", "ACC_SIZE")
+    assert_frame_equal(pl.read_parquet(tmp_path / "filtered" / "part-*.parquet"), expected)
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_run_completes_when_every_message_is_filtered_out(tmp_path: Path, memory_map: bool) -> None:
+    file = tmp_path / "test_file.csv"
+    write_filter_test_messages(file)
+
+    assert run(file, tmp_path / "output", memory_map=memory_map, tickers=["CCC.MC"])
+
+    manifest = json.loads((tmp_path / "output" / "_manifest.json").read_text())
+    assert manifest["complete"]
+    assert manifest["parts"] == []
+
+
+def test_iter_batches_filters_tickers(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    write_filter_test_messages(file)
+
+    df = pl.concat(iter_batches(file, tickers=["BBB.MC"]), how="diagonal")
+
+    assert df["TICKER"].unique().to_list() == ["BBB.MC"]
+    assert df.height == 4
+
+
+def test_run_raises_valueerror_on_invalid_window(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    write_filter_test_messages(file)
+
+    with pytest.raises(ValueError, match="Invalid timestamp"):
+        run(file, tmp_path / "output", start="yesterday")
+
+
+@pytest.mark.parametrize("suffix", [".csv", ".csv.gz", ".csv.zst"])
+def test_generate_messages_runs(tmp_path: Path, suffix: str) -> None:
+    file = tmp_path / f"synthetic{suffix}"
+
+    messages = generate_messages(file, 100_000, tickers=5, seed=1)
+
+    assert len(find_market_by_price_lines(file)) == messages
+    assert run(file, tmp_path / "output")
+    df = pl.read_parquet(tmp_path / "output" / "part-*.parquet")
+    assert df["TICKER"].n_unique() == 5
+    assert set(df["MARKET_MESSAGE_TYPE"]) == {"REFRESH", "UPDATE"}
+
+
+def test_generate_messages_is_reproducible(tmp_path: Path) -> None:
+    generate_messages(tmp_path / "first.csv", 10_000, seed=7)
+    generate_messages(tmp_path / "second.csv", 10_000, seed=7)
+    generate_messages(tmp_path / "third.csv", 10_000, seed=8)
+
+    assert (tmp_path / "first.csv").read_bytes() == (tmp_path / "second.csv").read_bytes()
+    assert (tmp_path / "first.csv").read_bytes() != (tmp_path / "third.csv").read_bytes()
+
+
+def test_generate_messages_raises_valueerror_on_bad_options(tmp_path: Path) -> None:
+    with pytest.raises(ValueError, match="refresh_ratio must be between 0 and 1"):
+        generate_messages(tmp_path / "synthetic.csv", 1000, refresh_ratio=2.0)
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_run_returns_stats(tmp_path: Path, memory_map: bool) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 10)
+
+    stats = run(file, tmp_path / "output", memory_map=memory_map, part_size=1, write_stats=True)
+
+    df = pl.read_parquet(tmp_path / "output" / "part-*.parquet")
+    assert stats.messages_read == 10
+    assert stats.messages_parsed == 10
+    assert stats.bytes_read == file.stat().st_size
+    assert stats.rows_written == df.height
+    assert len(stats.parts) == 10
+    assert sum(part["bytes"] for part in stats.parts) == stats.bytes_written
+    assert set(stats.stages) == {"read", "parse", "write", "encode"}
+    assert stats.reorder_buffer_peak >= 1
+    saved = json.loads((tmp_path / "output" / "_stats.json").read_text())
+    assert saved["parts"] == stats.parts
+    assert saved["messages_read"] == stats.to_dict()["messages_read"]
+
+
+def test_run_book_returns_stats(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    file.write_text("".join(generate_book_messages()))
+
+    stats = run(file, tmp_path / "output", book_depth=2)
+
+    df = pl.read_parquet(tmp_path / "output" / "part-*.parquet")
+    assert stats.messages_read == len(generate_book_messages())
+    assert stats.rows_written == df.height
+    assert not (tmp_path / "output" / "_stats.json").exists()
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_run_reports_progress(tmp_path: Path, memory_map: bool) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 10)
+    reports: list[tuple[int, int]] = []
+
+    run(
+        file,
+        tmp_path / "output",
+        memory_map=memory_map,
+        progress=lambda done, total: reports.append((done, total)),
+    )
+
+    assert reports
+    assert reports[-1] == (file.stat().st_size, file.stat().st_size)
+    assert [done for done, _ in reports] == sorted(done for done, _ in reports)
+
+
+def test_run_raises_progress_errors(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 10)
+
+    def progress(done: int, total: int) -> None:
+        raise RuntimeError("Stop")
+
+    with pytest.raises(RuntimeError, match="Stop"):
+        run(file, tmp_path / "output", progress=progress)
+
+
+def test_run_async(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 10)
+    reports: list[tuple[int, int]] = []
+
+    async def convert() -> tuple[Stats, Stats]:
+        return await asyncio.gather(
+            run_async(
+                file,
+                tmp_path / "output_1",
+                progress=lambda done, total: reports.append((done, total)),
+            ),
+            run_async(file, tmp_path / "output_2", memory_map=True),
+        )
+
+    stats = asyncio.run(convert())
+
+    assert [s.messages_read for s in stats] == [10, 10]
+    assert reports[-1] == (file.stat().st_size, file.stat().st_size)
+    assert_frame_equal(
+        pl.read_parquet(tmp_path / "output_1" / "part-*.parquet"),
+        pl.read_parquet(tmp_path / "output_2" / "part-*.parquet"),
+    )
+
+
+@pytest.mark.parametrize("hive_partitioning", [False, True])
+def test_run_writers_keep_the_parts_in_order(tmp_path: Path, hive_partitioning: bool) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 20)
+
+    for writers in [1, 3]:
+        run(
+            file,
+            tmp_path / f"output_{writers}",
+            part_size=1,
+            hive_partitioning=hive_partitioning,
+            writers=writers,
+        )
+
+    manifests = [
+        json.loads((tmp_path / f"output_{writers}" / "_manifest.json").read_text())
+        for writers in [1, 3]
+    ]
+    assert manifests[0]["parts"] == manifests[1]["parts"]
+    assert [part["first_message"] for part in manifests[1]["parts"]] == list(range(20))
+    assert manifests[1]["complete"]
+
+
+def test_run_invalid_writers(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 1)
+
+    with pytest.raises(ValueError, match="must be at least 1"):
+        run(file, tmp_path / "output", writers=0)
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_run_unordered_keeps_the_messages(tmp_path: Path, memory_map: bool) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 20)
+
+    run(file, tmp_path / "ordered", memory_map=memory_map)
+    run(file, tmp_path / "unordered", memory_map=memory_map, part_size=1, ordered=False)
+
+    ordered = pl.read_parquet(tmp_path / "ordered" / "part-*.parquet")
+    unordered = pl.read_parquet(tmp_path / "unordered" / "part-*.parquet")
+    assert unordered["MESSAGE_INDEX"].dtype == pl.UInt64
+    assert unordered["MESSAGE_INDEX"].n_unique() == 20
+    assert_frame_equal(unordered.sort("MESSAGE_INDEX").drop("MESSAGE_INDEX"), ordered)
+
+    manifest = json.loads((tmp_path / "unordered" / "_manifest.json").read_text())
+    for part in manifest["parts"]:
+        df = pl.read_parquet(tmp_path / "unordered" / part["file"])
+        assert part["message_indices"] == [df["MESSAGE_INDEX"].min(), df["MESSAGE_INDEX"].max()]
+        metadata = pl.read_parquet_metadata(tmp_path / "unordered" / part["file"])
+        assert int(metadata["lobmp.min_message_index"]) == df["MESSAGE_INDEX"].min()
+        assert int(metadata["lobmp.max_message_index"]) == df["MESSAGE_INDEX"].max()
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_run_memory_limit_keeps_the_messages(tmp_path: Path, memory_map: bool) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 20)
+
+    run(file, tmp_path / "unlimited", memory_map=memory_map)
+    # Every message exhausts the budget, so the batches are flushed early
+    run(file, tmp_path / "limited", memory_map=memory_map, memory_limit=1)
+
+    unlimited = pl.read_parquet(tmp_path / "unlimited" / "part-*.parquet")
+    limited = pl.read_parquet(tmp_path / "limited" / "part-*.parquet")
+    assert_frame_equal(limited, unlimited)
+    manifest = json.loads((tmp_path / "limited" / "_manifest.json").read_text())
+    assert len(manifest["parts"]) > 1
+    assert manifest["complete"]
+
+
+def test_run_invalid_memory_limit(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 1)
+
+    with pytest.raises(ValueError, match="memory limit must be at least 1 byte"):
+        run(file, tmp_path / "output", memory_limit=0)
+
+
+def test_run_unordered_can_not_be_resumed(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 2)
+
+    with pytest.raises(ValueError, match="Unordered output can not be resumed"):
+        run(file, tmp_path / "output", ordered=False, resume=True)
+
+    run(file, tmp_path / "output", ordered=False)
+    with pytest.raises(ValueError, match="was written unordered"):
+        run(file, tmp_path / "output", resume=True)
+
+
+def write_indexed_messages(file: Path) -> list[str]:
+    messages = [
+        generate_market_by_price_message(
+            ticker,
+            f"2020-01-11T0{hour}:00:00.000000000Z",
+            "+0",
+            hour < 2,
+            hour,
+            {"PROD_PERM": ["3240"]},
+            {("ADD", "1.000000_B"): {"ORDER_PRC": [f"{hour}.0"]}},
+        )
+        for hour, ticker in enumerate(["AAA.MC", "BBB.MC", "AAA.MC", "BBB.MC"])
+    ]
+    file.write_text("".join(messages))
+    return messages
+
+
+def test_build_index(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    messages = write_indexed_messages(file)
+
+    assert build_index(file) == 4
+    assert (tmp_path / "test_file.csv.lobmpidx").exists()
+
+    index = read_index(file)
+    assert index["TICKER"].to_list() == ["AAA.MC", "BBB.MC", "AAA.MC", "BBB.MC"]
+    assert index["REFRESH"].to_list() == [True, True, False, False]
+    assert index["LENGTH"].to_list() == [len(message) for message in messages]
+    assert index["OFFSET"].to_list() == [0, *accumulate(len(message) for message in messages[:-1])]
+    assert index["TIMESTAMP"][1] == datetime(2020, 1, 11, 1)
+
+
+def test_extract_messages_with_the_index(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    messages = write_indexed_messages(file)
+
+    # The index is built on demand
+    assert extract_messages(file, tickers=["BBB.MC"]) == [messages[1], messages[3]]
+    assert (
+        extract_messages(file, start="2020-01-11T01:00:00", end="2020-01-11T03:00:00")
+        == (messages[1:3])
+    )
+    assert extract_messages(file, tickers=["CCC.MC"]) == []
+
+    df = flatten_messages(file, tickers=["AAA.MC"])
+    expected = pl.concat(
+        [flatten_market_by_price(messages[0]), flatten_market_by_price(messages[2])],
+        how="diagonal",
+    )
+    assert_frame_equal(df, expected, check_column_order=False)
+
+
+def test_index_is_rebuilt_when_the_file_changes(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    messages = write_indexed_messages(file)
+    build_index(file)
+
+    file.write_text("".join(messages[:2]))
+    assert read_index(file).height == 2
+
+
+def test_run_writes_the_index(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    write_indexed_messages(file)
+
+    run(file, tmp_path / "output", write_index=True)
+    assert read_index(file).height == 4
+
+    compressed = tmp_path / "test_file.csv.gz"
+    compressed.write_bytes(gzip.compress(file.read_bytes()))
+    with pytest.raises(ValueError, match="can not be indexed"):
+        build_index(compressed)
+
+
+def test_run_pinned_schema(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    write_indexed_messages(file)
+    schema = ["TICKER", "TIMESTAMP", "ORDER_PRC", "MAP_ENTRY_KEY", "BID"]
+
+    run(file, tmp_path / "output", part_size=1, schema=schema)
+
+    parts = [pl.read_parquet(path) for path in sorted((tmp_path / "output").glob("part-*.parquet"))]
+    assert len(parts) == 4
+    for part in parts:
+        assert part.columns == schema
+        assert part["BID"].to_list() == [""]
+    assert [part["ORDER_PRC"].item() for part in parts] == ["0.0", "1.0", "2.0", "3.0"]
+
+
+def test_run_cached_schema(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    messages = write_indexed_messages(file)
+
+    run(file, tmp_path / "discovered", part_size=1)
+    run(file, tmp_path / "first", part_size=1, cache_schema=True)
+    cache = json.loads((tmp_path / "test_file.csv.lobmpschema.json").read_text())
+    assert cache["columns"] == sorted([*supplement, "PROD_PERM", "ORDER_PRC"])
+
+    # The second run starts from the cached schema, every part has it from the start
+    run(file, tmp_path / "second", part_size=1, cache_schema=True)
+    discovered = pl.read_parquet(tmp_path / "discovered" / "part-*.parquet")
+    for output in ["first", "second"]:
+        assert_frame_equal(pl.read_parquet(tmp_path / output / "part-*.parquet"), discovered)
+
+    # A changed input discovers its schema again
+    file.write_text(messages[0].replace("ORDER_PRC", "ORDER_SIZE"))
+    run(file, tmp_path / "changed", cache_schema=True)
+    cache = json.loads((tmp_path / "test_file.csv.lobmpschema.json").read_text())
+    assert "ORDER_SIZE" in cache["columns"]
+    assert "ORDER_PRC" not in cache["columns"]
+
+
+def test_run_invalid_schema(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 1)
+
+    with pytest.raises(ValueError, match="can not be cached"):
+        run(file, tmp_path / "output", schema=["TICKER"], cache_schema=True)
+    with pytest.raises(ValueError, match="twice in the pinned schema"):
+        run(file, tmp_path / "output", schema=["TICKER", "TICKER"])
+    with pytest.raises(ValueError, match="can not be pinned nor cached"):
+        run(file, tmp_path / "output", book_depth=5, cache_schema=True)
+
+
+@pytest.mark.parametrize("ipc_compression", ["uncompressed", "lz4"])
+def test_run_ipc_output(tmp_path: Path, ipc_compression: str) -> None:
+    file = tmp_path / "test_file.csv"
+    write_indexed_messages(file)
+
+    run(file, tmp_path / "parquet")
+    run(
+        file,
+        tmp_path / "ipc",
+        row_group_size=1,
+        output_format="ipc",
+        ipc_compression=ipc_compression,
+    )
+
+    parquet = pl.read_parquet(tmp_path / "parquet" / "part-*.parquet")
+    part = tmp_path / "ipc" / "part-000000.arrow"
+    assert_frame_equal(pl.read_ipc(part), parquet)
+    manifest = json.loads((tmp_path / "ipc" / "_manifest.json").read_text())
+    assert [part["file"] for part in manifest["parts"]] == ["part-000000.arrow"]
+
+    # Every row is a record batch of its own
+    index = read_ipc_index(part)
+    assert index["OFFSET"].to_list() == [0, 1, 2, 3]
+    assert index["ROWS"].to_list() == [1, 1, 1, 1]
+    assert index["MIN_TICKER"].to_list() == ["AAA.MC", "BBB.MC", "AAA.MC", "BBB.MC"]
+    assert index["MAX_TIMESTAMP"][2] == datetime(2020, 1, 11, 2)
+
+
+def test_run_both_formats(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 3)
+
+    run(file, tmp_path / "output", part_size=1, output_format="both")
+
+    manifest = json.loads((tmp_path / "output" / "_manifest.json").read_text())
+    assert manifest["format"] == "both"
+    for part in manifest["parts"]:
+        parquet_path = tmp_path / "output" / part["file"]
+        ipc_path = parquet_path.with_suffix(".arrow")
+        assert part["ipc_crc32"] == zlib.crc32(ipc_path.read_bytes())
+        assert_frame_equal(pl.read_ipc(ipc_path), pl.read_parquet(parquet_path))
+
+    with pytest.raises(ValueError, match="was written with output_format"):
+        run(file, tmp_path / "output", resume=True)
+
+
+@pytest.mark.parametrize("memory_limit", [None, 100_000])
+def test_compact(tmp_path: Path, memory_limit: int | None) -> None:
+    file = tmp_path / "synthetic.csv"
+    generate_messages(file, 2000, tickers=5, seed=3)
+    output = tmp_path / "output"
+    run(file, output, part_size=20_000, write_stats=True)
+    parts = len(list(output.glob("part-*.parquet")))
+    df = pl.read_parquet(output / "part-*.parquet")
+
+    compacted_parts = compact(
+        output, part_size=200_000, row_group_size=100, memory_limit=memory_limit
+    )
+
+    # The rows are sorted by ticker and timestamp, in input order when equal
+    assert 0 < compacted_parts < parts
+    assert len(list(output.glob("part-*.parquet"))) == compacted_parts
+    compacted = pl.read_parquet(output / "part-*.parquet")
+    assert_frame_equal(compacted, df.sort("TICKER", "TIMESTAMP", maintain_order=True))
+    manifest = json.loads((output / "_manifest.json").read_text())
+    assert manifest["compacted"]
+    for part in manifest["parts"]:
+        assert part["crc32"] == zlib.crc32((output / part["file"]).read_bytes())
+    assert (output / "_stats.json").exists()
+    assert not (tmp_path / "output.compact.tmp").exists()
+
+
+def test_compact_raises_valueerror_on_incomplete_output(tmp_path: Path) -> None:
+    file = tmp_path / "test_file.csv"
+    write_test_messages(file, 3)
+    run(file, tmp_path / "output", part_size=1)
+    manifest_path = tmp_path / "output" / "_manifest.json"
+    manifest = json.loads(manifest_path.read_text())
+    manifest_path.write_text(json.dumps({**manifest, "complete": False}))
+
+    with pytest.raises(ValueError, match="is not complete"):
+        compact(tmp_path / "output")
+    with pytest.raises(ValueError, match="has no manifest"):
+        compact(tmp_path)